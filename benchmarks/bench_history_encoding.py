@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Size and decode cost of the check result history for every encoding of result.history.encoding, and migration of
+existing history lists to one of them.
+
+    python benchmarks/bench_history_encoding.py [-n 20000]
+    python benchmarks/bench_history_encoding.py --redis redis://localhost:6379/0 [--keys 1000]
+    python benchmarks/bench_history_encoding.py --redis redis://localhost:6379/0 --migrate zlib
+
+Without --redis a synthetic history is measured. With --redis up to --keys history lists zmon:checks:<check>:<entity>
+are sampled: bytes per key are the payload of the entries, --migrate also reports what redis MEMORY USAGE says
+before and after rewriting them. Entries are re-encoded from their decoded result, entries that can not be decoded
+are kept as they are.
+"""
+
+import argparse
+import timeit
+
+import redis
+
+from zmon_worker_monitor.zmon_worker.encoder import HISTORY_ENCODINGS, decode_history, dumps_compact, encode_history
+
+KEY_PATTERN = 'zmon:checks:*:*'
+
+
+def synthetic_history(depth=20):
+    return [[dumps_compact({
+        'ts': 1409826332.92 + 60 * i,
+        'td': 0.0123 + i / 1000.0,
+        'worker': 'plocal.zmon-worker-1',
+        'value': {'status': 'UP', 'heap': {'used': 123456789 + 1024 * i, 'max': 536870912}, 'threads': 230 + i,
+                  'gc': {'count': 1200 + i, 'time': 12.5 + i}},
+    }) for i in range(depth)]]
+
+
+def sample_histories(con, max_keys):
+    keys = []
+    for key in con.scan_iter(match=KEY_PATTERN, count=1000):
+        keys.append(key)
+        if len(keys) >= max_keys:
+            break
+    p = con.pipeline(transaction=False)
+    for key in keys:
+        p.lrange(key, 0, -1)
+    # other types matching the pattern fail with WRONGTYPE and are skipped
+    return [(k, entries) for k, entries in zip(keys, p.execute(raise_on_error=False)) if isinstance(entries, list)]
+
+
+def reencode(entries, encoding):
+    encoded = []
+    for entry in entries:
+        try:
+            encoded.append(encode_history(dumps_compact(decode_history(entry)), encoding))
+        except Exception:
+            encoded.append(entry)
+    return encoded
+
+
+def report(histories, number):
+    entries = [e for h in histories for e in h]
+    if not entries:
+        print('no history found')
+        return
+    current = sum(len(e) for e in entries)
+    print('{} keys, {} entries, {:.1f} bytes/key as stored'.format(len(histories), len(entries),
+                                                                   float(current) / len(histories)))
+    print('{:<10} {:>10} {:>8} {:>16}'.format('encoding', 'bytes/key', 'saved', 'decode us/entry'))
+    for encoding in HISTORY_ENCODINGS:
+        encoded = reencode(entries, encoding)
+        size = sum(len(e) for e in encoded)
+        sample = encoded[:number]
+        t = min(timeit.repeat(lambda: map(decode_history, sample), number=max(1, number // len(sample)), repeat=3))
+        print('{:<10} {:>10.1f} {:>7.1f}% {:>16.2f}'.format(
+            encoding, float(size) / len(histories), 100.0 * (current - size) / current,
+            t * 1e6 / (len(sample) * max(1, number // len(sample)))))
+
+
+def memory_usage(con, keys):
+    p = con.pipeline(transaction=False)
+    for key in keys:
+        p.execute_command('MEMORY', 'USAGE', key)
+    usage = [u for u in p.execute(raise_on_error=False) if isinstance(u, (int, long))]
+    return sum(usage) if usage else None
+
+
+def migrate(con, keys, encoding):
+    '''Rewrite the history lists, lists changed by a worker while being rewritten are skipped'''
+    migrated = 0
+    for key in keys:
+        with con.pipeline() as p:
+            try:
+                p.watch(key)
+                entries = p.lrange(key, 0, -1)
+                if not entries:
+                    continue
+                p.multi()
+                p.delete(key)
+                p.rpush(key, *reencode(entries, encoding))
+                p.execute()
+                migrated += 1
+            except redis.WatchError:
+                continue
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--number', type=int, default=20000, help='entries decoded per measurement')
+    parser.add_argument('--redis', help='redis URL to sample history lists from, e.g. redis://localhost:6379/0')
+    parser.add_argument('--keys', type=int, default=1000, help='history lists to sample')
+    parser.add_argument('--migrate', choices=HISTORY_ENCODINGS, help='rewrite the sampled lists with this encoding')
+    args = parser.parse_args()
+
+    if not args.redis:
+        if args.migrate:
+            parser.error('--migrate needs --redis')
+        report(synthetic_history(), args.number)
+        return
+
+    con = redis.StrictRedis.from_url(args.redis)
+    histories = sample_histories(con, args.keys)
+    report([entries for _, entries in histories], args.number)
+
+    if args.migrate:
+        keys = [k for k, _ in histories]
+        before = memory_usage(con, keys)
+        migrated = migrate(con, keys, args.migrate)
+        after = memory_usage(con, keys)
+        print('migrated {} of {} keys to {}'.format(migrated, len(keys), args.migrate))
+        if before and after:
+            print('MEMORY USAGE {:.1f} -> {:.1f} bytes/key, {:.1f}% saved'.format(
+                float(before) / len(keys), float(after) / len(keys), 100.0 * (before - after) / before))
+
+
+if __name__ == '__main__':
+    main()
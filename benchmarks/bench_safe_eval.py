@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of safe_eval with and without the compile cache, for typical check commands, alert conditions and
+notification definitions.
+
+    python benchmarks/bench_safe_eval.py [-n 20000]
+"""
+
+import argparse
+import timeit
+
+from zmon_worker_monitor.zmon_worker.common import eval as zeval
+
+
+class FakeHttp(object):
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+
+    def json(self):
+        return {'status': 'UP', 'checks': {'db': 'UP', 'queue': 'UP'}, 'requests': 1203, 'errors': 3}
+
+
+def send_slack(**kwargs):
+    return True
+
+
+EXPRESSIONS = [
+    ('check-oneliner', '<check-command>', "http('http://{}:8080/health'.format(entity['host']), timeout=5).json()"),
+    ('check-function', '<check-command>', '''
+def check():
+    data = http('http://{}:8080/health'.format(entity['host']), timeout=5).json()
+    failed = [name for name, status in data['checks'].items() if status != 'UP']
+    return {
+        'status': data['status'],
+        'failed': failed,
+        'error_rate': float(data['errors']) / max(data['requests'], 1),
+    }
+'''),
+    ('check-class', '<check-command>', '''
+class Check(object):
+
+    def fetch(self):
+        return http('http://{}:8080/health'.format(entity['host']), timeout=5).json()
+
+    def __call__(self):
+        data = self.fetch()
+        return {k: v for k, v in data.items() if k != 'checks'}
+'''),
+    ('condition', '<alert-condition>', "value['status'] != 'UP' or value['error_rate'] > 0.01"),
+    ('notification', '<check-command>', "send_slack(channel='#alerts', message='{} is down'.format(entity['id']))"),
+]
+
+CONTEXT = {
+    'float': float,
+    'max': max,
+    'http': FakeHttp,
+    'send_slack': send_slack,
+    'entity': {'id': 'app-1[aws:123456789012:eu-central-1]', 'host': '172.31.1.23'},
+    'value': {'status': 'UP', 'error_rate': 0.002},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--number', type=int, default=20000, help='evaluations per measurement')
+    args = parser.parse_args()
+
+    print('{:<16} {:>14} {:>14} {:>9}'.format('expression', 'uncached us', 'cached us', 'speedup'))
+    for name, source, expr in EXPRESSIONS:
+        def run():
+            return zeval.safe_eval(expr, eval_source=source, **CONTEXT)
+
+        zeval.compile_cache.resize(0)
+        t_uncached = min(timeit.repeat(run, number=args.number, repeat=3))
+
+        zeval.compile_cache.resize(zeval.COMPILE_CACHE_SIZE)
+        t_cached = min(timeit.repeat(run, number=args.number, repeat=3))
+
+        print('{:<16} {:>14.2f} {:>14.2f} {:>8.1f}x'.format(
+            name, t_uncached * 1e6 / args.number, t_cached * 1e6 / args.number, t_uncached / t_cached))
+
+    print('cache stats: {}'.format(zeval.compile_cache.stats()))
+
+
+if __name__ == '__main__':
+    main()
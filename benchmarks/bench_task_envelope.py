@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the decode cost per task message for every envelope format the worker accepts.
+
+    python benchmarks/bench_task_envelope.py [-n 20000]
+
+"discard" is the cost of decoding enough to route or discard an expired task, "run" adds decoding args and kwargs.
+"""
+
+import argparse
+import base64
+import json
+import timeit
+
+import snappy
+
+from zmon_worker_monitor.envelope import decode_task, encode_task
+
+CHECK_REQ = {
+    'check_id': 277,
+    'check_name': 'Access control kit health',
+    'interval': 60,
+    'schedule_time': 1409826332.92,
+    'command': "http('http://{}:8080/health'.format(entity['host']), timeout=5).json()",
+    'entity': {
+        'id': 'access-control-kit-1[aws:123456789012:eu-central-1]',
+        'type': 'instance',
+        'host': '172.31.1.23',
+        'application_id': 'access-control-kit',
+        'application_version': '1.0.17',
+        'stack_name': 'access-control-kit',
+        'stack_version': '1',
+        'region': 'eu-central-1',
+        'infrastructure_account': 'aws:123456789012',
+    },
+}
+
+ALERTS = [
+    {
+        'id': 1000 + i,
+        'check_id': 277,
+        'name': 'Access control kit unhealthy {}'.format(i),
+        'condition': "value['status'] != 'UP'",
+        'notifications': ["send_slack(channel='#team-alerts')"],
+        'parameters': {},
+        'entities_map': [],
+        'priority': 1,
+        'team': 'team-a',
+        'responsible_team': 'team-a',
+        'period': '',
+    }
+    for i in range(3)
+]
+
+BODY = {
+    'task': 'check_and_notify',
+    'id': 'check-277-access-control-kit-1-1409826332.92',
+    'expires': '2014-09-04T10:27:32.919152+00:00',
+    'utc': True,
+    'timelimit': [90, 60],
+    'args': [CHECK_REQ, ALERTS],
+    'kwargs': {},
+}
+
+PROPERTIES = {
+    'delivery_info': {'priority': 0, 'routing_key': 'default', 'exchange': 'zmon'},
+    'trace': {'ot-tracer-traceid': '5c3e4e1a1b2c3d4e', 'ot-tracer-spanid': '1a2b3c4d5e6f7a8b'},
+}
+
+
+def celery_message(body_encoding):
+    if body_encoding == 'nested':
+        body = BODY
+    elif body_encoding == 'base64':
+        body = base64.b64encode(json.dumps(BODY))
+    else:
+        body = base64.b64encode(snappy.compress(json.dumps(BODY)))
+    return json.dumps({'body': body, 'properties': dict(PROPERTIES, body_encoding=body_encoding)})
+
+
+def messages():
+    return [
+        ('nested', celery_message('nested')),
+        ('base64', celery_message('base64')),
+        ('snappy', celery_message('snappy')),
+        ('msgpack', encode_task(BODY['task'], BODY['args'], BODY['kwargs'], id=BODY['id'], expires=1409826452.919152,
+                                timelimit=BODY['timelimit'], **PROPERTIES)),
+    ]
+
+
+def discard(msg):
+    return decode_task(msg).is_expired()
+
+
+def run(msg):
+    task = decode_task(msg)
+    return task.is_expired(), task.args, task.kwargs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--number', type=int, default=20000, help='messages decoded per measurement')
+    args = parser.parse_args()
+
+    print('{:<10} {:>8} {:>14} {:>14}'.format('format', 'bytes', 'discard us/msg', 'run us/msg'))
+    for name, msg in messages():
+        t_discard = min(timeit.repeat(lambda: discard(msg), number=args.number, repeat=3))
+        t_run = min(timeit.repeat(lambda: run(msg), number=args.number, repeat=3))
+        print('{:<10} {:>8} {:>14.2f} {:>14.2f}'.format(
+            name, len(msg), t_discard * 1e6 / args.number, t_run * 1e6 / args.number))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import json
+import time
+
+from mock import MagicMock
+
+from zmon_worker_monitor.zmon_worker.common.downtimes import DowntimeIndex
+
+DOWNTIME = json.dumps({'start_time': 0, 'end_time': time.time() + 3600})
+
+
+def mock_con(versions):
+    con = MagicMock()
+    con.get.side_effect = versions
+    loads = []
+
+    def execute():
+        loads.append(1)
+        return [[None, set(['1'])], [set(['e1'])], [{'d1': DOWNTIME}]][(len(loads) - 1) % 3]
+
+    con.pipeline.return_value.execute.side_effect = execute
+    return con
+
+
+def test_reload_on_version_change(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    con = mock_con(['7', None])
+    index = DowntimeIndex(check_interval=1, max_age=60)
+
+    assert [d['id'] for d in index.active(con, 1, 'e1')] == ['d1']
+    assert index.reloads == 1
+
+    # no round trips within the check interval
+    now[0] += 0.5
+    assert index.active(con, 1, 'e2') == []
+    assert con.get.call_count == 0
+
+    # version changed: reload
+    now[0] += 1
+    index.active(con, 1, 'e1')
+    assert con.get.call_count == 1
+    assert index.reloads == 2
+
+    # same version: no reload
+    now[0] += 1
+    index.active(con, 1, 'e1')
+    assert con.get.call_count == 2
+    assert index.reloads == 2
+
+
+def test_reload_when_too_old(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    con = mock_con([])
+    index = DowntimeIndex(check_interval=1, max_age=10)
+
+    index.active(con, 1, 'e1')
+    now[0] += 11
+    index.active(con, 1, 'e1')
+    assert index.reloads == 2
+    assert con.get.call_count == 0
+
+
+def test_reload_on_notification(monkeypatch):
+    con = mock_con([])
+    index = DowntimeIndex(check_interval=60, max_age=60, notifications=True)
+    monkeypatch.setattr(index, '_start_listener', MagicMock())
+
+    index.active(con, 1, 'e1')
+    index.active(con, 1, 'e1')
+    assert index.reloads == 1
+
+    index._stale = True  # set by the listener thread
+    index.active(con, 1, 'e1')
+    assert index.reloads == 2
+    index._start_listener.assert_called_with(con)
+
+
+def test_expired_downtime(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    monkeypatch.setattr('zmon_worker_monitor.zmon_worker.common.utils._registered_scripts', {})
+    con = MagicMock()
+    con.pipeline.return_value.execute.side_effect = [[None, set(['1'])], [set(['e1'])],
+                                                     [{'d1': json.dumps({'start_time': 900, 'end_time': 1100})}]]
+    con.get.return_value = None
+    index = DowntimeIndex(check_interval=1000, max_age=1000)
+
+    assert len(index.active(con, 1, 'e1')) == 1
+    assert con.sadd.call_count == 1
+
+    # active -> expired
+    now[0] = 1200
+    assert index.active(con, 1, 'e1') == []
+    expire = con.register_script.return_value
+    assert expire.call_args[1] == {
+        'keys': ['zmon:downtimes:1:e1', 'zmon:downtimes:1', 'zmon:downtimes', 'zmon:active_downtimes',
+                 'zmon:downtimes:version'],
+        'args': ['d1', 'e1', 1, '1:e1:d1'], 'client': con}
+
+    # removed once
+    index.active(con, 1, 'e1')
+    assert expire.call_count == 1
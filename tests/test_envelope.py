@@ -0,0 +1,66 @@
+import base64
+import json
+
+import pytest
+import snappy
+
+from zmon_worker_monitor.envelope import decode_task, encode_task, MAGIC
+
+BODY = {
+    'task': 'check_and_notify',
+    'id': 'check-123-77-1409826332.92',
+    'expires': '2014-09-04T10:27:32.919152+00:00',
+    'utc': True,
+    'timelimit': [90, 60],
+    'args': [{'check_id': 123, 'entity': {'id': '77'}, 'schedule_time': 1409826300.5}, []],
+    'kwargs': {},
+}
+PROPERTIES = {'delivery_info': {'routing_key': 'default'}, 'trace': {'ot-tracer-traceid': 'abc'}}
+
+
+def celery_message(body_encoding):
+    if body_encoding == 'nested':
+        body = BODY
+    elif body_encoding == 'base64':
+        body = base64.b64encode(json.dumps(BODY))
+    else:
+        body = base64.b64encode(snappy.compress(json.dumps(BODY)))
+    return json.dumps({'body': body, 'properties': dict(PROPERTIES, body_encoding=body_encoding)})
+
+
+@pytest.mark.parametrize('msg', [
+    celery_message('nested'),
+    celery_message('base64'),
+    celery_message('snappy'),
+    snappy.compress(celery_message('nested')),
+    encode_task(BODY['task'], BODY['args'], BODY['kwargs'], id=BODY['id'], expires=1409826452.919152,
+                timelimit=BODY['timelimit'], **PROPERTIES),
+])
+def test_decode_task(msg):
+    task = decode_task(msg)
+
+    assert task.task == 'check_and_notify'
+    assert task.id == BODY['id']
+    assert abs(task.expires - 1409826452.919152) < 1e-6
+    assert task.timelimit == [90, 60]
+    assert task.check_id == 123
+    assert task.entity_id == '77'
+    assert task.schedule_time == 1409826300.5
+    assert task.delivery_info == PROPERTIES['delivery_info']
+    assert task.trace == PROPERTIES['trace']
+    assert task.args == BODY['args']
+    assert task.kwargs == {}
+    assert task.is_expired()
+
+
+def test_binary_envelope_body_is_lazy():
+    task = decode_task(encode_task('cleanup', [{'check_id': 1}], {}))
+
+    assert task._body is None
+    assert not task.is_expired()
+    assert task.args == [{'check_id': 1}]
+
+
+def test_magic_is_not_json_or_snappy():
+    assert MAGIC[:1] != '{'
+    assert snappy.compress('')[:1] == MAGIC[:1]  # only an empty message could clash, we never get those
@@ -1,10 +1,12 @@
 import requests
+import time
 
 import pytest
 from mock import MagicMock
 from zmon_worker_monitor.builtins.plugins.http import HttpWrapper
-from zmon_worker_monitor.zmon_worker.errors import HttpError, CheckError, ConfigurationError
+from zmon_worker_monitor.zmon_worker.errors import HttpError, CheckError, ConfigurationError, TimeLimitExceeded
 from zmon_worker_monitor.zmon_worker.common.http import get_user_agent
+from zmon_worker_monitor.zmon_worker.common.time_ import Deadline
 
 
 def get_dropwizard_metrics():
@@ -191,6 +193,22 @@ def test_retries(monkeypatch):
     assert session.return_value.get.called
 
 
+def test_http_deadline(monkeypatch):
+    get = MagicMock()
+    get.return_value.text = 'OK'
+    monkeypatch.setattr('requests.get', get)
+
+    http = HttpWrapper('http://example.org', deadline=Deadline(4))
+    assert 'OK' == http.text()
+    assert 3 < get.call_args[1]['timeout'] <= 4
+
+    get.reset_mock()
+    http = HttpWrapper('http://example.org', deadline=Deadline(4, start=time.time() - 5))
+    with pytest.raises(TimeLimitExceeded):
+        http.text()
+    assert not get.called
+
+
 def test_basicauth(monkeypatch):
     resp = MagicMock()
     resp.text = 'OK'
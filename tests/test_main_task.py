@@ -1,14 +1,27 @@
+import functools
+import io
 import json
+import threading
 import time
+from collections import Counter
 
 import pytest
+import requests
 from mock import MagicMock
+from requests.packages.urllib3.response import HTTPResponse
 
 from zmon_worker_monitor import plugin_manager
+from zmon_worker_monitor.accounting import add_cost, pop_check_costs
 from zmon_worker_monitor.zmon_worker.tasks.main import (
     DEFAULT_CHECK_RESULTS_HISTORY_LENGTH, MAX_RESULT_KEYS, MainTask,
     ResultSizeError, alert_series, build_condition_context, entity_results,
-    entity_values)
+    entity_values, evaluate_condition, get_results, propartial)
+from zmon_worker_monitor.zmon_worker.common.call_cache import CallCache, call_cache
+from zmon_worker_monitor.zmon_worker.common.downtimes import DowntimeIndex
+from zmon_worker_monitor.zmon_worker.common.time_ import Deadline
+from zmon_worker_monitor.zmon_worker.errors import CheckError, HttpError, TimeLimitExceeded
+from zmon_worker_monitor.zmon_worker.encoder import CheckResult, dumps_compact
+from zmon_worker_monitor.zmon_worker.notifications.dispatcher import NotificationDispatcher
 
 ONE_DAY = 24 * 3600
 
@@ -43,13 +56,44 @@ def fx_big_result(request):
     return request.param
 
 
-def test_entity_results():
+def test_entity_results(monkeypatch):
+    monkeypatch.setattr('zmon_worker_monitor.zmon_worker.tasks.main.entity_results_cache', CallCache(max_ttl=10))
     con = MagicMock()
-    con.hkeys.return_value = ['foo']
-    con.lrange.return_value = ['{"value":7}']
+    con.hkeys.return_value = ['foo', 'bar']
+    con.pipeline.return_value.execute.return_value = [['{"value":7}'], []]
     assert [{'entity_id': 'foo', 'value': 7}] == entity_results(con, 1, 2)
     assert [7] == entity_values(con, 1, 2)
 
+    # all entities read in one round trip, shared by the tasks of the alert
+    con.pipeline.return_value.lrange.assert_any_call('zmon:checks:1:bar', 0, 0)
+    assert con.pipeline.return_value.execute.call_count == 1
+    assert con.hkeys.call_count == 1
+
+
+def test_entity_results_without_cache(monkeypatch):
+    monkeypatch.setattr('zmon_worker_monitor.zmon_worker.tasks.main.entity_results_cache', CallCache(max_ttl=0))
+    started = []
+    both = threading.Event()
+
+    def read_entity_results(con, check_id, alert_id, count):
+        started.append(check_id)
+        if len(started) == 2:
+            both.set()
+        both.wait(5)
+        return [{'entity_id': 'foo', 'value': 7}]
+
+    monkeypatch.setattr('zmon_worker_monitor.zmon_worker.tasks.main._read_entity_results', read_entity_results)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(entity_results(MagicMock(), 1, 2))) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(10)
+
+    # a TTL of 0 reads for every task, none of them waits for the other
+    assert both.is_set()
+    assert results == [[{'entity_id': 'foo', 'value': 7}]] * 2
+
 
 def test_timeseries():
     reload(plugin_manager)
@@ -106,6 +150,118 @@ def test_check(monkeypatch):
     task.check(req)
 
 
+def test_check_accounting(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+
+    MainTask.configure({})
+    task = MainTask()
+
+    def get_check_result(req):
+        add_cost('http_bytes', 1024)
+        return {'value': 'x' * 100}
+
+    monkeypatch.setattr(MainTask, 'con', MagicMock())
+    monkeypatch.setattr(task, '_get_check_result', get_check_result)
+    monkeypatch.setattr(task, 'send_metrics', MagicMock())
+    pop_check_costs()
+
+    req = {'check_id': 123, 'entity': {'id': 'myent'}}
+    task.check(req)
+    task.check(req)
+
+    costs = pop_check_costs()['123']
+    assert costs['runs'] == 2
+    assert costs['http_bytes'] == 2048
+    assert costs['result_bytes'] == 2 * len(dumps_compact({'value': 'x' * 100}))
+    assert costs['wall_time'] > 0 and costs['cpu_time'] >= 0
+
+
+def test_check_accounting_http_bytes(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+
+    MainTask.configure({})
+    task = MainTask()
+
+    def get_check_result(req):
+        # any plugin reading a response through urllib3, not only http()
+        session = requests.Session()
+        adapter = session.get_adapter('http://example.org')
+        raw = HTTPResponse(body=io.BytesIO('x' * 1000), headers={'Content-Length': '1000'}, status=200,
+                           preload_content=False)
+        response = adapter.build_response(requests.Request('GET', 'http://example.org').prepare(), raw)
+        return {'value': len(response.content)}
+
+    monkeypatch.setattr(MainTask, 'con', MagicMock())
+    monkeypatch.setattr(task, '_get_check_result', get_check_result)
+    monkeypatch.setattr(task, 'send_metrics', MagicMock())
+    pop_check_costs()
+
+    task.check({'check_id': 123, 'entity': {'id': 'myent'}})
+    assert pop_check_costs()['123']['http_bytes'] == 1000
+
+    # responses read outside of checks are not counted
+    HTTPResponse(body=io.BytesIO('x' * 10), preload_content=False).read()
+    assert pop_check_costs() == {}
+
+
+def test_check_result_serialized_once(monkeypatch):
+    MainTask.configure({})
+    task = MainTask()
+    monkeypatch.setattr(MainTask, 'con', MagicMock())
+    monkeypatch.setattr(task, '_get_check_result_internal', lambda req: {'ts': 10, 'value': {'a': {'b': 1.5}}})
+
+    encoded = []
+    dumps = MagicMock(side_effect=lambda obj: encoded.append(obj) or json.dumps(obj, separators=(',', ':')))
+    monkeypatch.setattr('zmon_worker_monitor.zmon_worker.encoder.dumps_compact', dumps)
+
+    req = {'check_id': 123, 'entity': {'id': 'myent'}}
+    result = task._get_check_result(req)
+    assert isinstance(result, CheckResult)
+
+    task._store_check_result(req, result)
+    serialized = MainTask._serialize_dataservice_result({'check_id': 123, 'check_result': result})
+
+    # limits, redis and the data service share a single encoding of the result
+    assert [r for r in encoded if r is result] == [result]
+    assert json.loads(serialized)['check_result'] == json.loads(MainTask.con.lpush.call_args[0][1])
+    assert result.numeric_values == {'a.b': 1.5}
+
+
+@pytest.mark.parametrize('encoding', ('json', 'zlib', 'msgpack'))
+def test_store_check_result_history_encoding(monkeypatch, encoding):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+
+    con = MagicMock()
+    monkeypatch.setattr(MainTask, 'con', con)
+    MainTask.configure({'result.history.encoding': encoding})
+    task = MainTask()
+
+    req = {'check_id': 123, 'entity': {'id': 'myent'}}
+    result = {'ts': 10, 'td': 0.25, 'worker': 'plocal.zmon-worker-1', 'value': {'status': 'UP', 'heap': [10 ** 9] * 8}}
+    task._store_check_result(req, result)
+
+    stored = con.lpush.call_args[0][1]
+    assert (len(stored) < len(dumps_compact(result))) == (encoding != 'json')
+
+    # entries written before the encoding was enabled are still read
+    con.lrange.return_value = [stored, dumps_compact(dict(result, ts=5))]
+    assert get_results(con, 123, 'myent', 2) == [dict(result, entity_id='myent'), dict(result, ts=5, entity_id='myent')]
+
+    MainTask.configure({})
+
+
+def test_history_encoding_unknown():
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+
+    with pytest.raises(ValueError):
+        MainTask.configure({'result.history.encoding': 'snappy'})
+    MainTask.configure({})
+
+
 def test_check_result_size_violation(monkeypatch, fx_big_result):
     config, result = fx_big_result
 
@@ -194,14 +350,75 @@ def test_evaluate_downtimes(monkeypatch):
 
     # mock Redis
     con = MagicMock()
-    con.pipeline.return_value.execute.return_value = (['ent1'], {'dt-active': json.dumps(downtimes[0]),
-                                                                 'dt-expired': json.dumps(downtimes[1]),
-                                                                 'dt-future': json.dumps(downtimes[2])})
+    con.pipeline.return_value.execute.side_effect = [[None, set(['1'])], [set(['ent1'])],
+                                                     [{'dt-active': json.dumps(downtimes[0]),
+                                                       'dt-expired': json.dumps(downtimes[1]),
+                                                       'dt-future': json.dumps(downtimes[2])}]]
     monkeypatch.setattr(MainTask, 'con', con)
+    monkeypatch.setattr('zmon_worker_monitor.zmon_worker.tasks.main.downtime_index', DowntimeIndex())
+    monkeypatch.setattr('zmon_worker_monitor.zmon_worker.common.utils._registered_scripts', {})
     MainTask.configure({})
     task = MainTask()
     result = task._evaluate_downtimes(1, 'ent1')
     assert downtimes_active == result
+    con.sadd.assert_called_once_with('zmon:active_downtimes', '1:ent1:dt-active')
+    expire = con.register_script.return_value
+    assert expire.call_count == 1  # expired downtime removed
+
+    # the index is loaded once, only transitions are written
+    assert task._evaluate_downtimes(1, 'ent1') == downtimes_active
+    assert task._evaluate_downtimes(1, 'ent2') == []
+    assert con.pipeline.return_value.execute.call_count == 3
+    assert con.sadd.call_count == 1 and expire.call_count == 1
+
+
+@pytest.mark.parametrize('condition,value', (
+    ('>100', 101),
+    ('>= 100', 99.5),
+    ('== "OK"', 'OK'),
+    ("!='OK'", 'OK'),
+    ('< -1e3', -2000),
+    ('== None', None),
+    ('!= True', {'a': 1}),
+))
+def test_evaluate_alert_simple_condition(monkeypatch, condition, value):
+    MainTask.configure({})
+    task = MainTask()
+
+    build_context = MagicMock(side_effect=build_condition_context)
+    monkeypatch.setattr('zmon_worker_monitor.zmon_worker.tasks.main.build_condition_context', build_context)
+
+    alert_def = {'id': 1, 'check_id': 123, 'condition': condition}
+    is_alert, captures = task.evaluate_alert(alert_def, {'entity': {'id': 'e1'}}, {'value': value})
+
+    assert is_alert is bool(evaluate_condition(value, condition, **{'True': True, 'False': False}))
+    assert captures == {}
+    assert not build_context.called
+
+
+def test_evaluate_alert_lazy_context(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+    plugin_manager.collect_plugins()
+
+    monkeypatch.setattr(MainTask, 'con', MagicMock())
+    MainTask.configure({})
+    task = MainTask()
+    kairosdb_factory = MagicMock()
+    get_plugin = plugin_manager.get_plugin_obj_by_name
+    monkeypatch.setattr(plugin_manager, 'get_plugin_obj_by_name',
+                        lambda name, category: kairosdb_factory if name == 'kairosdb' else get_plugin(name, category))
+
+    alert_def = {'id': 1, 'check_id': 123, 'condition': 'capture(v=value) > 100 and time() is not None'}
+    is_alert, captures = task.evaluate_alert(alert_def, {'entity': {'id': 'e1'}}, {'value': 101})
+
+    assert is_alert and captures == {'v': 101}
+    assert not kairosdb_factory.create.called
+
+    # parameters still must not clash with context functions the condition does not use
+    alert_def['parameters'] = {'kairosdb': {'value': 1}}
+    is_alert, captures = task.evaluate_alert(alert_def, {'entity': {'id': 'e1'}}, {'value': 0})
+    assert is_alert and 'clashes' in captures['exception']
 
 
 def test_notify(monkeypatch):
@@ -209,8 +426,12 @@ def test_notify(monkeypatch):
     plugin_manager.init_plugin_manager()  # init plugin manager
     plugin_manager.collect_plugins()
 
-    # mock Redis
+    # mock Redis: the entity enters or leaves the alert with every state transition
     con = MagicMock()
+    transitions = []
+    pipeline = con.pipeline.return_value
+    pipeline.evalsha.side_effect = lambda sha, numkeys, *args: transitions.append([args[-2]] * 3 + [None, []])
+    pipeline.execute.side_effect = lambda **kwargs: [transitions.pop(0) for _ in list(transitions)]
     monkeypatch.setattr(MainTask, 'con', con)
     monkeypatch.setattr(MainTask, '_evaluate_downtimes', lambda self, x, y: [])
     MainTask.configure({})
@@ -243,6 +464,256 @@ def test_notify(monkeypatch):
     assert [] == notify_result
 
 
+def test_notify_shares_check_history(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+    plugin_manager.collect_plugins()
+
+    con = MagicMock()
+    con.lrange.return_value = ['{{"ts": {}, "value": 1}}'.format(1000 - 60 * i) for i in range(1, 5)]
+    pipeline = con.pipeline.return_value
+    pipeline.execute.side_effect = lambda **kw: [[1, 0, 1, None, []]] * 3 if pipeline.execute.call_count == 1 else []
+    monkeypatch.setattr(MainTask, 'con', con)
+    monkeypatch.setattr(MainTask, '_evaluate_downtimes', lambda self, x, y: [])
+    MainTask.configure({})
+    task = MainTask()
+    monkeypatch.setattr(task, 'send_metrics', MagicMock())
+
+    req = {'check_id': 123, 'check_name': 'My Check', 'entity': {'id': '77', 'type': 'test'}}
+    result = {'ts': 1000, 'value': 5}
+    task._store_check_result(req, result)
+
+    alerts = [{'id': 1, 'check_id': 123, 'condition': 'value_series(1) == [5]'},
+              {'id': 2, 'check_id': 123, 'condition': 'alert_series(lambda v: v > 0, 3)'},
+              {'id': 3, 'check_id': 123, 'condition': 'timeseries_sum("2m") == 7'}]
+    assert task.notify(result, req, alerts) == [1, 2, 3]
+
+    # the latest result is the one just stored, older ones are read once for all alerts
+    con.lrange.assert_called_once_with('zmon:checks:123:77', 1, DEFAULT_CHECK_RESULTS_HISTORY_LENGTH - 1)
+
+
+def test_evaluate_alert_series(monkeypatch):
+    con = MagicMock()
+    con.lrange.return_value = ['{{"ts": {}, "value": {{"load": {}}}}}'.format(1000 - 60 * i, 10 - i) for i in range(5)]
+    monkeypatch.setattr(MainTask, 'con', con)
+    MainTask.configure({})
+    task = MainTask()
+
+    req = {'check_id': 123, 'check_name': 'My Check', 'entity': {'id': '77', 'type': 'test'}}
+    condition = 'series(key=lambda v: v["load"]).window("2m").rate() * 60 == 1 and series(2).last()["load"] == 10'
+    alert = {'id': 1, 'check_id': 123, 'condition': condition}
+    is_alert, captures = task.evaluate_alert(alert, req, {'ts': 1000, 'value': {'load': 10}})
+
+    assert is_alert is True
+    assert captures == {}
+
+
+def test_notify_round_trips(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+    plugin_manager.collect_plugins()
+
+    con = MagicMock()
+    pipeline = con.pipeline.return_value
+    stored = json.dumps({'start_time': 5, 'ts': 4, 'value': 1})
+    # entity stays in alert 1, alert 2 starts, entity leaves alert 3 while others stay in it
+    transitions = [[0, 0, 2, stored, ['send_x()', '0']], [1, 1, 1, None, []], [1, 0, 1, None, ['send_x()', '0']]]
+    pipeline.execute.side_effect = lambda **kwargs: transitions if pipeline.execute.call_count == 1 else []
+    monkeypatch.setattr(MainTask, 'con', con)
+    monkeypatch.setattr(MainTask, '_evaluate_downtimes', lambda self, x, y: [])
+    MainTask.configure({})
+    task = MainTask()
+    send_notification = MagicMock()
+    monkeypatch.setattr(task, 'send_notification', send_notification)
+    monkeypatch.setattr(task, 'send_metrics', MagicMock())
+
+    alerts = [{'id': i, 'check_id': 123, 'condition': cond, 'notifications': ['send_x()']}
+              for i, cond in ((1, '>0'), (2, '>0'), (3, '<0'))]
+    req = {'check_id': 123, 'check_name': 'My Check', 'entity': {'id': '77', 'type': 'test'}}
+
+    assert task.notify({'ts': 10, 'value': 1}, req, alerts) == [1, 2]
+
+    # one round trip for the state transitions, one for the writes
+    assert pipeline.execute.call_count == 2
+    assert [c[0][2:] for c in pipeline.evalsha.call_args_list] == [
+        ('zmon:alerts:{}'.format(i), 'zmon:alerts', 'zmon:alerts:{}:entities'.format(i), 'zmon:alerts:{}:77'.format(i),
+         'zmon:notifications:{}:77'.format(i), '77', i, int(i != 3), '{}') for i in (1, 2, 3)]
+    assert not con.sadd.called and not con.get.called and not con.hgetall.called
+
+    # alert 1 keeps its start time and repeats its notification, alert 2 notifies as it changed, alert 3 ended
+    assert json.loads(pipeline.set.call_args_list[0][0][1])['start_time'] == 5
+    assert [(c[0][1]['alert_def']['id'], c[0][1]['changed']) for c in send_notification.call_args_list] == [
+        (1, False), (2, True), (3, True)]
+    pipeline.delete.assert_any_call('zmon:notifications:3:77')
+
+
+def test_send_notification_async(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+
+    con = MagicMock()
+    monkeypatch.setattr(MainTask, 'con', con)
+    MainTask.configure({'zmon.notifications.async': True})
+    dispatcher = NotificationDispatcher(retry_delay=0)
+    monkeypatch.setattr('zmon_worker_monitor.zmon_worker.tasks.main.notification_dispatcher', dispatcher)
+    task = MainTask()
+
+    sent = []
+
+    def send_slack(context, **kwargs):
+        sent.append(context['alert_def']['id'])
+        if len(sent) == 1:
+            raise requests.ConnectionError('provider is down')
+        return kwargs['repeat']
+
+    monkeypatch.setattr('zmon_worker_monitor.zmon_worker.tasks.main._build_notify_context',
+                        lambda context: {'send_slack': functools.partial(send_slack, context)})
+
+    context = {'alert_def': {'id': 1}, 'entity': {'id': '77'}}
+    writes = MagicMock()
+    task.send_notification("send_slack(channel='#alerts', repeat=60)", context, con=writes)
+    assert dispatcher.join(5)
+
+    # sent on the second attempt, the repeat time is written once it is sent
+    assert sent == [1, 1]
+    assert not writes.hset.called
+    assert con.hset.call_args[0][:2] == ('zmon:notifications:1:77', "send_slack(channel='#alerts', repeat=60)")
+    stats = dispatcher.stats()
+    assert (stats['slack.sent'], stats['slack.retried'], stats.get('slack.failed', 0)) == (1, 1, 0)
+
+    MainTask.configure({})
+
+
+def test_send_notification_async_several_calls(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+
+    con = MagicMock()
+    monkeypatch.setattr(MainTask, 'con', con)
+    MainTask.configure({'zmon.notifications.async': True})
+    dispatcher = NotificationDispatcher(retry_delay=0)
+    monkeypatch.setattr('zmon_worker_monitor.zmon_worker.tasks.main.notification_dispatcher', dispatcher)
+    task = MainTask()
+
+    send_sms = MagicMock(return_value=None)
+    send_mail = MagicMock(side_effect=requests.ConnectionError('mail server is down'))
+    monkeypatch.setattr('zmon_worker_monitor.zmon_worker.tasks.main._build_notify_context',
+                        lambda context: {'send_sms': send_sms, 'send_mail': send_mail})
+
+    task.send_notification("[send_sms('1234'), send_mail()]", {'alert_def': {'id': 1}, 'entity': {'id': '77'}})
+    assert dispatcher.join(5)
+
+    # retrying the expression would send the sms again
+    assert (send_sms.call_count, send_mail.call_count) == (1, 1)
+    assert dispatcher.stats()['other.failed'] == 1
+
+    MainTask.configure({})
+
+
+def test_send_notification_async_pending(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+    plugin_manager.collect_plugins()
+
+    con = MagicMock()
+    pipeline = con.pipeline.return_value
+    notification = 'send_slack(repeat=60)'
+    times = {notification: '0'}  # the repeat time has passed
+    con.hset.side_effect = lambda key, field, value: times.__setitem__(field, str(value))
+    stored = json.dumps({'start_time': 5, 'ts': 4, 'value': 1})
+    evaluated = [0]
+
+    def execute(**kwargs):
+        if pipeline.evalsha.call_count == evaluated[0]:
+            return []
+        evaluated[0] = pipeline.evalsha.call_count
+        return [[0, 0, 1, stored, [v for item in times.items() for v in item]]]
+
+    pipeline.execute.side_effect = execute
+    monkeypatch.setattr(MainTask, 'con', con)
+    monkeypatch.setattr(MainTask, '_evaluate_downtimes', lambda self, x, y: [])
+    MainTask.configure({'zmon.notifications.async': True})
+    dispatcher = NotificationDispatcher(retry_delay=0)
+    monkeypatch.setattr('zmon_worker_monitor.zmon_worker.tasks.main.notification_dispatcher', dispatcher)
+    task = MainTask()
+    monkeypatch.setattr(task, 'send_metrics', MagicMock())
+
+    release = threading.Event()
+    sent = []
+
+    def send_slack(context, **kwargs):
+        release.wait(5)
+        sent.append(context['entity']['id'])
+        return kwargs['repeat']
+
+    monkeypatch.setattr('zmon_worker_monitor.zmon_worker.tasks.main._build_notify_context',
+                        lambda context: {'send_slack': functools.partial(send_slack, context)})
+
+    alerts = [{'id': 1, 'check_id': 123, 'condition': '>0', 'notifications': [notification]}]
+    req = {'check_id': 123, 'check_name': 'My Check', 'entity': {'id': '77', 'type': 'test'}}
+    task.notify({'ts': 10, 'value': 1}, req, alerts)
+    # the next run of the check while the notification is still pending does not queue it again
+    task.notify({'ts': 70, 'value': 1}, req, alerts)
+    release.set()
+    assert dispatcher.join(5)
+
+    assert sent == ['77']
+    assert float(times[notification]) - time.time() > 50
+    assert dispatcher.stats()['slack.queued'] == 1
+
+    MainTask.configure({})
+
+
+def test_notify_steady_ok_without_writes(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+    plugin_manager.collect_plugins()
+
+    con = MagicMock()
+    pipeline = con.pipeline.return_value
+    pipeline.execute.side_effect = lambda **kwargs: [[0, 0, 0, None, []]] if pipeline.execute.call_count == 1 else []
+    monkeypatch.setattr(MainTask, 'con', con)
+    monkeypatch.setattr('zmon_worker_monitor.zmon_worker.common.utils._registered_scripts', {})
+    monkeypatch.setattr(MainTask, '_evaluate_downtimes', lambda self, x, y: [])
+    MainTask.configure({})
+    task = MainTask()
+    monkeypatch.setattr(task, 'send_metrics', MagicMock())
+
+    req = {'check_id': 123, 'check_name': 'My Check', 'entity': {'id': '77', 'type': 'test'}}
+    assert task.notify({'ts': 10, 'value': 0}, req, [{'id': 1, 'check_id': 123, 'condition': '>0'}]) == []
+
+    # entity was not in alert: no stored alert or repeat times to delete
+    assert not pipeline.delete.called and not pipeline.set.called
+    assert 'HGET' in con.register_script.call_args[0][0]
+    assert pipeline.evalsha.call_args[0][0] == con.register_script.return_value.sha
+
+
+def test_notify_scheduled_time_drops_cached_encoding(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+    plugin_manager.collect_plugins()
+
+    con = MagicMock()
+    pipeline = con.pipeline.return_value
+    pipeline.execute.side_effect = lambda **kwargs: [[0, 0, 0, None, []]] if pipeline.execute.call_count == 1 else []
+    poster = MagicMock()
+    monkeypatch.setattr(MainTask, 'con', con)
+    monkeypatch.setattr(MainTask, '_dataservice_poster', poster)
+    monkeypatch.setattr(MainTask, '_evaluate_downtimes', lambda self, x, y: [])
+    MainTask.configure({})
+    task = MainTask()
+    monkeypatch.setattr(task, 'send_metrics', MagicMock())
+
+    val = CheckResult(ts=10, value={'load': 0, '_use_scheduled_time': True})
+    assert '_use_scheduled_time' in val.json
+    req = {'check_id': 123, 'check_name': 'My Check', 'interval': 60, 'schedule_time': 5.5,
+           'entity': {'id': '77', 'type': 'test'}}
+    task.notify(val, req, [{'id': 1, 'check_id': 123, 'condition': '>0'}])
+
+    sent = poster.enqueue.call_args[0][0]['check_result']
+    assert sent is val and json.loads(val.json) == {'ts': 5, 'value': {'load': 0}}
+
+
 def test_send_to_dataservice(monkeypatch):
     check_results = [{'check_id': 123, 'ts': 10, 'value': 'CHECK-VAL'}]
     expected = {'account': 'myacc', 'team': 'myteam', 'region': 'eu-west-1', 'results': check_results}
@@ -343,3 +814,297 @@ def test_main_task_sampling_rate(monkeypatch, sampling_config, check_id, is_aler
 
     # We give some margin of error due to probabilistic non-uniform sampling
     assert sampled >= 5 and sampled <= 20
+
+
+@pytest.mark.parametrize('shedding_lag,check_id,interval,lag,rand,is_shed', (
+    (0, 11, 60, 600, 0.99, False),  # shedding disabled
+    (60, 11, 60, 30, 0.99, False),  # no lag
+    (60, 11, 60, 240, 0.5, True),  # kept with probability 60 / 240
+    (60, 11, 60, 240, 0.2, False),
+    (60, 11, 300, 240, 0.99, False),  # long interval check
+    (60, 13, 60, 240, 0.99, False),  # critical check
+))
+def test_main_task_load_shedding(monkeypatch, shedding_lag, check_id, interval, lag, rand, is_shed):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+
+    monkeypatch.setattr('random.random', lambda: rand)
+    monkeypatch.setattr(MainTask, '_counter', Counter())
+    monkeypatch.setattr(MainTask, '_gauges', {})
+
+    MainTask.configure({'zmon.shedding.lag': shedding_lag})
+    task = MainTask()
+
+    assert task.is_shed({'critical_checks': ['13']}, check_id, interval, time.time() - lag, MagicMock()) is is_shed
+
+    assert task._gauges['tasks.lag.max'] >= lag
+    if shedding_lag and lag > shedding_lag and interval < 300 and check_id != 13:
+        assert task._counter['shedding.skipped' if is_shed else 'shedding.kept'] == 1
+    else:
+        assert not task._counter
+
+
+def test_check_and_notify_batch(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+
+    con = MagicMock()
+    monkeypatch.setattr(MainTask, 'con', con)
+    MainTask.configure({})
+    task = MainTask()
+
+    def get_check_result(req):
+        if req['entity']['id'] == 'e2':
+            raise CheckError('no data')
+        return {'ts': 10, 'value': req['entity']['id']}
+
+    monkeypatch.setattr(task, '_get_check_result_internal', get_check_result)
+    monkeypatch.setattr(task, 'send_metrics', MagicMock())
+    notify = MagicMock(side_effect=lambda *args, **kwargs: con.pipeline.return_value.execute.assert_called_once_with())
+    monkeypatch.setattr(task, 'notify', notify)
+
+    alerts = [{'id': 1}, {'id': 2}]
+    req = {'check_id': 123, 'interval': 60, 'command': 'x'}
+    entities = [{'entity': {'id': 'e1'}}, {'entity': {'id': 'e2'}, 'alert_ids': [2]}, {'entity': {'id': 'e3'}}]
+    task.check_and_notify_batch(req, entities, alerts, task_context={'delivery_info': {}})
+
+    # results of all entities go in one pipeline, sent before any alert is evaluated
+    assert con.pipeline.return_value.lpush.call_count == 3
+    assert not con.lpush.called
+
+    assert [(args[1]['entity']['id'], args[2], kwargs.get('force_alert', False))
+            for args, kwargs in notify.call_args_list] == [('e1', alerts, False), ('e2', [{'id': 2}], True),
+                                                           ('e3', alerts, False)]
+    assert notify.call_args_list[0][0][0]['value'] == 'e1'
+    assert notify.call_args_list[1][0][0]['value'] == 'no data'
+    assert 'entity' not in req
+
+
+def test_check_and_notify_batch_time_limit(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+
+    con = MagicMock()
+    monkeypatch.setattr(MainTask, 'con', con)
+    monkeypatch.setattr(MainTask, '_counter', Counter())
+    MainTask.configure({})
+    task = MainTask()
+
+    now = [1000.0]
+    monkeypatch.setattr('time.time', lambda: now[0])
+    deadlines = []
+
+    def get_check_result(req):
+        deadlines.append(task.deadline.seconds)
+        if req['entity']['id'] == 'e1':
+            now[0] += 4
+            return {'ts': 10, 'value': 1}
+        # the budget of the task expires while e2 is checked
+        now[0] += 10
+        task.deadline.timeout()
+
+    monkeypatch.setattr(task, '_get_check_result_internal', get_check_result)
+    monkeypatch.setattr(task, 'send_metrics', MagicMock())
+    notify = MagicMock()
+    monkeypatch.setattr(task, 'notify', notify)
+
+    req = {'check_id': 123, 'interval': 60, 'command': 'x'}
+    entities = [{'entity': {'id': 'e{}'.format(i)}} for i in range(1, 5)]
+    task.check_and_notify_batch(req, entities, [{'id': 1}],
+                                task_context={'delivery_info': {}, 'task_properties': {'timelimit': [20, 10]}})
+
+    # e2 gets what is left of the budget, it and the entities after it are skipped, not alerted as failed
+    assert deadlines == [10, 6]
+    assert [args[1]['entity']['id'] for args, kwargs in notify.call_args_list] == ['e1']
+    assert not notify.call_args_list[0][1].get('force_alert')
+    assert con.pipeline.return_value.lpush.call_count == 1
+    assert task._counter['batch.skipped_entities'] == 3
+
+
+def test_check_and_notify_batch_entity_time_limit(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+
+    con = MagicMock()
+    monkeypatch.setattr(MainTask, 'con', con)
+    MainTask.configure({})
+    task = MainTask()
+
+    now = [1000.0]
+    monkeypatch.setattr('time.time', lambda: now[0])
+    deadlines = []
+
+    def get_check_result(req):
+        deadlines.append(task.deadline.seconds)
+        if req['entity']['id'] == 'e1':
+            # hangs: fails once its own budget is gone, the task has time left for the others
+            now[0] += 6
+            task.deadline.timeout()
+        elif req['entity']['id'] == 'e3':
+            # fails for another reason after the task ran out of time: stored and alerted
+            now[0] += 12
+            raise CheckError('no data')
+        return {'ts': 10, 'value': 1}
+
+    monkeypatch.setattr(task, '_get_check_result_internal', get_check_result)
+    monkeypatch.setattr(task, 'send_metrics', MagicMock())
+    notify = MagicMock()
+    monkeypatch.setattr(task, 'notify', notify)
+
+    req = {'check_id': 123, 'interval': 5, 'command': 'x'}
+    entities = [{'entity': {'id': 'e{}'.format(i)}} for i in range(1, 5)]
+    task.check_and_notify_batch(req, entities, [{'id': 1}],
+                                task_context={'delivery_info': {}, 'task_properties': {'timelimit': [30, 15]}})
+
+    assert deadlines == [5, 5, 5]
+    assert [(args[1]['entity']['id'], kwargs.get('force_alert', False))
+            for args, kwargs in notify.call_args_list] == [('e1', True), ('e2', False), ('e3', True)]
+    assert con.pipeline.return_value.lpush.call_count == 3
+
+
+def test_check_and_notify_batch_chunks(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+
+    con = MagicMock()
+    monkeypatch.setattr(MainTask, 'con', con)
+    monkeypatch.setattr('zmon_worker_monitor.zmon_worker.tasks.main.CHECK_BATCH_CHUNK', 2)
+    MainTask.configure({})
+    task = MainTask()
+
+    monkeypatch.setattr(task, '_get_check_result_internal', lambda req: {'ts': 10, 'value': req['entity']['id']})
+    monkeypatch.setattr(task, 'send_metrics', MagicMock())
+    executed = []
+    con.pipeline.return_value.execute.side_effect = lambda: executed.append(notify.call_count)
+    notify = MagicMock()
+    monkeypatch.setattr(task, 'notify', notify)
+
+    entities = [{'entity': {'id': 'e{}'.format(i)}} for i in range(5)]
+    task.check_and_notify_batch({'check_id': 123, 'interval': 60, 'command': 'x'}, entities, [{'id': 1}],
+                                task_context={'delivery_info': {}})
+
+    # the results of every chunk are sent before its alerts are evaluated
+    assert executed == [0, 2, 4]
+    assert notify.call_count == 5
+
+
+def test_build_check_context_lazy(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+
+    MainTask.configure({})
+    task = MainTask()
+
+    http_factory, kairosdb_factory = MagicMock(), MagicMock()
+    monkeypatch.setattr(MainTask, '_function_factories', {'http': http_factory, 'kairosdb': kairosdb_factory})
+    monkeypatch.setattr(task, 'get_redis_host', MagicMock(return_value='localhost'))
+    monkeypatch.setattr(task, 'get_redis_port', MagicMock(return_value=6379))
+
+    req = {'check_id': 123, 'entity': {'id': 'myent', 'host': 'myhost'}, 'interval': 60}
+
+    ctx = task._build_check_context(req, names={'entity', 'len'})
+    assert 'http' not in ctx and 'kairosdb' not in ctx
+    assert not task.get_redis_host.called
+
+    ctx = task._build_check_context(req, names={'http', 'json'})
+    assert ctx['http'] is http_factory.create.return_value
+    assert 'kairosdb' not in ctx
+    assert http_factory.create.call_args[0][0]['host'] == 'myhost'
+
+    ctx = task._build_check_context(req)
+    assert 'http' in ctx and 'kairosdb' in ctx
+
+
+def test_cached_plugin_calls(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+
+    MainTask.configure({'zmon.call_cache.max_ttl': '60'})
+    task = MainTask()
+    task.task_context = {'delivery_info': {}}
+
+    entities = MagicMock()
+    entities.return_value.search_all.side_effect = lambda q: [{'id': 'lb-1', 'type': q['type']}]
+    factory = MagicMock()
+    factory.create.return_value = propartial(entities, infrastructure_account='aws:1')
+    monkeypatch.setattr(MainTask, '_function_factories', {'entities': factory})
+    monkeypatch.setattr(task, 'get_redis_host', MagicMock(return_value='localhost'))
+    monkeypatch.setattr(task, 'get_redis_port', MagicMock(return_value=6379))
+    hits = call_cache.stats()['hits']
+
+    cmd = "len(cached(ttl=30).entities().search_all({'type': 'elb'}))"
+    for entity_id in ('e1', 'e2', 'e3'):
+        req = {'check_id': 123, 'entity': {'id': entity_id}, 'interval': 60, 'command': cmd}
+        assert task._get_check_result_internal(req)['value'] == 1
+
+    assert entities.return_value.search_all.call_count == 1
+    assert call_cache.max_ttl == 60
+    assert call_cache.stats()['hits'] - hits == 2
+
+
+def test_cached_calls_per_entity_binding(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+
+    MainTask.configure({})
+    task = MainTask()
+    task.task_context = {'delivery_info': {}}
+    monkeypatch.setattr(task, 'get_redis_host', MagicMock(return_value='localhost'))
+    monkeypatch.setattr(task, 'get_redis_port', MagicMock(return_value=6379))
+
+    class Http(object):
+        def __init__(self, url, base_url=None, deadline=None):
+            self.url = base_url + url
+
+        def text(self):
+            return 'GET ' + self.url
+
+    # like the http plugin: entity URL and the deadline of the task are bound by the factory
+    factory = MagicMock()
+    factory.create.side_effect = lambda ctx: propartial(Http, base_url=ctx['entity_url'], deadline=object(),
+                                                        __protected=['deadline'])
+    monkeypatch.setattr(MainTask, '_function_factories', {'http': factory})
+    monkeypatch.setattr(call_cache, 'get', MagicMock(side_effect=CallCache().get))
+
+    cmd = "cached(ttl=30).http('/health').text()"
+    results = []
+    for entity_id, check_id in (('entity-a', 1), ('entity-b', 1), ('entity-a', 1), ('entity-a', 2)):
+        req = {'check_id': check_id, 'entity': {'id': entity_id, 'url': 'http://{}'.format(entity_id)},
+               'interval': 60, 'command': cmd}
+        results.append(task._get_check_result_internal(req)['value'])
+
+    assert results == ['GET http://entity-a/health', 'GET http://entity-b/health', 'GET http://entity-a/health',
+                       'GET http://entity-a/health']
+    # same entity URL and check share the call, another check does not
+    keys = [c[0][0] for c in call_cache.get.call_args_list]
+    assert keys[0] == keys[2] and len(set(keys)) == 3
+
+
+def test_check_deadline(monkeypatch):
+    reload(plugin_manager)
+    plugin_manager.init_plugin_manager()  # init plugin manager
+
+    MainTask.configure({})
+    task = MainTask()
+    task.task_context = {'delivery_info': {}}
+
+    req = {'check_id': 123, 'entity': {'id': 'myent'}, 'interval': 60, 'command': 'slow()'}
+
+    # soft time limit of the task, or the check interval
+    assert task.start_deadline(req, {'task_properties': {'timelimit': [90, 30]}}).seconds == 30
+    assert task.start_deadline(req, None).seconds == 60
+
+    def slow():
+        raise HttpError('timeout', 'http://example.org')
+
+    monkeypatch.setattr(task, '_build_check_context', lambda req, names=None: {'slow': slow})
+
+    # plugin errors still surface as usual while there is budget left
+    with pytest.raises(Exception) as ex:
+        task._get_check_result_internal(req)
+    assert 'HTTP request failed' in str(ex.value)
+
+    task._task_local.deadline = Deadline(30, start=time.time() - 31)
+    with pytest.raises(TimeLimitExceeded) as ex:
+        task._get_check_result_internal(req)
+    assert 'Soft time limit of 30s exceeded' == str(ex.value)
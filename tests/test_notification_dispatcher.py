@@ -0,0 +1,79 @@
+import threading
+import time
+
+from mock import MagicMock
+
+from zmon_worker_monitor.zmon_worker.errors import NotificationError
+from zmon_worker_monitor.zmon_worker.notifications.dispatcher import NotificationDispatcher
+
+
+def test_provider_concurrency():
+    dispatcher = NotificationDispatcher(concurrency={'mail': 1}, default_concurrency=3)
+    release = threading.Event()
+    running = {'mail': 0, 'slack': 0}
+    most = {'mail': 0, 'slack': 0}
+    lock = threading.Lock()
+
+    def send(provider):
+        with lock:
+            running[provider] += 1
+            most[provider] = max(most[provider], running[provider])
+        release.wait(5)
+        with lock:
+            running[provider] -= 1
+
+    for i in range(6):
+        for provider in ('mail', 'slack'):
+            assert dispatcher.submit(provider, send, (provider,))
+    deadline = time.time() + 5
+    while running != {'mail': 1, 'slack': 3} and time.time() < deadline:
+        time.sleep(0.01)
+    release.set()
+
+    assert dispatcher.join(5)
+    assert most == {'mail': 1, 'slack': 3}
+
+
+def test_queue_full_sends_right_away():
+    dispatcher = NotificationDispatcher(queue_size=1, concurrency={'sms': 1})
+    release = threading.Event()
+    blocked = threading.Event()
+
+    def block():
+        blocked.set()
+        release.wait(5)
+
+    assert dispatcher.submit('sms', block)
+    assert blocked.wait(5)
+    assert dispatcher.submit('sms', MagicMock())  # waits in the queue
+
+    send = MagicMock()
+    assert not dispatcher.submit('sms', send, ('now',))
+    send.assert_called_once_with('now')
+
+    release.set()
+    assert dispatcher.join(5)
+    stats = dispatcher.stats()
+    assert (stats['sms.queued'], stats['sms.overflow'], stats['sms.sent']) == (2, 1, 3)
+
+
+def test_retries():
+    dispatcher = NotificationDispatcher(retries=2, retry_delay=0)
+    failing = MagicMock(side_effect=Exception('down'))
+    invalid = MagicMock(side_effect=NotificationError('API key is required!'))
+
+    dispatcher.submit('opsgenie', failing)
+    dispatcher.submit('pagerduty', invalid)
+    assert dispatcher.join(5)
+
+    # invalid notifications are not retried
+    assert failing.call_count == 3
+    assert invalid.call_count == 1
+    stats = dispatcher.stats()
+    assert (stats['opsgenie.retried'], stats['opsgenie.failed'], stats['pagerduty.failed']) == (2, 1, 1)
+    assert 'pagerduty.retried' not in stats
+    assert dispatcher.stats()['opsgenie.queue'] == 0
+
+    dispatcher.submit('opsgenie', failing, retries=0)
+    assert dispatcher.join(5)
+    assert failing.call_count == 4
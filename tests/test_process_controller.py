@@ -255,7 +255,8 @@ def test_process_plus_basic(monkeypatch):
 
     # Check persisting object to dict works
     exported_fields = ('target', 'args', 'kwargs', 'flags', 'tags', 'stats', 'name', 'pid', 'previous_proc',
-                       'ping_status', 'actions_last_5', 'errors_last_5', 'task_counts', 'event_counts')
+                       'ping_status', 'actions_last_5', 'errors_last_5', 'task_counts', 'queue_counts',
+                       'event_counts')
 
     assert set(exported_fields) == set(NonSpawningProcessPlus._pack_fields)  # fails if _pack_fields was modified
 
@@ -391,6 +392,7 @@ def test_process_plus_pings(monkeypatch):
         'tasks_done': 1,
         'percent_idle': 95.0,
         'task_duration': 3.14,
+        'tasks_by_queue': {},
     }
     pp.add_ping(ping_worker_ok)
 
@@ -403,6 +405,7 @@ def test_process_plus_pings(monkeypatch):
         'tasks_done': 0,
         'percent_idle': 99.9,
         'task_duration': 3.14,
+        'tasks_by_queue': {},
     }
     pp.stored_pings = [ping_worker_idle]
 
@@ -415,6 +418,7 @@ def test_process_plus_pings(monkeypatch):
         'tasks_done': 0,
         'percent_idle': 0.1,
         'task_duration': 3.14,
+        'tasks_by_queue': {},
     }
     pp.stored_pings = [ping_worker_idle]
 
@@ -439,6 +443,7 @@ def test_process_plus_pings(monkeypatch):
         'tasks_done': 5,
         'percent_idle': 15.7,
         'task_duration': 3.14,
+        'tasks_by_queue': {},
     }
 
     ping_data2 = {
@@ -447,6 +452,7 @@ def test_process_plus_pings(monkeypatch):
         'tasks_done': 1,
         'percent_idle': 91.2,
         'task_duration': 3.14,
+        'tasks_by_queue': {},
     }
 
     # lets add 2 pings
@@ -576,6 +582,7 @@ def test_process_plus_ping_aggregations(monkeypatch):
             'tasks_done': 1,
             'percent_idle': 85.0,
             'task_duration': 3.14,
+            'tasks_by_queue': {'zmon:queue:default': 1},
         }
         for i in range(num_pings)
     ]
@@ -623,6 +630,13 @@ def test_process_plus_ping_aggregations(monkeypatch):
 
     assert compare_float_values(pp.aggregate_pings(interval=interval), aggregated_results_last_ping)
 
+    # per queue throughput is aggregated over the same pings
+    queue_agg = pp.aggregate_queue_pings(interval=interval)
+    assert queue_agg.keys() == ['zmon:queue:default']
+    assert queue_agg['zmon:queue:default']['tasks_done'] == 1
+    assert abs(queue_agg['zmon:queue:default']['tasks_per_min'] - tasks_per_sec * 60) < 0.01
+    assert pp.aggregate_queue_pings()['zmon:queue:default']['tasks_done'] == num_pings
+
     # lets now check that the dict representation export the same ping aggregation results under task_counts key
     dict_repr = pp.to_dict()
 
@@ -913,3 +927,126 @@ def test_process_group_health(monkeypatch):
     pg.terminate_all()
 
     assert len(pg) == pg.total_processes() == 0
+
+
+def test_process_controller_shared_values():
+    pc = process_controller.ProcessController(start_action_loop=False)
+
+    assert pc.get_shared_value('sampling_config') == {'version': 0}
+
+    fetched = {'default_sampling': 50}
+    pc.add_shared_value('sampling_config', lambda: fetched, refresh_sec=60)
+
+    t_end = time.time() + 5
+    while pc.get_shared_value('sampling_config')['version'] == 0 and time.time() < t_end:
+        time.sleep(0.05)
+
+    assert pc.get_shared_value('sampling_config') == {'version': 1, 'value': fetched}
+    # a worker that is up to date gets no value back
+    assert pc.get_shared_value('sampling_config', 1) == {'version': 1}
+
+    # same value does not bump the version
+    assert pc.set_shared_value('sampling_config', {'default_sampling': 50}) == 1
+    assert pc.set_shared_value('sampling_config', {'default_sampling': 10}) == 2
+    assert pc.get_shared_value('sampling_config', 1) == {'version': 2, 'value': {'default_sampling': 10}}
+
+
+def test_process_group_autoscale(monkeypatch):
+
+    # Deactivate cache. Pool load is computed from aggregate_pings() which has a short cache
+    monkeypatch.setattr('zmon_worker_monitor.process_controller.SimpleMethodCacheInMemory.shortcut_cache', True)
+    monkeypatch.setattr(process_controller.ProcessGroup, 'autoscale_kill_wait', 0)
+
+    NonSpawningProcessPlus.reset_mock_counter()
+
+    pg = process_controller.ProcessGroup(group_name='main', process_plus_impl=NonSpawningProcessPlus)
+
+    backlog = [0]
+    pg.add_scaling_pool('zmon:queue:default', 2, 8, lambda: backlog[0], target=target,
+                        kwargs={'queue': 'zmon:queue:default'}, flags=MONITOR_RESTART | MONITOR_PING)
+    pg.spawn_process(target=target, flags=MONITOR_RESTART)  # not part of any pool
+
+    with pytest.raises(ValueError):
+        pg.add_scaling_pool('zmon:queue:default', 1, 1, lambda: 0, target=target)
+
+    assert pg.get_scaling_pools() == {'zmon:queue:default': {'min': 2, 'max': 8, 'running': 2}}
+
+    def ping_all(percent_idle, tasks_done=10, task_duration=5.0):
+        for proc in pg.pool_processes('zmon:queue:default'):
+            proc.stored_pings = [{'timestamp': time.time(), 'timedelta': 30.0, 'tasks_done': tasks_done,
+                                  'percent_idle': percent_idle, 'task_duration': task_duration,
+                                  'tasks_by_queue': {}}]
+
+    with pytest.raises(ValueError):
+        pg.set_action_policy('random')
+
+    pg.set_action_policy(pg.ACTION_POLICY_AUTOSCALE)
+
+    # busy pool with a backlog grows up to max
+    backlog[0] = 1000
+    ping_all(percent_idle=0.0)
+    pg.autoscale_pool('zmon:queue:default')
+    assert len(pg.pool_processes('zmon:queue:default')) == 8
+    assert len(pg) == 9
+
+    # idle pool with empty queue does not shrink before autoscale_down_wait
+    backlog[0] = 0
+    ping_all(percent_idle=90.0)
+    pg.autoscale_pool('zmon:queue:default')
+    assert len(pg.pool_processes('zmon:queue:default')) == 8
+
+    # nor while a single task is waiting
+    pg._scaling_pools['zmon:queue:default']['t_last_resize'] = 0
+    backlog[0] = 1
+    pg.autoscale_pool('zmon:queue:default')
+    assert len(pg.pool_processes('zmon:queue:default')) == 8
+
+    # then it retires half of the spare processes at a time, youngest first
+    backlog[0] = 0
+    pg.autoscale_pool('zmon:queue:default')
+    assert len(pg.pool_processes('zmon:queue:default')) == 5
+    assert 'NonSpawningProcessPlus-1' in pg and len(pg.dead_group) == 3
+
+    # new bounds are applied right away
+    pg.set_scaling_bounds('zmon:queue:default', 1, 3)
+    pg.autoscale_pool('zmon:queue:default')
+    assert pg.get_scaling_pools() == {'zmon:queue:default': {'min': 1, 'max': 3, 'running': 3}}
+
+    with pytest.raises(ValueError):
+        pg.set_scaling_bounds('zmon:queue:default', 4, 2)
+
+    pg.terminate_all()
+
+
+def test_process_group_top_checks(monkeypatch):
+
+    monkeypatch.setattr('zmon_worker_monitor.process_controller.SimpleMethodCacheInMemory.shortcut_cache', True)
+
+    NonSpawningProcessPlus.reset_mock_counter()
+
+    pg = process_controller.ProcessGroup(group_name='main', process_plus_impl=NonSpawningProcessPlus)
+    procs = [pg[pg.spawn_process(target=target, flags=MONITOR_PING)] for _ in range(2)]
+
+    def ping(check_costs):
+        return {'timestamp': time.time(), 'timedelta': 30.0, 'tasks_done': 3, 'percent_idle': 10.0,
+                'task_duration': 1.5, 'tasks_by_queue': {}, 'check_costs': check_costs}
+
+    costs = {'runs': 1.0, 'wall_time': 0.5, 'cpu_time': 0.1, 'result_bytes': 100.0, 'redis_calls': 4.0,
+             'http_bytes': 2048.0}
+    pg.add_ping(procs[0].pid, ping({'11': costs, '12': dict(costs, cpu_time=0.4)}))
+    pg.add_ping(procs[1].pid, ping({'11': costs}))
+
+    # costs are not kept with every stored ping
+    assert 'check_costs' not in procs[0].get_pings()[0]
+
+    top = pg.top_checks(interval=300)
+    assert [c['check_id'] for c in top] == [12, 11]
+    assert top[1] == {'check_id': 11, 'runs': 2, 'wall_time': 1.0, 'cpu_time': 0.2, 'result_bytes': 200,
+                      'redis_calls': 8, 'http_bytes': 4096}
+
+    assert [c['check_id'] for c in pg.top_checks(interval=300, limit=1, sort_by='runs')] == [11]
+
+    with pytest.raises(ValueError):
+        pg.top_checks(interval=300, sort_by='memory')
+
+    pg.terminate_all()
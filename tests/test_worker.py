@@ -81,15 +81,15 @@ def execute_check(tmpdir, monkeypatch, check_command, expected_strings):
 
 def test_check_failure(tmpdir, monkeypatch):
     execute_check(tmpdir, monkeypatch, 'invalid_python_code',
-                  ['"value": "Traceback (most recent', 'name \'invalid_python_code\' is not defined', '"exc": 1'])
+                  ['"value":"Traceback (most recent', 'name \'invalid_python_code\' is not defined', '"exc":1'])
 
 
 def test_check_success(tmpdir, monkeypatch):
-    execute_check(tmpdir, monkeypatch, '"test-result"', ['"value": "test-result"'])
+    execute_check(tmpdir, monkeypatch, '"test-result"', ['"value":"test-result"'])
 
 
 def test_check_http(tmpdir, monkeypatch):
     response = MagicMock()
     response.json.return_value = {'foo': 'bar'}
     monkeypatch.setattr('zmon_worker_monitor.builtins.plugins.http.requests.get', lambda *args, **kwargs: response)
-    execute_check(tmpdir, monkeypatch, 'http("https://example.org/").json()', ['"value": {"foo": "bar"}'])
+    execute_check(tmpdir, monkeypatch, 'http("https://example.org/").json()', ['"value":{"foo":"bar"}'])
@@ -0,0 +1,272 @@
+import collections
+import itertools
+import threading
+import time
+
+from mock import MagicMock
+
+from zmon_worker_monitor import coalesce, workflow
+from zmon_worker_monitor.envelope import decode_task, encode_task
+
+
+def test_pop_tasks_idle():
+    r_conn = MagicMock()
+    r_conn.blpop.return_value = None
+
+    assert workflow.pop_tasks(r_conn, 'q', prefetch=10, timeout=1) == []
+
+    r_conn.blpop.assert_called_once_with('q', 1)
+    r_conn.pipeline.assert_not_called()
+
+
+def test_pop_tasks_no_prefetch():
+    r_conn = MagicMock()
+    r_conn.blpop.return_value = ('q', 'm1')
+
+    assert workflow.pop_tasks(r_conn, 'q', prefetch=1) == [('q', 'm1')]
+
+    r_conn.pipeline.assert_not_called()
+
+
+def test_pop_tasks_prefetch():
+    r_conn = MagicMock()
+    r_conn.blpop.return_value = ('q', 'm1')
+    pipeline = r_conn.pipeline.return_value
+    pipeline.execute.return_value = [['m2', 'm3'], True]
+
+    assert workflow.pop_tasks(r_conn, 'q', prefetch=10) == [('q', 'm1'), ('q', 'm2'), ('q', 'm3')]
+
+    pipeline.lrange.assert_called_once_with('q', 0, 8)
+    pipeline.ltrim.assert_called_once_with('q', 9, -1)
+
+
+def test_requeue_tasks():
+    r_conn = MagicMock()
+
+    assert workflow.requeue_tasks(r_conn, [('q1', 'm1'), ('q1', 'm2'), ('q2', 'm3')]) == 3
+
+    r_conn.lpush.assert_any_call('q1', 'm2', 'm1')
+    r_conn.lpush.assert_any_call('q2', 'm3')
+
+
+def test_flow_drains_buffer_on_shutdown(monkeypatch):
+    r_conn = MagicMock()
+    r_conn.blpop.return_value = ('q', '{"m": 1}')
+    r_conn.pipeline.return_value.execute.return_value = [['{"m": 2}', '{"m": 3}'], True]
+
+    conn_handler = MagicMock()
+    conn_handler.__enter__.return_value = conn_handler
+    conn_handler.__exit__.return_value = False
+    conn_handler.get_healthy_conn.return_value = r_conn
+    conn_handler.get_conn.return_value = r_conn
+
+    handler_cls = MagicMock()
+    handler_cls.get_instance.return_value = conn_handler
+
+    def process_message(*args, **kwargs):
+        # worker gets SIGTERM while running the first task
+        raise SystemExit(0)
+
+    monkeypatch.setattr(workflow, 'get_config', lambda: {})
+    monkeypatch.setattr(workflow, 'configure_tasks', MagicMock())
+    monkeypatch.setattr(workflow, 'RedisConnHandler', handler_cls)
+    monkeypatch.setattr(workflow, 'FlowControlReactor', MagicMock())
+    monkeypatch.setattr(workflow, 'decode_task', MagicMock())
+    monkeypatch.setattr(workflow, 'process_message', process_message)
+
+    try:
+        workflow.flow_simple_queue_processor(queue='q', prefetch=3)
+    except SystemExit:
+        pass
+
+    r_conn.lpush.assert_called_once_with('q', '{"m": 3}', '{"m": 2}')
+
+
+def test_threaded_executor_runs_tasks_concurrently():
+    executor = workflow.get_task_executor(3)
+    started = [threading.Event() for _ in range(3)]
+    release = threading.Event()
+    done = []
+
+    def task(i):
+        started[i].set()
+        release.wait(5)
+        done.append(i)
+
+    for i in range(3):
+        executor.submit(task, i)
+
+    # all three tasks must be running at the same time
+    assert all(ev.wait(5) for ev in started)
+    assert done == []
+
+    release.set()
+    executor.submit(lambda: done.append(3))  # blocks until a slot is free
+    executor.shutdown()
+    for th in executor._threads:
+        th.join(5)
+
+    assert sorted(done) == [0, 1, 2, 3]
+
+
+def test_reactor_tracks_tasks_by_id(monkeypatch):
+    monkeypatch.setattr(workflow, 'get_rpc_client', MagicMock())
+    monkeypatch.setattr(workflow.FlowControlReactor, '_instance', None)
+    reactor = workflow.FlowControlReactor.get_instance()
+
+    with reactor.enter_task_context('check_and_notify', 90, 60, queue='q1'):
+        with reactor.enter_task_context('check_and_notify', 90, 60, queue='q2'):
+            assert len(reactor._current_tasks) == 2
+        assert len(reactor._current_tasks) == 1
+
+    assert reactor._current_tasks == {}
+    assert reactor._ping_data['tasks_done'] == 2
+    assert reactor._ping_data['tasks_by_queue'] == {'q1': 1, 'q2': 1}
+
+
+def test_order_queues_weighted():
+    queues = workflow.parse_queues('zmon:queue:default@3|zmon:queue:internal@1')
+
+    first = collections.Counter(workflow.order_queues(queues)[0] for _ in range(4000))
+
+    assert 2700 < first['zmon:queue:default'] < 3300
+    assert workflow.order_queues(queues, policy='priority') == ['zmon:queue:default', 'zmon:queue:internal']
+
+
+def test_purge_expired_tasks():
+    expired = [encode_task('check_and_notify', [{'check_id': i}], {}, expires=time.time() - 10) for i in range(5)]
+    fresh = [encode_task('check_and_notify', [{'check_id': i}], {}, expires=time.time() + 60) for i in range(3)]
+
+    r_conn = MagicMock()
+    # first batch is fully expired, second one mixed, third one has no expired task
+    r_conn.lrange.side_effect = [expired[:3], expired[3:] + fresh[:1], fresh[1:]]
+    r_conn.eval.side_effect = lambda script, numkeys, key, *msgs: len(msgs)
+
+    assert workflow.purge_expired_tasks(r_conn, 'q', 3) == 5
+
+    assert r_conn.lrange.call_args_list[1][0] == ('q', 0, 2)
+    assert r_conn.lrange.call_args_list[2][0] == ('q', 1, 3)
+    assert r_conn.eval.call_count == 2
+
+
+def test_flow_decodes_popped_tasks_once(monkeypatch):
+    def check_task(check_id):
+        return encode_task('check_and_notify', [{'check_id': check_id, 'entity': {'id': 'e'},
+                                                 'schedule_time': time.time()}], {}, timelimit=[90, 60])
+
+    msgs = [check_task(i) for i in (1, 2, 3)]
+    r_conn = MagicMock()
+    r_conn.blpop.return_value = ('q', msgs[0])
+    r_conn.pipeline.return_value.execute.return_value = [msgs[1:], True]
+
+    conn_handler = MagicMock()
+    conn_handler.__enter__.return_value = conn_handler
+    conn_handler.__exit__.return_value = False
+    conn_handler.get_healthy_conn.return_value = r_conn
+    conn_handler.get_conn.return_value = r_conn
+
+    handler_cls = MagicMock()
+    handler_cls.get_instance.return_value = conn_handler
+
+    def process_message(*args, **kwargs):
+        raise SystemExit(0)
+
+    decode = MagicMock(side_effect=decode_task)
+    monkeypatch.setattr(workflow, 'get_config', lambda: {'zmon.coalesce.scan': 10})
+    monkeypatch.setattr(workflow, 'configure_tasks', MagicMock())
+    monkeypatch.setattr(workflow, 'RedisConnHandler', handler_cls)
+    monkeypatch.setattr(workflow, 'FlowControlReactor', MagicMock())
+    monkeypatch.setattr(workflow, 'decode_task', decode)
+    monkeypatch.setattr(coalesce, 'decode_task', decode)
+    monkeypatch.setattr(workflow, 'process_message', process_message)
+
+    try:
+        workflow.flow_simple_queue_processor(queue='q', prefetch=3)
+    except SystemExit:
+        pass
+
+    # observed by the coalescer and run from the same decoded envelopes
+    assert decode.call_count == 3
+    r_conn.lpush.assert_called_once_with('q', msgs[2], msgs[1])
+
+
+def test_process_message_expired_without_body():
+    task = decode_task(encode_task('check_and_notify', [{'check_id': 1}], {}, expires=time.time() - 1,
+                                   timelimit=[90, 60]))
+    known_tasks = {'check_and_notify': MagicMock()}
+
+    assert not workflow.process_message('q', known_tasks, MagicMock(), task, MagicMock())
+
+    assert task._body is None
+    assert not known_tasks['check_and_notify'].called
+
+
+def test_reactor_refresh_shared_values(monkeypatch):
+    rpc_client = MagicMock()
+    monkeypatch.setattr(workflow, 'get_rpc_client', lambda *args: rpc_client)
+    monkeypatch.setattr(workflow.FlowControlReactor, '_instance', None)
+    reactor = workflow.FlowControlReactor.get_instance()
+
+    # the timer does not start before the first subscription
+    reactor.action_refresh_shared_values()
+    assert reactor._t_last_shared == 0
+
+    # a reactor pass just before subscribing does not delay the first fetch
+    reactor._t_last_shared = time.time()
+    fallback = MagicMock(return_value={'default_sampling': 100})
+    reactor.subscribe_shared_value('sampling_config', fallback, fallback_refresh_sec=60)
+
+    # parent has no value yet: worker fetches it by itself
+    rpc_client.get_shared_value.return_value = {'version': 0}
+    reactor.action_refresh_shared_values()
+    assert reactor.get_shared_value('sampling_config') == {'default_sampling': 100}
+    assert fallback.call_count == 1
+
+    # parent value wins as soon as it has one
+    rpc_client.get_shared_value.return_value = {'version': 3, 'value': {'default_sampling': 20}}
+    reactor._t_last_shared = 0
+    reactor.action_refresh_shared_values()
+    assert reactor.get_shared_value('sampling_config') == {'default_sampling': 20}
+    rpc_client.get_shared_value.assert_called_with('sampling_config', 0)
+
+    # up to date: value is kept, parent is asked with our version
+    rpc_client.get_shared_value.return_value = {'version': 3}
+    reactor._t_last_shared = 0
+    reactor.action_refresh_shared_values()
+    assert reactor.get_shared_value('sampling_config') == {'default_sampling': 20}
+    rpc_client.get_shared_value.assert_called_with('sampling_config', 3)
+    assert fallback.call_count == 1
+
+
+def test_execute_task_coalesced(monkeypatch):
+    def check_task(schedule_time):
+        return encode_task('check_and_notify', [{'check_id': 1, 'entity': {'id': 'e'}, 'schedule_time': schedule_time}],
+                           {}, timelimit=[90, 60])
+
+    coalescer = workflow.get_task_coalescer({'zmon.coalesce.scan': 10})
+    r_conn = MagicMock()
+    r_conn.lrange.return_value = [check_task(160.0), 'not a task']
+    assert coalescer.scan(r_conn, 'q') == 1
+    assert coalescer.scan(r_conn, 'q') == 0  # rate limited
+
+    process_message = MagicMock(return_value=True)
+    monkeypatch.setattr(workflow, 'process_message', process_message)
+    span = MagicMock()
+    coalesced_counter = itertools.count(1)
+
+    workflow._execute_task('q', {}, MagicMock(), decode_task(check_task(100.0)), span, None, itertools.count(1),
+                           coalescer, coalesced_counter)
+    assert not process_message.called
+    span.set_tag.assert_called_with(workflow.OPENTRACING_TAG_QUEUE_RESULT, 'coalesced')
+
+    workflow._execute_task('q', {}, MagicMock(), decode_task(check_task(160.0)), span, None, itertools.count(1),
+                           coalescer, coalesced_counter)
+    assert process_message.call_count == 1
+    assert next(coalesced_counter) == 2
+
+    # other tasks for the same check and entity are never coalesced
+    trial_run = encode_task('trial_run', [{'check_id': 1, 'entity': {'id': 'e'}, 'schedule_time': 100.0}], {})
+    assert decode_task(trial_run).check_id == 1
+    workflow._execute_task('q', {}, MagicMock(), decode_task(trial_run), span, None, itertools.count(1),
+                           coalescer, coalesced_counter)
+    assert process_message.call_count == 2
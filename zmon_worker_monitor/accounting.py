@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Per check resource accounting.
+
+While a check runs (see MainTask.check) its costs are collected in a thread local record, code doing I/O on behalf of
+the check adds to it with add_cost(), which does nothing outside of a check. Finished checks are summed up per check_id
+in the worker, the reactor ships the sums to the parent with every ping and the parent keeps them in time buckets to
+rank checks by cost over a window.
+"""
+
+import functools
+import resource
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import redis
+from requests.packages.urllib3.response import HTTPResponse
+
+COST_FIELDS = ('runs', 'wall_time', 'cpu_time', 'result_bytes', 'redis_calls', 'http_bytes')
+
+COST_BUCKET_SEC = 60 * 5
+COST_KEEP_SEC = 60 * 60 * 6
+
+# python 2 does not expose RUSAGE_THREAD, on linux it is 1. Elsewhere we fall back to the whole process.
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1 if sys.platform.startswith('linux') else resource.RUSAGE_SELF)
+
+_local = threading.local()
+
+_worker_costs = {}  # {check_id: {field: value}}, summed up until the reactor sends them
+_worker_costs_lock = threading.Lock()
+
+
+def thread_cpu_time():
+    usage = resource.getrusage(RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+def add_cost(field, value=1):
+    costs = getattr(_local, 'costs', None)
+    if costs is not None:
+        costs[field] += value
+
+
+@contextmanager
+def account_check(check_id):
+    """
+    Collect the costs of the check running in this thread and add them to the worker's sums.
+
+    >>> with account_check(7) as costs:
+    ...     add_cost('redis_calls', 2)
+    >>> costs['runs'], costs['redis_calls'], costs['wall_time'] >= 0
+    (1, 2, True)
+    >>> add_cost('redis_calls')  # no check running: ignored
+    >>> pop_check_costs()['7']['redis_calls']
+    2.0
+    """
+    costs = dict.fromkeys(COST_FIELDS, 0)
+    costs['runs'] = 1
+    _local.costs = costs
+    t_start, cpu_start = time.time(), thread_cpu_time()
+    try:
+        yield costs
+    finally:
+        costs['wall_time'] = time.time() - t_start
+        costs['cpu_time'] = thread_cpu_time() - cpu_start
+        _local.costs = None
+        record_check_costs(check_id, costs)
+
+
+def merge_costs(total, costs):
+    """
+    >>> merge_costs({'runs': 1, 'http_bytes': 10}, {'runs': 2, 'http_bytes': 5})['http_bytes']
+    15
+    """
+    for field in COST_FIELDS:
+        total[field] = total.get(field, 0) + costs.get(field, 0)
+    return total
+
+
+def record_check_costs(check_id, costs):
+    with _worker_costs_lock:
+        merge_costs(_worker_costs.setdefault(str(check_id), {}), costs)
+
+
+def pop_check_costs():
+    """
+    Return and reset the costs summed up in this worker, as {str(check_id): {field: float}}.
+    Values go as floats over XML-RPC, which only knows 32 bit ints.
+
+    >>> record_check_costs(7, {'runs': 1, 'result_bytes': 120})
+    >>> record_check_costs(7, {'runs': 1, 'result_bytes': 80})
+    >>> pop_check_costs()['7']['result_bytes']
+    200.0
+    >>> pop_check_costs()
+    {}
+    """
+    global _worker_costs
+    with _worker_costs_lock:
+        costs, _worker_costs = _worker_costs, {}
+    return {check_id: {field: float(v) for field, v in c.items()} for check_id, c in costs.items()}
+
+
+def install_http_accounting():
+    """
+    Add the bytes of every HTTP response body read by the running check to its http_bytes, whatever plugin reads it:
+    requests (http(), entities(), kairosdb(), ...), pykube and boto all read through urllib3. Bodies are counted as
+    they are read, after decoding, responses which are not read are not counted.
+    """
+    if getattr(HTTPResponse.read, 'accounted', False):
+        return
+
+    read, read_chunked = HTTPResponse.read, HTTPResponse.read_chunked
+
+    @functools.wraps(read)
+    def accounted_read(self, *args, **kwargs):
+        data = read(self, *args, **kwargs)
+        if data:
+            add_cost('http_bytes', len(data))
+        return data
+
+    @functools.wraps(read_chunked)
+    def accounted_read_chunked(self, *args, **kwargs):
+        for chunk in read_chunked(self, *args, **kwargs):
+            add_cost('http_bytes', len(chunk))
+            yield chunk
+
+    accounted_read.accounted = True
+    HTTPResponse.read, HTTPResponse.read_chunked = accounted_read, accounted_read_chunked
+
+
+class AccountedConnection(redis.Connection):
+    """Redis connection counting round trips for the running check, a pipeline counts as one."""
+
+    def send_packed_command(self, command):
+        add_cost('redis_calls')
+        return super(AccountedConnection, self).send_packed_command(command)
+
+
+class CheckCostTable(object):
+    """
+    Costs of all workers, kept per check in time buckets of bucket_sec, so windows are rounded to full buckets.
+
+    >>> table = CheckCostTable()
+    >>> table.add({'1': {'runs': 2.0, 'cpu_time': 0.5}, '2': {'runs': 1.0, 'cpu_time': 2.0}}, timestamp=1000.0)
+    >>> table.add({'1': {'runs': 1.0, 'cpu_time': 0.5}}, timestamp=1010.0)
+    >>> [(c['check_id'], c['runs'], c['cpu_time']) for c in table.top(300, sort_by='cpu_time', now=1020.0)]
+    [(2, 1, 2.0), (1, 3, 1.0)]
+    >>> table.top(300, now=1020.0 + 2 * COST_BUCKET_SEC)
+    []
+    """
+
+    def __init__(self, bucket_sec=COST_BUCKET_SEC, keep_sec=COST_KEEP_SEC):
+        self.bucket_sec = bucket_sec
+        self.keep_sec = keep_sec
+        self._buckets = deque()  # [(bucket_start, {check_id: {field: value}})], oldest first
+        self._lock = threading.Lock()
+
+    def add(self, check_costs, timestamp=None):
+        if not check_costs:
+            return
+        bucket_start = int(timestamp or time.time()) // self.bucket_sec * self.bucket_sec
+        with self._lock:
+            if not self._buckets or self._buckets[-1][0] < bucket_start:
+                self._buckets.append((bucket_start, {}))
+                while self._buckets[0][0] <= bucket_start - self.keep_sec:
+                    self._buckets.popleft()
+            # pings arrive in order, a late one lands in the newest bucket
+            bucket = self._buckets[-1][1]
+            for check_id, costs in check_costs.items():
+                merge_costs(bucket.setdefault(check_id, {}), costs)
+
+    def aggregate(self, interval, now=None):
+        t_from = int(now or time.time()) - interval
+        totals = {}
+        with self._lock:
+            for bucket_start, bucket in self._buckets:
+                if bucket_start + self.bucket_sec > t_from:
+                    for check_id, costs in bucket.items():
+                        merge_costs(totals.setdefault(check_id, {}), costs)
+        return totals
+
+    def top(self, interval, limit=20, sort_by='cpu_time', now=None):
+        if sort_by not in COST_FIELDS:
+            raise ValueError('Can not sort checks by {}, valid fields: {}'.format(sort_by, ', '.join(COST_FIELDS)))
+
+        ranked = []
+        for check_id, costs in self.aggregate(interval, now=now).items():
+            costs = {field: round(costs[field], 3) for field in COST_FIELDS}
+            for field in ('runs', 'result_bytes', 'redis_calls', 'http_bytes'):
+                costs[field] = int(costs[field])
+            costs['check_id'] = int(check_id) if check_id.isdigit() else check_id
+            ranked.append(costs)
+
+        ranked.sort(key=lambda c: c[sort_by], reverse=True)
+        return ranked[:limit]
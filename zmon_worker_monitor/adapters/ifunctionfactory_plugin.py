@@ -45,6 +45,13 @@ class ProtectedPartial(object):
         new_kwargs.update((k, v) for (k, v) in kwargs.iteritems() if k not in self.__protected)
         return self.__func(*self.__partial_args + args, **new_kwargs)
 
+    def __bound__(self):
+        '''
+        The function and the arguments bound into it, e.g. to key cached calls. Check commands can not call it, names
+        with double underscores are rejected by safe_eval, so they do not see protected arguments like passwords.
+        '''
+        return self.__func, self.__partial_args, self.__partial_kwargs
+
 
 def propartial(func, *args, **kwargs):
     '''
@@ -2,7 +2,24 @@
 
 import requests
 
+from botocore.config import Config
+
+BOTO_DEFAULT_TIMEOUT = 60
+
 
 def get_instance_identity_document():
     r = requests.get('http://169.254.169.254/latest/dynamic/instance-identity/document', timeout=3)
     return r.json()
+
+
+def boto_client_kwargs(deadline=None):
+    '''
+    Extra boto3 client arguments capping connect and read timeouts with the remaining budget of the check deadline.
+
+    >>> boto_client_kwargs()
+    {}
+    '''
+    if deadline is None:
+        return {}
+    timeout = deadline.timeout(BOTO_DEFAULT_TIMEOUT)
+    return {'config': Config(connect_timeout=timeout, read_timeout=timeout)}
@@ -8,7 +8,7 @@ import fnmatch
 import logging
 
 from zmon_worker_monitor.zmon_worker.errors import CheckError
-from zmon_worker_monitor.builtins.plugins.aws_common import get_instance_identity_document
+from zmon_worker_monitor.builtins.plugins.aws_common import boto_client_kwargs, get_instance_identity_document
 from zmon_worker_monitor.adapters.ifunctionfactory_plugin import IFunctionFactoryPlugin, propartial
 
 STATE_OK = 'OK'
@@ -35,7 +35,8 @@ class CloudwatchWrapperFactory(IFunctionFactoryPlugin):
         :param factory_ctx: (dict) names available for Function instantiation
         :return: an object that implements a check function
         """
-        return propartial(CloudwatchWrapper, region=factory_ctx.get('entity').get('region', None))
+        return propartial(CloudwatchWrapper, region=factory_ctx.get('entity').get('region', None),
+                          deadline=factory_ctx.get('deadline'), __protected=['deadline'])
 
 
 def matches(dimensions, filters):
@@ -46,18 +47,18 @@ def matches(dimensions, filters):
 
 
 class CloudwatchWrapper(object):
-    def __init__(self, region=None, assume_role_arn=None):
+    def __init__(self, region=None, assume_role_arn=None, deadline=None):
         if not region:
             region = get_instance_identity_document()['region']
-        self.__client = boto3.client('cloudwatch', region_name=region)
+        self.__client = boto3.client('cloudwatch', region_name=region, **boto_client_kwargs(deadline))
 
         if assume_role_arn:
-            sts = boto3.client('sts', region_name=region)
+            sts = boto3.client('sts', region_name=region, **boto_client_kwargs(deadline))
             resp = sts.assume_role(RoleArn=assume_role_arn, RoleSessionName='zmon-woker-session')
             session = boto3.Session(aws_access_key_id=resp['Credentials']['AccessKeyId'],
                                     aws_secret_access_key=resp['Credentials']['SecretAccessKey'],
                                     aws_session_token=resp['Credentials']['SessionToken'])
-            self.__client = session.client('cloudwatch', region_name=region)
+            self.__client = session.client('cloudwatch', region_name=region, **boto_client_kwargs(deadline))
             logger.debug('Cloudwatch wrapper assumed role: {}'.format(assume_role_arn))
 
     def query_one(self, dimensions, metric_name, statistics, namespace, period=60, minutes=5, start=None, end=None,
@@ -5,7 +5,7 @@ import boto3
 import logging
 
 from zmon_worker_monitor.zmon_worker.errors import CheckError
-from zmon_worker_monitor.builtins.plugins.aws_common import get_instance_identity_document
+from zmon_worker_monitor.builtins.plugins.aws_common import boto_client_kwargs, get_instance_identity_document
 from zmon_worker_monitor.adapters.ifunctionfactory_plugin import IFunctionFactoryPlugin, propartial
 
 logging.getLogger('botocore').setLevel(logging.WARN)
@@ -24,7 +24,8 @@ class DataPipelineWrapperFactory(IFunctionFactoryPlugin):
         :param factory_ctx: (dict) names available for Function instantiation
         :return: an object that implements a check function
         """
-        return propartial(DataPipelineWrapper, region=factory_ctx.get('entity').get('region', None))
+        return propartial(DataPipelineWrapper, region=factory_ctx.get('entity').get('region', None),
+                          deadline=factory_ctx.get('deadline'), __protected=['deadline'])
 
 
 # create a dict of keys from a list of dicts
@@ -37,10 +38,10 @@ def create_dict_from_list_of_fields(fields):
 
 
 class DataPipelineWrapper(object):
-    def __init__(self, region=None):
+    def __init__(self, region=None, deadline=None):
         if not region:
             region = get_instance_identity_document()['region']
-        self.__client = boto3.client('datapipeline', region_name=region)
+        self.__client = boto3.client('datapipeline', region_name=region, **boto_client_kwargs(deadline))
 
     def get_details(self, pipeline_ids):
         """
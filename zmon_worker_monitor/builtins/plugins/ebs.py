@@ -3,7 +3,7 @@
 import boto3
 import logging
 
-from zmon_worker_monitor.builtins.plugins.aws_common import get_instance_identity_document
+from zmon_worker_monitor.builtins.plugins.aws_common import boto_client_kwargs, get_instance_identity_document
 from zmon_worker_monitor.adapters.ifunctionfactory_plugin import IFunctionFactoryPlugin, propartial
 
 logging.getLogger('botocore').setLevel(logging.WARN)
@@ -23,15 +23,16 @@ class EBSWrapperFactory(IFunctionFactoryPlugin):
         :param factory_ctx: (dict) names available for Function instantiation
         :return: an object that implements a check function
         """
-        return propartial(EBSWrapper, region=factory_ctx.get('entity').get('region', None))
+        return propartial(EBSWrapper, region=factory_ctx.get('entity').get('region', None),
+                          deadline=factory_ctx.get('deadline'), __protected=['deadline'])
 
 
 class EBSWrapper(object):
 
-    def __init__(self, region=None):
+    def __init__(self, region=None, deadline=None):
         if not region:
             region = get_instance_identity_document()['region']
-        self.__client = boto3.client('ec2', region_name=region)
+        self.__client = boto3.client('ec2', region_name=region, **boto_client_kwargs(deadline))
 
     def list_snapshots(self, account_id=None, max_items=100):
         """
@@ -64,7 +64,8 @@ class HttpFactory(IFunctionFactoryPlugin):
         :param factory_ctx: (dict) names available for Function instantiation
         :return: an object that implements a check function
         """
-        return propartial(HttpWrapper, base_url=factory_ctx.get('entity_url'))
+        return propartial(HttpWrapper, base_url=factory_ctx.get('entity_url'), deadline=factory_ctx.get('deadline'),
+                          __protected=['deadline'])
 
 
 def absolute_http_url(url):
@@ -165,6 +166,7 @@ class HttpWrapper(object):
             oauth2=False,
             oauth2_token_name='uid',
             headers=None,
+            deadline=None,
     ):
         if method.lower() not in ('get', 'head'):
             raise CheckError('Invalid method. Only GET and HEAD are supported!')
@@ -178,6 +180,7 @@ class HttpWrapper(object):
         self.clean_url = None
         self.params = params
         self.timeout = timeout
+        self.deadline = deadline
         self.max_retries = max_retries
         self.verify = verify
         self._headers = headers or {}
@@ -191,6 +194,10 @@ class HttpWrapper(object):
 
         self.__r = None
 
+    def __timeout(self):
+        # requests timeouts apply per connect and per read, the deadline still cuts long checks short
+        return self.deadline.timeout(self.timeout) if self.deadline else self.timeout
+
     def __request(self, raise_error=True, post_data=None):
         if self.__r is None:
             if self.max_retries:
@@ -215,14 +222,16 @@ class HttpWrapper(object):
 
             self._headers.update({'User-Agent': get_user_agent()})
 
+            timeout = self.__timeout()
+
             try:
                 if post_data is None:
                     # GET or HEAD
                     get_method = getattr(s, self.__method)
-                    self.__r = get_method(base_url, params=self.params, timeout=self.timeout, verify=self.verify,
+                    self.__r = get_method(base_url, params=self.params, timeout=timeout, verify=self.verify,
                                           headers=self._headers, auth=basic_auth, allow_redirects=self.allow_redirects)
                 else:
-                    self.__r = s.post(base_url, params=self.params, timeout=self.timeout, verify=self.verify,
+                    self.__r = s.post(base_url, params=self.params, timeout=timeout, verify=self.verify,
                                       headers=self._headers, auth=basic_auth, data=json.dumps(post_data))
             except requests.Timeout, e:
                 raise HttpError('timeout', self.clean_url), None, sys.exc_info()[2]
@@ -358,10 +367,12 @@ class HttpWrapper(object):
         host = parsed_host[0]
         port = parsed_host[1] if len(parsed_host) > 1 else 443
 
+        timeout = self.__timeout()
+
         # TODO: The following could be moved to a diff wrapper with more TLS related features.
         try:
             sock = socket.socket()
-            sock.settimeout(self.timeout)
+            sock.settimeout(timeout)
 
             ssl_sock = ssl.wrap_socket(sock, cert_reqs=ssl.CERT_REQUIRED)
 
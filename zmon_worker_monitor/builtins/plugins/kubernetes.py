@@ -11,7 +11,7 @@ from pykube.objects import NamespacedAPIObject
 
 from prometheus_client.parser import text_string_to_metric_families
 
-from zmon_worker_monitor.zmon_worker.common.http import get_user_agent
+from zmon_worker_monitor.zmon_worker.common.http import DeadlineAdapter, get_user_agent
 
 from zmon_worker_monitor.zmon_worker.errors import CheckError
 
@@ -71,7 +71,8 @@ class KubernetesFactory(IFunctionFactoryPlugin):
         :param factory_ctx: (dict) names available for Function instantiation
         :return: an object that implements a check function
         """
-        return propartial(KubernetesWrapper, check_id=factory_ctx['check_id'], __protected=['check_id'])
+        return propartial(KubernetesWrapper, check_id=factory_ctx['check_id'], deadline=factory_ctx.get('deadline'),
+                          __protected=['check_id', 'deadline'])
 
 
 def _get_resources(object_manager, name=None, field_selector=None, **kwargs):
@@ -105,8 +106,9 @@ def _objects(objects):
 
 
 class KubernetesWrapper(object):
-    def __init__(self, namespace='default', check_id='<unknown>'):
+    def __init__(self, namespace='default', check_id='<unknown>', deadline=None):
         self.__check_id = check_id
+        self.__deadline = deadline
         self.__namespace = pykube.all if namespace is None else namespace
 
     @property
@@ -115,6 +117,8 @@ class KubernetesWrapper(object):
         client = pykube.HTTPClient(config)
         client.session.headers['User-Agent'] = "{} (check {})".format(get_user_agent(), self.__check_id)
         client.session.trust_env = False
+        if self.__deadline is not None:
+            client.session.mount('https://', DeadlineAdapter(self.__deadline))
         return client
 
     def namespaces(self):
@@ -8,7 +8,7 @@ import cStringIO
 
 from botocore.exceptions import ClientError
 
-from zmon_worker_monitor.builtins.plugins.aws_common import get_instance_identity_document
+from zmon_worker_monitor.builtins.plugins.aws_common import boto_client_kwargs, get_instance_identity_document
 from zmon_worker_monitor.adapters.ifunctionfactory_plugin import IFunctionFactoryPlugin, propartial
 
 logging.getLogger('botocore').setLevel(logging.WARN)
@@ -27,14 +27,15 @@ class S3BucketWrapper(IFunctionFactoryPlugin):
         :param factory_ctx: (dict) names available for Function instantiation
         :return: an object that implements a check function
         """
-        return propartial(S3Wrapper, region=factory_ctx.get('entity').get('region', None))
+        return propartial(S3Wrapper, region=factory_ctx.get('entity').get('region', None),
+                          deadline=factory_ctx.get('deadline'), __protected=['deadline'])
 
 
 class S3Wrapper(object):
-    def __init__(self, region=None):
+    def __init__(self, region=None, deadline=None):
         if not region:
             region = get_instance_identity_document()['region']
-        self.__client = boto3.client('s3', region_name=region)
+        self.__client = boto3.client('s3', region_name=region, **boto_client_kwargs(deadline))
 
     def get_object_metadata(self, bucket_name, key):
         """
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import math
 import psycopg2
 import re
 import sys
@@ -65,7 +66,8 @@ class SqlFactory(IFunctionFactoryPlugin):
                           timeout=factory_ctx['soft_time_limit'] * 1000,
                           check_id=factory_ctx['check_id'],
                           created_by=factory_ctx['req_created_by'],
-                          __protected=['created_by', 'check_id'])
+                          deadline=factory_ctx.get('deadline'),
+                          __protected=['created_by', 'check_id', 'deadline'])
 
 
 def make_safe(s):
@@ -94,6 +96,7 @@ class SqlWrapper(object):
             shard=None,
             created_by=None,
             check_id=None,
+            deadline=None,
     ):
         '''
         Parameters
@@ -113,6 +116,8 @@ class SqlWrapper(object):
             requested database. It's optional because it's currently supported only in trial run.
         check_id: int
             The check definition ID in order to set PostgreSQL application name (easier tracking on server side).
+        deadline: Deadline
+            Optional time budget of the check, caps connect and statement timeouts.
         '''
 
         if not shards:
@@ -120,6 +125,11 @@ class SqlWrapper(object):
         if shard and not shards.get(shard):
             raise CheckError('SqlWrapper: Shard {} not found in shards definition'.format(shard))
 
+        if deadline is not None:
+            # libpq takes whole seconds (2 at least), statement_timeout milliseconds
+            connect_timeout = max(int(math.ceil(deadline.timeout(connect_timeout))), 2)
+            timeout = max(int(deadline.timeout(timeout / 1000.0) * 1000), 1)
+
         self._cursors = []
         self._conns = []
         self._stmt = None
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Coalescing of stale duplicate tasks.
+
+When workers fall behind, a queue holds several check_and_notify tasks for the same check and entity, only the newest
+one matters. We keep a local index {(check_id, entity_id): newest schedule_time} fed with the tasks we pop and, while
+lagging, with the headers of the tasks waiting at the head of the queue. A task is stale when a newer one for the
+same pair was seen.
+"""
+
+import logging
+import time
+
+from envelope import decode_task
+
+logger = logging.getLogger(__name__)
+
+COALESCE_SCAN_DEFAULT = 0  # disabled
+COALESCE_LAG_DEFAULT = 60
+COALESCE_SCAN_INTERVAL = 5
+COALESCE_INDEX_TTL = 60 * 60
+COALESCE_INDEX_MAX_SIZE = 100000
+
+# only these tasks are superseded by a newer one for the same check and entity, trial runs are not
+COALESCE_TASKS = frozenset(['check_and_notify'])
+
+
+class TaskCoalescer(object):
+    """
+    >>> from envelope import TaskEnvelope
+    >>> coalescer = TaskCoalescer()
+    >>> coalescer.observe([TaskEnvelope('check_and_notify', check_id=1, entity_id='e', schedule_time=t)
+    ...                    for t in (100.0, 160.0)])
+    >>> coalescer.is_stale(TaskEnvelope('check_and_notify', check_id=1, entity_id='e', schedule_time=100.0))
+    True
+    >>> coalescer.is_stale(TaskEnvelope('check_and_notify', check_id=1, entity_id='e', schedule_time=160.0))
+    False
+    >>> coalescer.is_stale(TaskEnvelope('trial_run', check_id=None, entity_id='e', schedule_time=100.0))
+    False
+    >>> coalescer.is_stale(TaskEnvelope('trial_run', check_id=1, entity_id='e', schedule_time=100.0))
+    False
+    """
+
+    def __init__(self, scan_size=100, lag=COALESCE_LAG_DEFAULT, scan_interval=COALESCE_SCAN_INTERVAL):
+        self.scan_size = scan_size
+        self.lag = lag
+        self.scan_interval = scan_interval
+        self._newest = {}
+        self._t_last_scan = {}  # {queue: t_last_scan}
+
+    @staticmethod
+    def _key(task):
+        if (task.task not in COALESCE_TASKS or task.check_id is None or task.entity_id is None or
+                task.schedule_time is None):
+            return None
+        return task.check_id, task.entity_id
+
+    def observe(self, tasks):
+        for task in tasks:
+            key = self._key(task)
+            if key is not None and task.schedule_time > self._newest.get(key, 0):
+                self._newest[key] = task.schedule_time
+
+    def observe_msgs(self, msgs):
+        """
+        Observe raw messages, e.g. the ones just popped, messages that can not be decoded are ignored.
+        """
+        tasks = []
+        for msg in msgs:
+            try:
+                tasks.append(decode_task(msg))
+            except Exception:
+                logger.debug('Could not decode task for coalescing: %r', msg[:100])
+        self.observe(tasks)
+        return len(tasks)
+
+    def is_stale(self, task):
+        key = self._key(task)
+        return key is not None and task.schedule_time < self._newest.get(key, 0)
+
+    def is_lagging(self, task, now=None):
+        return task.schedule_time is not None and (now or time.time()) - task.schedule_time > self.lag
+
+    def scan(self, r_conn, queue):
+        """
+        Observe the tasks waiting at the head of queue, at most once every scan_interval seconds.
+        Bodies of compact envelopes are not decoded. Returns the number of tasks observed.
+        """
+        t_now = time.time()
+        if t_now - self._t_last_scan.get(queue, 0) < self.scan_interval:
+            return 0
+        self._t_last_scan[queue] = t_now
+
+        observed = self.observe_msgs(r_conn.lrange(queue, 0, self.scan_size - 1))
+        self._prune(t_now)
+        return observed
+
+    def _prune(self, t_now):
+        if len(self._newest) > COALESCE_INDEX_MAX_SIZE:
+            self._newest = {k: t for k, t in self._newest.items() if t_now - t < COALESCE_INDEX_TTL}
+
+
+def get_task_coalescer(config):
+    """
+    Coalescing is opt-in: zmon.coalesce.scan sets how many queued tasks are looked ahead, 0 disables it.
+
+    >>> get_task_coalescer({}) is None
+    True
+    >>> get_task_coalescer({'zmon.coalesce.scan': '500', 'zmon.coalesce.lag': '120'}).lag
+    120
+    """
+    scan_size = int(config.get('zmon.coalesce.scan', COALESCE_SCAN_DEFAULT))
+    if scan_size <= 0:
+        return None
+    return TaskCoalescer(scan_size=scan_size, lag=int(config.get('zmon.coalesce.lag', COALESCE_LAG_DEFAULT)))
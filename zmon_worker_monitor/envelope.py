@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Encoding and decoding of the task messages found in the zmon queues.
+
+Besides the celery style JSON messages (body_encoding nested, base64 or snappy) we accept a compact binary envelope:
+
+    MAGIC + msgpack([header, body])
+
+The header is a flat map holding everything needed to route or discard a task: task name, id, expiry as epoch float,
+time limits, check and entity ids, schedule time, trace and delivery info. The body holds args and kwargs packed with
+msgpack as well, it is only unpacked if the task really runs.
+"""
+
+import _strptime  # noqa: F401 - datetime.strptime imports it lazily, which is not thread safe in python 2
+import base64
+import calendar
+import json
+import time
+from datetime import datetime
+
+import msgpack
+import snappy
+
+# Snappy compressed messages never start with a zero byte (it would be an empty message), JSON ones start with "{"
+MAGIC = b'\x00\x01'
+
+HEADER_FIELDS = ('task', 'id', 'expires', 'timelimit', 'check_id', 'entity_id', 'schedule_time', 'trace',
+                 'delivery_info')
+
+
+class TaskEnvelope(object):
+    """
+    A decoded task. Only the header is decoded up front, args and kwargs are decoded on first access.
+    """
+
+    __slots__ = HEADER_FIELDS + ('_packed_body', '_body')
+
+    def __init__(self, task, id='', expires=None, timelimit=None, check_id=None, entity_id=None, schedule_time=None,
+                 trace=None, delivery_info=None, packed_body=None, body=None):
+        self.task = task
+        self.id = id
+        self.expires = expires  # epoch seconds or None if the task never expires
+        self.timelimit = timelimit  # [hard, soft]
+        self.check_id = check_id
+        self.entity_id = entity_id
+        self.schedule_time = schedule_time
+        self.trace = trace or {}
+        self.delivery_info = delivery_info or {}
+        self._packed_body = packed_body
+        self._body = body
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = msgpack.unpackb(self._packed_body, raw=False) if self._packed_body else {}
+        return self._body
+
+    @property
+    def args(self):
+        return self.body.get('args', [])
+
+    @property
+    def kwargs(self):
+        return self.body.get('kwargs', {})
+
+    def is_expired(self, now=None):
+        """
+        >>> TaskEnvelope('check_and_notify', expires=100.0).is_expired(now=99.0)
+        False
+        >>> TaskEnvelope('check_and_notify', expires=100.0).is_expired(now=100.0)
+        True
+        >>> TaskEnvelope('check_and_notify').is_expired()
+        False
+        """
+        if self.expires is None:
+            return False
+        return (time.time() if now is None else now) >= self.expires
+
+    def header(self):
+        return {f: getattr(self, f) for f in HEADER_FIELDS}
+
+    @classmethod
+    def from_header(cls, header, packed_body):
+        # ignore unknown header fields, newer producers may add them
+        return cls(packed_body=packed_body, **{str(k): v for k, v in header.items() if k in HEADER_FIELDS})
+
+
+def _check_info(args):
+    req = args[0] if args and isinstance(args[0], dict) else {}
+    return req.get('check_id'), req.get('entity', {}).get('id'), req.get('schedule_time')
+
+
+def parse_expires(expires, utc=True):
+    """
+    Convert the celery expires string to epoch seconds.
+
+    >>> parse_expires('2014-09-04T10:27:32.919152+00:00')
+    1409826452.919152
+    >>> parse_expires('2014-09-04T10:27:32.919152Z')
+    1409826452.919152
+    >>> parse_expires(None) is None
+    True
+    """
+    if not expires:
+        return None
+    dt = datetime.strptime(expires.replace('Z', '').rsplit('+', 1)[0], '%Y-%m-%dT%H:%M:%S.%f')
+    return (calendar.timegm(dt.timetuple()) if utc else time.mktime(dt.timetuple())) + dt.microsecond / 1e6
+
+
+def decode_celery_message(msg_obj):
+    """
+    Decode an already parsed celery style message, the body is decoded right away as it holds the task name.
+
+    >>> t = decode_celery_message({'properties': {'body_encoding': 'nested'},
+    ...                            'body': {'task': 'check_and_notify', 'args': [{'check_id': 1}], 'kwargs': {},
+    ...                                     'timelimit': [90, 60]}})
+    >>> t.task, t.check_id, t.args
+    ('check_and_notify', 1, [{'check_id': 1}])
+    """
+    properties = msg_obj.get('properties', {})
+    body_encoding = properties.get('body_encoding')
+
+    msg_body = None
+    if body_encoding == 'nested':
+        msg_body = msg_obj['body']
+    elif body_encoding == 'base64':
+        msg_body = json.loads(base64.b64decode(msg_obj['body']))
+    elif body_encoding == 'snappy':
+        msg_body = json.loads(snappy.decompress(base64.b64decode(msg_obj['body'])))
+
+    check_id, entity_id, schedule_time = _check_info(msg_body['args'])
+
+    return TaskEnvelope(
+        msg_body['task'],
+        id=msg_body.get('id', ''),
+        expires=parse_expires(msg_body.get('expires'), utc=msg_body.get('utc', True)),
+        timelimit=msg_body.get('timelimit'),
+        check_id=check_id,
+        entity_id=entity_id,
+        schedule_time=schedule_time,
+        trace=properties.get('trace', {}),
+        delivery_info=properties.get('delivery_info', {}),
+        body={'args': msg_body['args'], 'kwargs': msg_body['kwargs']},
+    )
+
+
+def decode_task(msg):
+    """
+    Decode a raw message popped from a zmon queue, whatever its format.
+
+    >>> decode_task(encode_task('check_and_notify', [{'check_id': 1, 'entity': {'id': 'e'}}], {})).entity_id
+    'e'
+    """
+    if msg[:len(MAGIC)] == MAGIC:
+        header, packed_body = msgpack.unpackb(msg[len(MAGIC):], raw=False)
+        return TaskEnvelope.from_header(header, packed_body)
+
+    if msg[:1] != '{':
+        msg = snappy.decompress(msg)
+
+    return decode_celery_message(json.loads(msg))
+
+
+def encode_task(task, args, kwargs, id='', expires=None, timelimit=None, trace=None, delivery_info=None):
+    """
+    Build a compact binary task message, expires is given in epoch seconds.
+
+    >>> t = decode_task(encode_task('check_and_notify', [{'check_id': 1}], {'x': 1}, expires=10.5, timelimit=[9, 6]))
+    >>> t.task, t.check_id, t.expires, t.timelimit, t.kwargs
+    ('check_and_notify', 1, 10.5, [9, 6], {'x': 1})
+    """
+    check_id, entity_id, schedule_time = _check_info(args)
+
+    envelope = TaskEnvelope(task, id=id, expires=expires, timelimit=timelimit, check_id=check_id, entity_id=entity_id,
+                            schedule_time=schedule_time, trace=trace, delivery_info=delivery_info)
+    packed_body = msgpack.packb({'args': args, 'kwargs': kwargs}, use_bin_type=True)
+
+    return MAGIC + msgpack.packb([envelope.header(), packed_body], use_bin_type=True)
@@ -6,6 +6,8 @@ import logging
 import logging.config
 import os
 import warnings
+from collections import Counter
+from functools import partial
 
 import requests
 import yaml
@@ -13,7 +15,10 @@ from requests.packages.urllib3.exceptions import SubjectAltNameWarning
 
 import plugin_manager
 import rpc_server
+import sampling
 import settings
+from process_controller import ProcessGroup
+from redis_context_manager import RedisConnHandler
 
 from .flags import MONITOR_KILL_REQ, MONITOR_PING, MONITOR_RESTART
 from .web_server.start import start_web
@@ -26,6 +31,9 @@ os.environ["ORACLE_HOME"] = "/opt/oracle/instantclient_12_1/"
 os.environ["LD_LIBRARY_PATH"] = os.environ.get("LD_LIBRARY_PATH", '') + ":/opt/oracle/instantclient_12_1/"
 
 DEFAULT_NUM_PROC = 16
+DEFAULT_PREFETCH = 1
+DEFAULT_CONCURRENCY = 1
+QUEUE_POLICIES = ('weighted', 'priority')
 
 
 def parse_args(args):
@@ -41,6 +49,99 @@ def read_config(path):
     return config
 
 
+def parse_queue_config(qn):
+    '''
+    Parse one entry of zmon.queues: <queue>[/<num_proc>[-<max_num_proc>]][?<option>=<value>&...]
+
+    With a process range the number of processes is autoscaled between both bounds according to the queue backlog,
+    the returned options hold the upper bound as max_processes.
+
+    One entry may consume several queues: <queue>@<weight>|<queue>@<weight>... With policy=weighted (default) a
+    queue gets tasks in proportion to its weight when all queues have work, with policy=priority queues are consumed
+    in the listed order. In both cases idle workers take tasks from any queue with work.
+
+    >>> parse_queue_config('zmon:queue:default')[:2]
+    ('zmon:queue:default', 16)
+
+    >>> parse_queue_config(' zmon:queue:internal/2 ')[:2]
+    ('zmon:queue:internal', 2)
+
+    >>> sorted(parse_queue_config('zmon:queue:default/4')[2].items())
+    [('concurrency', 1), ('max_processes', 4), ('policy', 'weighted'), ('prefetch', 1)]
+
+    >>> sorted(parse_queue_config('zmon:queue:default/4?prefetch=10&concurrency=8')[2].items())
+    [('concurrency', 8), ('max_processes', 4), ('policy', 'weighted'), ('prefetch', 10)]
+
+    >>> queue, N, options = parse_queue_config('zmon:queue:default/4-32?prefetch=10')
+    >>> queue, N, options['max_processes']
+    ('zmon:queue:default', 4, 32)
+
+    >>> parse_queue_config('zmon:queue:default@4|zmon:queue:internal@1/18?policy=priority')[:2]
+    ('zmon:queue:default@4|zmon:queue:internal@1', 18)
+
+    >>> parse_queue_config('zmon:queue:default/4?policy=random')
+    Traceback (most recent call last):
+        ...
+    ValueError: Unknown policy "random" for queue zmon:queue:default
+
+    >>> parse_queue_config('zmon:queue:default/4?foo=1')
+    Traceback (most recent call last):
+        ...
+    ValueError: Unknown option "foo" for queue zmon:queue:default
+
+    >>> parse_queue_config('zmon:queue:default/8-4')
+    Traceback (most recent call last):
+        ...
+    ValueError: Wrong process range "8-4" for queue zmon:queue:default
+    '''
+    qn, _, query = qn.strip().partition('?')
+    queue, N = (qn.rsplit('/', 1) + [str(DEFAULT_NUM_PROC)])[:2]
+    N, _, N_max = N.partition('-')
+
+    options = {'prefetch': DEFAULT_PREFETCH, 'concurrency': DEFAULT_CONCURRENCY, 'policy': QUEUE_POLICIES[0]}
+    for opt in filter(None, query.split('&')):
+        key, _, value = opt.partition('=')
+        if key not in options:
+            raise ValueError('Unknown option "{}" for queue {}'.format(key, queue))
+        options[key] = type(options[key])(value)
+
+    if options['policy'] not in QUEUE_POLICIES:
+        raise ValueError('Unknown policy "{}" for queue {}'.format(options['policy'], queue))
+
+    options['max_processes'] = int(N_max or N)
+    if options['max_processes'] < int(N):
+        raise ValueError('Wrong process range "{}-{}" for queue {}'.format(N, N_max, queue))
+
+    return queue, int(N), options
+
+
+def queue_backlog(queue):
+    '''
+    Number of tasks waiting in the queues consumed by one zmon.queues entry
+    '''
+    names = [q.rsplit('@', 1)[0] for q in queue.split('|')]
+    pipe = RedisConnHandler.get_instance().get_conn().pipeline(transaction=False)
+    for name in names:
+        pipe.llen(name)
+    return sum(pipe.execute())
+
+
+def scaling_pool_names(queues):
+    '''
+    Name of the scaling pool of every zmon.queues entry: its queues, numbered from the second entry on when the same
+    queues are listed more than once
+
+    >>> scaling_pool_names(['zmon:queue:default', 'zmon:queue:internal', 'zmon:queue:default'])
+    ['zmon:queue:default', 'zmon:queue:internal', 'zmon:queue:default#2']
+    '''
+    seen = Counter()
+    names = []
+    for queue in queues:
+        seen[queue] += 1
+        names.append(queue if seen[queue] == 1 else '{}#{}'.format(queue, seen[queue]))
+    return names
+
+
 def process_config(config):
     # If running on AWS, fetch the account number
     try:
@@ -114,14 +215,28 @@ def main(args=None):
     # load external plugins (should be run only once)
     plugin_manager.collect_plugins(global_config=config, load_builtins=True, load_env=True)
 
-    # start worker processes per queue according to the config
-    queues = config['zmon.queues']
-    for qn in queues.split(','):
-        queue, N = (qn.rsplit('/', 1) + [DEFAULT_NUM_PROC])[:2]
-        main_proc.proc_control.spawn_many(
-            int(N),
+    # fetch the sampling config once for all workers, they get it from us over RPC
+    if not args.no_rpc:
+        main_proc.proc_control.add_shared_value(
+            sampling.SAMPLING_CONFIG_SHARED_NAME, partial(sampling.fetch_sampling_rate_config, config),
+            refresh_sec=int(config.get('zmon.sampling.update.rate', sampling.SAMPLING_RATE_UPDATE_DURATION)))
+
+    # start worker processes per queue according to the config, queues with a process range get autoscaled
+    queues = [parse_queue_config(qn) for qn in config['zmon.queues'].split(',')]
+    if any(options['max_processes'] > N for queue, N, options in queues):
+        RedisConnHandler.configure(**dict(config))
+        main_proc.proc_control.set_action_policy(ProcessGroup.ACTION_POLICY_AUTOSCALE)
+
+    # an entry listed twice gets a pool of its own, as it got its own processes before autoscaling
+    pool_names = scaling_pool_names([queue for queue, N, options in queues])
+    for name, (queue, N, options) in zip(pool_names, queues):
+        main_proc.proc_control.add_scaling_pool(
+            name, N, options['max_processes'], partial(queue_backlog, queue),
             kwargs={
                 'queue': queue,
+                'prefetch': options['prefetch'],
+                'concurrency': options['concurrency'],
+                'policy': options['policy'],
                 'flow': 'simple_queue_processor',
                 'tracer': config.get('opentracing.tracer'),
                 'tracer_tags': {
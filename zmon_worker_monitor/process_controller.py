@@ -6,19 +6,22 @@ Logic for controlling worker processes
 import copy
 import json
 import logging
+import math
 import os
 import pickle
 import signal
 import time
-from collections import Iterable, defaultdict
+from collections import Counter, Iterable, defaultdict
 from datetime import timedelta
 from functools import wraps
 from multiprocessing import Process
-from threading import Thread
+from threading import Lock, Thread
 from UserDict import IterableUserDict
 
 from zmon_worker_monitor.zmon_worker.common.utils import get_process_cmdline
 
+from .accounting import CheckCostTable
+
 from .flags import (MONITOR_KILL_REQ, MONITOR_NONE, MONITOR_PING,
                     MONITOR_RESTART, flags2num, has_flag)
 
@@ -58,6 +61,11 @@ class ProcessController(object):
 
         self.proc_groups = {}  # TODO: allow creation of separated process groups ?
 
+        self._shared_values = {}  # {name: {'version': version, 'value': value}}
+        self._shared_fetchers = {}  # {name: (fetch, refresh_sec)}
+        self._shared_lock = Lock()
+        self._shared_thread = None
+
         if start_action_loop:
             self.start_action_loop()
 
@@ -134,12 +142,76 @@ class ProcessController(object):
     def health_state(self):
         return self.proc_group.is_healthy()
 
+    def top_checks(self, interval=None, limit=20, sort_by='cpu_time'):
+        return self.proc_group.top_checks(interval=interval, limit=limit, sort_by=sort_by)
+
     def start_action_loop(self):
         self.proc_group.start_action_loop()
 
     def stop_action_loop(self):
         self.proc_group.stop_action_loop()
 
+    def add_scaling_pool(self, name, min_processes, max_processes, queue_length, target=None, args=None, kwargs=None,
+                         flags=None):
+        return self.proc_group.add_scaling_pool(name, min_processes, max_processes, queue_length, target=target,
+                                                args=args, kwargs=kwargs, flags=flags)
+
+    def get_dynamic_num_processes(self):
+        return self.proc_group.get_scaling_pools()
+
+    def set_dynamic_num_processes(self, name, min_processes, max_processes):
+        self.proc_group.set_scaling_bounds(name, min_processes, max_processes)
+        return True
+
+    def get_action_policy(self):
+        return self.proc_group.action_policy
+
+    def set_action_policy(self, policy):
+        self.proc_group.set_action_policy(policy)
+        return True
+
+    def available_action_policies(self):
+        return list(ProcessGroup.action_policies)
+
+    def add_shared_value(self, name, fetch, refresh_sec=60):
+        """
+        Fetch a value once for all workers: fetch() runs every refresh_sec seconds in a background thread and
+        workers poll the result with get_shared_value() over RPC.
+        """
+        self._shared_fetchers[name] = (fetch, refresh_sec)
+        if self._shared_thread is None:
+            self._shared_thread = Thread(target=self._shared_values_loop)
+            self._shared_thread.daemon = True
+            self._shared_thread.start()
+
+    def set_shared_value(self, name, value):
+        with self._shared_lock:
+            entry = self._shared_values.get(name, {'version': 0})
+            if 'value' not in entry or entry['value'] != value:
+                entry = {'version': entry['version'] + 1, 'value': value}
+                self._shared_values[name] = entry
+            return entry['version']
+
+    def get_shared_value(self, name, version=0):
+        """
+        Return {'version': version, 'value': value}, value is left out if the caller already has the current version.
+        Version 0 means there is no value yet.
+        """
+        entry = self._shared_values.get(name, {'version': 0})
+        return {'version': entry['version']} if entry['version'] == version else dict(entry)
+
+    def _shared_values_loop(self):
+        t_next = {}
+        while True:
+            for name, (fetch, refresh_sec) in self._shared_fetchers.items():
+                if time.time() >= t_next.get(name, 0):
+                    t_next[name] = time.time() + refresh_sec
+                    try:
+                        self.set_shared_value(name, fetch())
+                    except Exception:
+                        self.logger.exception('Failed to refresh shared value %s: ', name)
+            time.sleep(1)
+
 
 class SimpleMethodCacheInMemory(object):
     """
@@ -221,7 +293,7 @@ class ProcessPlus(Process):
     """
 
     _pack_fields = ('target', 'args', 'kwargs', 'flags', 'tags', 'stats', 'name', 'pid', 'previous_proc',
-                    'ping_status', 'actions_last_5', 'errors_last_5', 'task_counts', 'event_counts')
+                    'ping_status', 'actions_last_5', 'errors_last_5', 'task_counts', 'queue_counts', 'event_counts')
 
     keep_pings = 3000  # covers approx. 24 hours if pings sent every 30 secs
 
@@ -235,6 +307,7 @@ class ProcessPlus(Process):
         'tasks_done': 0,
         'percent_idle': 0,
         'task_duration': 0.0,
+        'tasks_by_queue': {},
     }
 
     default_status_interval = 60 * 5  # analyze only the pings received since now - this interval
@@ -348,6 +421,10 @@ class ProcessPlus(Process):
     def task_counts(self):
         return self.get_ping_counts()
 
+    @property
+    def queue_counts(self):
+        return self.get_queue_counts()
+
     @property
     def event_counts(self):
         return self.get_event_counts()
@@ -439,6 +516,27 @@ class ProcessPlus(Process):
 
         return agg_data
 
+    @cache(wait_sec=5)
+    def aggregate_queue_pings(self, interval=None):
+
+        tnow = time.time()
+
+        if interval is None:  # if time_window not given we aggregate all stored pings
+            interval = (tnow - self.stored_pings[0]['timestamp']) if self.stored_pings else 0
+
+        tasks_by_queue = Counter()
+        for p in self.stored_pings:
+            if tnow - p['timestamp'] <= interval:
+                tasks_by_queue.update(p['tasks_by_queue'])
+
+        return {
+            queue: {
+                'tasks_done': tasks_done,
+                'tasks_per_min': round((float(tasks_done) / interval) * 60, FLOAT_DIGITS) if interval else -1,
+            }
+            for queue, tasks_done in tasks_by_queue.items()
+        }
+
     @cache(wait_sec=5)
     def aggregate_events(self, interval=None):
 
@@ -477,6 +575,11 @@ class ProcessPlus(Process):
         intervals = intervals or self.default_ping_count_intervals
         return {str(timedelta(seconds=ts)): self.aggregate_pings(interval=ts) for ts in intervals}
 
+    @cache(wait_sec=5)
+    def get_queue_counts(self, intervals=()):
+        intervals = intervals or self.default_ping_count_intervals
+        return {str(timedelta(seconds=ts)): self.aggregate_queue_pings(interval=ts) for ts in intervals}
+
     @cache(wait_sec=5)
     def get_event_counts(self, intervals=()):
         intervals = intervals or self.default_event_count_intervals
@@ -582,6 +685,19 @@ class ProcessGroup(IterableUserDict):
     Perform simple operations on the collection.
     """
 
+    ACTION_POLICY_STATIC = 'static'  # keep the number of processes we were told to spawn
+    ACTION_POLICY_AUTOSCALE = 'autoscale'  # resize scaling pools between their bounds according to load
+
+    action_policies = (ACTION_POLICY_STATIC, ACTION_POLICY_AUTOSCALE)
+
+    autoscale_ping_interval = 120  # analyze the pings received since now - this interval
+    autoscale_drain_sec = 30  # spawn enough processes to drain the queue backlog in this time
+    autoscale_up_wait = 30  # seconds between two scale ups, gives new processes time to start pinging
+    autoscale_down_wait = 120  # seconds since last resize before we retire processes
+    autoscale_down_idle = 50  # retire processes only if pool is idle more than this percent of time
+    autoscale_default_task_duration = 1.0  # used while a pool did not finish any task
+    autoscale_kill_wait = 2  # retired workers get this time to push their prefetched tasks back
+
     def __init__(self, group_name=None, default_target=None, default_args=None, default_kwargs=None,
                  default_flags=None, default_kill_wait=0.5, max_processes=1000, process_plus_impl=None):
 
@@ -614,6 +730,11 @@ class ProcessGroup(IterableUserDict):
         self.stop_action = True
         self.action_loop_interval = 1  # seconds between each actions pass
 
+        self.action_policy = self.ACTION_POLICY_STATIC
+        self._scaling_pools = {}  # {pool_name => {'min': n, 'max': n, 'queue_length': callable, ...}}
+
+        self.check_costs = CheckCostTable()  # costs of all processes by check, not kept with each process' pings
+
         IterableUserDict.__init__(self)
 
     def _v_or_def(self, **kw):
@@ -681,6 +802,127 @@ class ProcessGroup(IterableUserDict):
                 n_success += 1
         return n_success == N  # TODO: better return n_success
 
+    def add_scaling_pool(self, name, min_processes, max_processes, queue_length, target=None, args=None, kwargs=None,
+                         flags=None):
+        """
+        Spawn min_processes tagged as members of pool name. With the autoscale policy the pool is later resized
+        between min_processes and max_processes, queue_length() must return the number of tasks waiting for the pool.
+        """
+        if name in self._scaling_pools:
+            raise ValueError('Scaling pool {} already exists'.format(name))
+        self._scaling_pools[name] = dict(target=target, args=args, kwargs=kwargs or {}, flags=flags,
+                                         queue_length=queue_length, t_last_up=0, t_last_resize=0)
+        self.set_scaling_bounds(name, min_processes, max_processes)
+
+        return all(self._spawn_pool_process(name) for _ in range(min_processes))
+
+    def set_scaling_bounds(self, name, min_processes, max_processes):
+        if name not in self._scaling_pools:
+            raise Exception('Scaling pool {} not found'.format(name))
+        if not 0 < int(min_processes) <= int(max_processes):
+            raise ValueError('Wrong bounds for scaling pool {}: {}-{}'.format(name, min_processes, max_processes))
+        self._scaling_pools[name].update(min=int(min_processes), max=int(max_processes))
+
+    def get_scaling_pools(self):
+        return {name: {'min': pool['min'], 'max': pool['max'], 'running': len(self.pool_processes(name))}
+                for name, pool in self._scaling_pools.items()}
+
+    def pool_processes(self, name):
+        return [proc for proc in self.values() if (proc.tags or {}).get('pool') == name]
+
+    def set_action_policy(self, policy):
+        if policy not in self.action_policies:
+            raise ValueError('Unknown action policy {}. Available: {}'.format(policy, self.action_policies))
+        self.action_policy = policy
+
+    def _spawn_pool_process(self, name):
+        pool = self._scaling_pools[name]
+        try:
+            return self.spawn_process(target=pool['target'], args=pool['args'], kwargs=pool['kwargs'],
+                                      flags=pool['flags'], tags={'pool': name})
+        except Exception:
+            self.logger.exception('Failed to start process in scaling pool %s. Reason: ', name)
+            return None
+
+    @classmethod
+    def scaling_target(cls, running, backlog, percent_idle, task_duration, concurrency=1):
+        """
+        Number of processes a pool needs: the busy ones plus enough to drain the backlog in autoscale_drain_sec.
+
+        >>> ProcessGroup.scaling_target(4, backlog=0, percent_idle=75.0, task_duration=0.5)
+        1
+        >>> ProcessGroup.scaling_target(4, backlog=600, percent_idle=0.0, task_duration=0.5)
+        14
+        >>> ProcessGroup.scaling_target(4, backlog=600, percent_idle=0.0, task_duration=0.5, concurrency=10)
+        5
+        """
+        busy = running * (100.0 - percent_idle) / 100
+        drain = backlog * task_duration / (cls.autoscale_drain_sec * concurrency)
+        return int(math.ceil(busy + drain))
+
+    def _pool_load(self, procs):
+        """
+        Average percent_idle and task_duration over the pinging processes of a pool, None if none pinged yet.
+        """
+        aggs = [agg for agg in (proc.aggregate_pings(interval=self.autoscale_ping_interval) for proc in procs)
+                if agg['percent_idle'] >= 0]
+        if not aggs:
+            return None
+
+        percent_idle = sum(agg['percent_idle'] for agg in aggs) / len(aggs)
+        tasks_done = sum(agg['tasks_done'] for agg in aggs)
+        task_duration = (sum(agg['average_task_duration'] * agg['tasks_done'] for agg in aggs) / tasks_done
+                         if tasks_done > 0 else self.autoscale_default_task_duration)
+        return percent_idle, task_duration
+
+    def _resize_pool(self, name, procs, num):
+        pool = self._scaling_pools[name]
+        running = len(procs)
+        self.logger.info('Resizing scaling pool %s from %s to %s processes (bounds %s-%s)', name, running, num,
+                         pool['min'], pool['max'])
+
+        if num > running:
+            for _ in range(num - running):
+                self._spawn_pool_process(name)
+            pool['t_last_up'] = time.time()
+        else:
+            # youngest processes go first, they hold the least warmed up caches
+            for proc in sorted(procs, key=lambda p: p.start_time, reverse=True)[:running - num]:
+                try:
+                    self.terminate_process(proc.name, kill_wait=self.autoscale_kill_wait)
+                except Exception:
+                    self.logger.exception('Failed to retire process %s. Reason: ', proc.name)
+
+        pool['t_last_resize'] = time.time()
+
+    def autoscale_pool(self, name):
+        pool = self._scaling_pools[name]
+        procs = self.pool_processes(name)
+        running = len(procs)
+
+        # bounds may have changed over RPC
+        if not pool['min'] <= running <= pool['max']:
+            self._resize_pool(name, procs, min(max(running, pool['min']), pool['max']))
+            return
+
+        load = self._pool_load(procs)
+        if load is None:
+            return
+
+        percent_idle, task_duration = load
+        backlog = pool['queue_length']()
+        concurrency = int(pool['kwargs'].get('concurrency', 1))
+        target = min(max(self.scaling_target(running, backlog, percent_idle, task_duration, concurrency),
+                         pool['min']), pool['max'])
+
+        # hysteresis: grow fast, shrink only after the pool has been mostly idle for a while
+        tnow = time.time()
+        if target > running and backlog > 0 and tnow - pool['t_last_up'] >= self.autoscale_up_wait:
+            self._resize_pool(name, procs, target)
+        elif (target < running and backlog == 0 and percent_idle >= self.autoscale_down_idle and
+              tnow - pool['t_last_resize'] >= self.autoscale_down_wait):
+            self._resize_pool(name, procs, running - max((running - target) // 2, 1))
+
     def get_by_pid(self, pid):
         for name, proc in self.items():
             if proc.pid == pid:
@@ -724,7 +966,13 @@ class ProcessGroup(IterableUserDict):
     def add_ping(self, pid, data):
         proc = self.get_by_pid(pid)
         if proc:
+            check_costs = data.pop('check_costs', None)
             proc.add_ping(data)
+            self.check_costs.add(check_costs, timestamp=data['timestamp'])
+
+    @cache(wait_sec=30)
+    def top_checks(self, interval=None, limit=20, sort_by='cpu_time'):
+        return self.check_costs.top(interval or 60 * 5, limit=limit, sort_by=sort_by)
 
     def add_events(self, pid, events):
         proc = self.get_by_pid(pid) or self.dead_group.get_by_pid(pid)
@@ -909,6 +1157,21 @@ class ProcessGroup(IterableUserDict):
                 self.limbo_group.pop(name, None)
                 self.logger.info('Limbo proc was terminated: %s', proc)
 
+    @register('action', wait_sec=10)
+    def _action_autoscale(self):
+        """
+        action: resize scaling pools according to queue backlog and load reported in pings
+        """
+        if self.action_policy != self.ACTION_POLICY_AUTOSCALE:
+            return
+        for name in self._scaling_pools.keys():
+            if self.stop_action:
+                break
+            try:
+                self.autoscale_pool(name)
+            except Exception:
+                self.logger.exception('Failed to autoscale pool %s. Reason: ', name)
+
     @register('action', wait_sec=600)
     def _action_prune_dead_info(self):
         """
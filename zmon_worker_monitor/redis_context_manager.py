@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from emu_kombu import parse_redis_conn
+from accounting import AccountedConnection
 import redis
 import logging
 import time
@@ -224,6 +225,8 @@ class RedisConnHandler(object):
             active_server = self.get_active_server()
             c = parse_redis_conn(active_server)
             logger.info('Opening new Redis connection to %s:%s/%s..', c.hostname, c.port, c.virtual_host)
-            self._conn = redis.StrictRedis(host=c.hostname, port=c.port, db=c.virtual_host,
-                                           socket_timeout=15, socket_connect_timeout=15)
+            # round trips are counted for the check running in this thread, if any
+            pool = redis.ConnectionPool(connection_class=AccountedConnection, host=c.hostname, port=c.port,
+                                        db=c.virtual_host, socket_timeout=15, socket_connect_timeout=15)
+            self._conn = redis.StrictRedis(connection_pool=pool)
             return self._conn
@@ -38,7 +38,7 @@ class ProcessControllerProxy(rpc_utils.RpcProxy):
                      'is_action_loop_running', 'get_dynamic_num_processes', 'set_dynamic_num_processes',
                      'get_action_policy', 'set_action_policy', 'available_action_policies', 'terminate_all_processes',
                      'terminate_process', 'mark_for_termination', 'ping', 'add_events', 'processes_view', 'status_view',
-                     'health_state', 'single_process_view']
+                     'health_state', 'single_process_view', 'get_shared_value', 'top_checks']
 
     def on_exit(self):
         self.get_exposed_obj().terminate_all_processes()
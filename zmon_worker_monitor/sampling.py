@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Sampling rate configuration, fetched once by the parent process and shared with all workers over RPC.
+"""
+
+from traceback import format_exc
+
+import opentracing
+import requests
+import tokens
+
+SAMPLING_RATE_UPDATE_DURATION = 60
+SAMPLING_RATE_ENTITY_ID = 'zmon-sampling-rate'
+SAMPLING_CONFIG_SHARED_NAME = 'sampling_config'
+
+
+# We manage uid tokens once when we import
+tokens.manage('uid', ['uid'])
+
+
+def get_sampling_rate_config(config, current_span):
+    """
+    Get sampling rate config from a ZMON entity or config vars.
+    Entity:
+        {
+            "id": "zmon-sampling-rate",
+            "type": "zmon_config",
+            "default_sampling": 100,
+            "critical_checks": [13, 14, 19],
+            "worker_sampling": {
+                "account-1": 50,
+                "account-2": 60,
+                "account-3": 0
+            }
+        }
+    """
+    default_sampling = int(config.get('zmon.sampling.rate', 100))
+    critical_checks = config.get('zmon.critical.checks')
+    if type(critical_checks) is not list:
+        critical_checks = critical_checks.replace(' ', '').split(',')
+
+    sampling_config = {
+        'default_sampling': default_sampling,
+        'critical_checks': critical_checks
+    }
+
+    # We try to get sampling rate entity!
+    zmon_url = config.get('zmon.url')
+    if not zmon_url:
+        current_span.set_tag('sampling_entity_used', False)
+    else:
+        current_span.set_tag('sampling_entity_used', True)
+
+        try:
+            url = '{}/api/v1/entities/{}'.format(zmon_url, SAMPLING_RATE_ENTITY_ID)
+            headers = {'Authorization': 'Bearer {}'.format(tokens.get('uid'))}
+            resp = requests.get(url, headers=headers, timeout=2)
+
+            resp.raise_for_status()
+
+            entity = resp.json()
+            sampling_config.update(entity)
+        except Exception:
+            current_span.set_tag('sampling_entity_used', False)
+            current_span.log_kv({'exception': format_exc()})
+
+    return sampling_config
+
+
+def fetch_sampling_rate_config(config):
+    """
+    Fetch the sampling config outside of any task, used by the background refresh in the parent and the workers.
+    """
+    span = opentracing.tracer.start_span(operation_name='sampling_config_refresh')
+    with span:
+        return get_sampling_rate_config(config, span)
@@ -27,6 +27,13 @@ def check_and_notify(req, alerts, task_context=None, **kwargs):
     zmontask.check_and_notify(req, alerts, task_context=task_context, **kwargs)
 
 
+def check_and_notify_batch(req, entities, alerts, task_context=None, **kwargs):
+    logger.debug('check_and_notify_batch received req=%s, entities=%d, alerts=%s, task_context=%s, ', req,
+                 len(entities), alerts, task_context)
+
+    zmontask.check_and_notify_batch(req, entities, alerts, task_context=task_context, **kwargs)
+
+
 def trial_run(req, alerts, task_context=None, **kwargs):
     logger.info('trial_run received <== check_id=%s', req['check_id'])
     logger.debug('trial_run received req=%s, alerts=%s, task_context=%s, ', req, alerts, task_context)
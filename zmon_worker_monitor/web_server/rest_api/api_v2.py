@@ -7,6 +7,8 @@ from flask_restful import reqparse, Resource
 from flask_restful_swagger import swagger
 from traceback import format_exc
 
+from zmon_worker_monitor.accounting import COST_FIELDS
+
 from .commons import ApiExtended, get_rpc_client
 from .errors import ServerError, UserError
 
@@ -130,6 +132,44 @@ class StatusListApi(Resource):
         return r
 
 
+class TopChecksApi(StatusListApi):
+
+    default_limit = 20
+
+    def __init__(self):
+        super(TopChecksApi, self).__init__()
+        self.parser.add_argument('limit', type=int, default=self.default_limit,
+                                 help='number of checks to return (defaults to %s)' % self.default_limit)
+        self.parser.add_argument('sort_by', choices=COST_FIELDS, default='cpu_time',
+                                 help='choices=(%s). defaults to cpu_time' % ', '.join(COST_FIELDS))
+
+    @swagger.operation(
+        summary='Top Checks by Cost',
+        notes='Get the checks using most of the workers\' resources in the time interval. Costs are summed up over all '
+              'workers: runs, wall_time and cpu_time in seconds, result_bytes, redis_calls (round trips) and '
+              'http_bytes (HTTP response bodies read by any plugin). Intervals are rounded to 5 minutes and cover the '
+              'last 6 hours at most.',
+        responseMessages=[
+            {'code': 400, 'message': 'Bad query parameter'},
+            {'code': 500, 'message': 'System error'}
+        ],
+    )
+    def get(self):
+        args = self.parser.parse_args(strict=True)
+        interval = args['interval'] * self.units_to_secs[args['units']]
+
+        if args['limit'] <= 0:
+            raise UserError(code=400, message='limit must be a positive number')
+
+        try:
+            client = get_rpc_client()
+            r = client.top_checks(interval=interval, limit=args['limit'], sort_by=args['sort_by'])
+        except Exception as e:
+            raise ServerError(code=500, message='Error: {}'.format(e), previous_tb=format_exc())
+
+        return {'interval': interval, 'sort_by': args['sort_by'], 'checks': r}
+
+
 class HealthApi(Resource):
 
     @swagger.operation(
@@ -163,4 +203,5 @@ api_v2.add_resource(Welcome, '/')
 api_v2.add_resource(ProcessListApi, '/processes')
 api_v2.add_resource(ProcessApi, '/processes/<string:id>')
 api_v2.add_resource(StatusListApi, '/status')
+api_v2.add_resource(TopChecksApi, '/checks/top')
 api_v2.add_resource(HealthApi, '/health')
@@ -1,30 +1,32 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import base64
-import json
+import Queue
+import itertools
 import logging
 import os
 import sys
 import threading
 import time
+from collections import deque
 from contextlib import contextmanager
+from functools import partial
 from copy import deepcopy
-from datetime import datetime, timedelta
 from operator import itemgetter
 from random import random
 from traceback import format_exc
 
 import opentracing
-import requests
 import setproctitle
-import snappy
-import tokens
 
 import settings
+from accounting import pop_check_costs
 from redis_context_manager import RedisConnHandler
 from rpc_client import get_rpc_client
-from tasks import check_and_notify, cleanup, configure_tasks, trial_run
+from sampling import SAMPLING_CONFIG_SHARED_NAME, SAMPLING_RATE_UPDATE_DURATION, fetch_sampling_rate_config
+from coalesce import get_task_coalescer
+from envelope import decode_task
+from tasks import check_and_notify, check_and_notify_batch, cleanup, configure_tasks, trial_run
 from zmon_worker_monitor import eventloghttp
 from zmon_worker_monitor.zmon_worker.common.tracing import extract_tracing_span
 from zmon_worker_monitor.zmon_worker.common.utils import get_process_cmdline
@@ -32,82 +34,259 @@ from zmon_worker_monitor.zmon_worker.common.utils import get_process_cmdline
 logger = logging.getLogger(__name__)
 
 TASK_POP_TIMEOUT = 5
+TASK_PREFETCH_DEFAULT = 1
+TASK_CONCURRENCY_DEFAULT = 1
+QUEUE_POLICY_WEIGHTED = 'weighted'
+QUEUE_POLICY_PRIORITY = 'priority'
+EXPIRED_PURGE_BATCH_DEFAULT = 0  # disabled
+EXPIRED_PURGE_MIN_INTERVAL = 5
+
+# remove the given tasks from the queue head in one server side operation
+LUA_REMOVE_TASKS = '''
+local removed = 0
+for i = 1, #ARGV do
+    removed = removed + redis.call('LREM', KEYS[1], 1, ARGV[i])
+end
+return removed
+'''
 OPENTRACING_TAG_QUEUE_RESULT = 'worker_task_result'
 OPENTRACING_QUEUE_OPERATION = 'worker_task_processing'
 OPENTRACING_TASK_EXPIRATION = 'worker_task_expire_time'
 
-SAMPLING_RATE_UPDATE_DURATION = 60
-SAMPLING_RATE_ENTITY_ID = 'zmon-sampling-rate'
+__config = None
 
 
-__config = None
+def get_config():
+    global __config
+    if __config is None:
+        __config = settings.get_external_config()
+    return __config
 
 
-# We manage uid tokens once when we import
-tokens.manage('uid', ['uid'])
+def parse_queues(queue):
+    '''
+    Parse the queue(s) a worker consumes into a list of (queue, weight)
 
+    >>> parse_queues('zmon:queue:default')
+    [('zmon:queue:default', 1)]
 
-def get_sampling_rate_config(config, current_span):
-    """
-    Get sampling rate config from a ZMON entity or config vars.
-    Entity:
-        {
-            "id": "zmon-sampling-rate",
-            "type": "zmon_config",
-            "default_sampling": 100,
-            "critical_checks": [13, 14, 19],
-            "worker_sampling": {
-                "account-1": 50,
-                "account-2": 60,
-                "account-3": 0
-            }
-        }
-    """
-    default_sampling = int(config.get('zmon.sampling.rate', 100))
-    critical_checks = config.get('zmon.critical.checks')
-    if type(critical_checks) is not list:
-        critical_checks = critical_checks.replace(' ', '').split(',')
-
-    sampling_config = {
-        'default_sampling': default_sampling,
-        'critical_checks': critical_checks
-    }
+    >>> parse_queues('zmon:queue:default@4|zmon:queue:internal')
+    [('zmon:queue:default', 4), ('zmon:queue:internal', 1)]
 
-    # We try to get sampling rate entity!
-    zmon_url = config.get('zmon.url')
-    if not zmon_url:
-        current_span.set_tag('sampling_entity_used', False)
-    else:
-        current_span.set_tag('sampling_entity_used', True)
+    >>> parse_queues('zmon:queue:default@0')
+    Traceback (most recent call last):
+        ...
+    ValueError: Queue weight must be a positive integer: zmon:queue:default@0
+    '''
+    queues = []
+    for q in queue.split('|'):
+        name, _, weight = q.strip().partition('@')
+        weight = int(weight) if weight else 1
+        if weight <= 0:
+            raise ValueError('Queue weight must be a positive integer: {}'.format(q))
+        queues.append((name, weight))
+    return queues
 
-        try:
-            url = '{}/api/v1/entities/{}'.format(zmon_url, SAMPLING_RATE_ENTITY_ID)
-            headers = {'Authorization': 'Bearer {}'.format(tokens.get('uid'))}
-            resp = requests.get(url, headers=headers, timeout=2)
 
-            resp.raise_for_status()
+def order_queues(queues, policy=QUEUE_POLICY_WEIGHTED):
+    '''
+    Return the queue names in the order they are passed to a multi key BLPOP, which pops from the first non empty
+    queue. The weighted policy draws a new weighted random order for every pop, so when all queues have work a queue
+    comes first with probability weight / sum(weights).
+
+    >>> order_queues([('a', 1), ('b', 1)], policy='priority')
+    ['a', 'b']
+
+    >>> sorted(order_queues([('a', 1), ('b', 3)]))
+    ['a', 'b']
+    '''
+    if policy == QUEUE_POLICY_PRIORITY or len(queues) == 1:
+        return [name for name, _ in queues]
+
+    # weighted random permutation (Efraimidis-Spirakis): sort by u ** (1 / w)
+    return [name for _, name in sorted(((random() ** (1.0 / w), name) for name, w in queues), reverse=True)]
+
+
+def pop_tasks(r_conn, queue, prefetch=TASK_PREFETCH_DEFAULT, timeout=TASK_POP_TIMEOUT):
+    '''
+    Pop up to prefetch raw tasks from queue, which may also be a list of queues in the order they should be tried.
+
+    We block with BLPOP until the first task arrives, the rest are taken from the head of the queue in one extra
+    round trip (LRANGE + LTRIM inside MULTI/EXEC), so they are removed atomically and no other worker can get them.
+    Prefetched tasks come from the same queue as the first one.
+
+    :return: list of (queue, msg) tuples, empty if no task was received before the timeout
+    '''
+    encoded_task = r_conn.blpop(queue, timeout)
+
+    if encoded_task is None:
+        return []
+
+    queue, msg = encoded_task
+    tasks = [(queue, msg)]
+
+    if prefetch > 1:
+        p = r_conn.pipeline()
+        p.lrange(queue, 0, prefetch - 2)
+        p.ltrim(queue, prefetch - 1, -1)
+        prefetched, _ = p.execute()
+        tasks.extend((queue, m) for m in prefetched)
+
+    return tasks
+
 
-            entity = resp.json()
-            sampling_config.update(entity)
+def requeue_tasks(r_conn, tasks):
+    '''
+    Push unstarted tasks back to the head of their queues, keeping their original order.
+
+    :param tasks: list of (queue, msg) tuples as returned by pop_tasks()
+    :return: number of tasks pushed back
+    '''
+    msgs_by_queue = {}
+    for queue, msg in tasks:
+        msgs_by_queue.setdefault(queue, []).append(msg)
+
+    for queue, msgs in msgs_by_queue.items():
+        # LPUSH inserts values one after the other at the head, so we push the last one first
+        r_conn.lpush(queue, *reversed(msgs))
+
+    return len(tasks)
+
+
+def decode_popped_tasks(tasks):
+    '''
+    Decode the popped messages once, for the coalescer and for running them.
+
+    :param tasks: list of (queue, msg) tuples as returned by pop_tasks()
+    :return: list of (queue, msg, task) tuples, task is None for messages that can not be decoded
+    '''
+    decoded = []
+    for queue, msg in tasks:
+        try:
+            task = decode_task(msg)
         except Exception:
-            current_span.set_tag('sampling_entity_used', False)
-            current_span.log_kv({'exception': format_exc()})
+            task = None
+        decoded.append((queue, msg, task))
+    return decoded
 
-    return sampling_config
 
+class SerialTaskExecutor(object):
+    '''
+    Runs each task in the calling thread, one after the other.
+    '''
 
-def get_config():
-    global __config
-    if __config is None:
-        __config = settings.get_external_config()
-    return __config
+    concurrency = 1
+
+    def submit(self, fn, *args, **kwargs):
+        fn(*args, **kwargs)
+
+    def shutdown(self):
+        pass
+
+
+class ThreadedTaskExecutor(object):
+    '''
+    Runs up to concurrency tasks at the same time in a pool of threads.
+
+    submit() blocks while all threads are busy, so the consumer never pops more tasks than it can start.
+    '''
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._tasks = Queue.Queue()
+        self._threads = []
+        for i in range(concurrency):
+            th = threading.Thread(target=self._run, name='TaskExecutor-{}'.format(i))
+            th.daemon = True
+            th.start()
+            self._threads.append(th)
+
+    def submit(self, fn, *args, **kwargs):
+        with self._cond:
+            while self._in_flight >= self.concurrency:
+                # wait with timeout: an untimed wait can not be interrupted by signals in python 2
+                self._cond.wait(1)
+            self._in_flight += 1
+        self._tasks.put((fn, args, kwargs))
+
+    def _run(self):
+        while True:
+            item = self._tasks.get()
+            if item is None:
+                return
+            fn, args, kwargs = item
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                logger.exception('Exception in task executor thread. Details: ')
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._cond.notify()
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._tasks.put(None)
 
 
-def flow_simple_queue_processor(queue='', **execution_context):
+def get_task_executor(concurrency=TASK_CONCURRENCY_DEFAULT):
+    '''
+    >>> get_task_executor(1).concurrency
+    1
+    >>> type(get_task_executor(4)).__name__
+    'ThreadedTaskExecutor'
+    '''
+    concurrency = max(int(concurrency), 1)
+    return ThreadedTaskExecutor(concurrency) if concurrency > 1 else SerialTaskExecutor()
+
+
+def _is_expired_msg(msg, now):
+    try:
+        return decode_task(msg).is_expired(now=now)
+    except Exception:
+        return False  # leave it to the worker, it will report the error
+
+
+def purge_expired_tasks(r_conn, queue, batch_size):
+    '''
+    Remove expired tasks from the head of queue, scanning batch_size tasks at a time until a batch holds no expired
+    task. Expired tasks found in a batch are removed with a single EVAL.
+
+    :return: number of tasks removed
+    '''
+    purged = 0
+    start = 0
+    now = time.time()
+
+    while True:
+        msgs = r_conn.lrange(queue, start, start + batch_size - 1)
+        expired = [m for m in msgs if _is_expired_msg(m, now)]
+
+        if expired:
+            purged += r_conn.eval(LUA_REMOVE_TASKS, 1, queue, *expired)
+
+        if not expired or len(msgs) < batch_size:
+            return purged
+
+        start += len(msgs) - len(expired)
+
+
+def flow_simple_queue_processor(queue='', prefetch=TASK_PREFETCH_DEFAULT, concurrency=TASK_CONCURRENCY_DEFAULT,
+                                policy=QUEUE_POLICY_WEIGHTED, **execution_context):
     '''
     Simple logic to connect to a redis queue, listen to messages, decode them and execute the tasks
 
-    :param queue: (str) queue to connect to
+    :param queue: (str) queue to connect to, or several queues with weights: <queue>@<weight>|<queue>@<weight>
+    :param prefetch: (int) max number of tasks taken from the queue in one round trip. Prefetched tasks wait in a
+                     local buffer, their expiration is checked right before they run and the ones not started are
+                     pushed back to the queue on shutdown
+    :param concurrency: (int) max number of tasks running at the same time in this process. Checks are mostly I/O
+                        bound, so a few threads per process give more checks in flight per GB of RAM than more
+                        processes
+    :param policy: (str) how several queues are consumed: weighted (random order proportional to weights) or
+                   priority (always in the given order)
     :param execution_context: (dict) other kwargs that may have been passed when worker was spawn
     :return:
 
@@ -149,15 +328,22 @@ def flow_simple_queue_processor(queue='', **execution_context):
         u'id': u'check-277-de_zalando:access-control-kit-1409826332.92'
     }
 
+    3. Messages may also use the compact binary envelope from envelope.py: a flat msgpack header with the expiry as
+    epoch seconds, followed by the msgpack packed args and kwargs, which are only decoded when the task runs.
+
     '''
 
-    known_tasks = {'check_and_notify': check_and_notify, 'trial_run': trial_run, 'cleanup': cleanup}
+    known_tasks = {'check_and_notify': check_and_notify, 'check_and_notify_batch': check_and_notify_batch,
+                   'trial_run': trial_run, 'cleanup': cleanup}
 
     # get configuration and configure tasks
     config = get_config()
     configure_tasks(config)
 
-    logger.info('Connecting simple_queue_consumer to queue=%s, execution_context=%s', queue, execution_context)
+    logger.info('Connecting simple_queue_consumer to queue=%s, policy=%s, prefetch=%s, concurrency=%s, '
+                'execution_context=%s', queue, policy, prefetch, concurrency, execution_context)
+
+    queues = parse_queues(queue)
 
     RedisConnHandler.configure(**dict(config))
 
@@ -165,15 +351,66 @@ def flow_simple_queue_processor(queue='', **execution_context):
     eventloghttp.enable_http(config.get('eventlog.http', False))
 
     reactor = FlowControlReactor.get_instance()
+    reactor.subscribe_shared_value(
+        SAMPLING_CONFIG_SHARED_NAME, partial(fetch_sampling_rate_config, config),
+        fallback_refresh_sec=int(config.get('zmon.sampling.update.rate', SAMPLING_RATE_UPDATE_DURATION)))
 
     conn_handler = RedisConnHandler.get_instance()
 
-    expired_count = 0
+    prefetch = max(int(prefetch), 1)
+    buffered_tasks = deque()
+    executor = get_task_executor(concurrency)
+    coalescer = get_task_coalescer(config)
+
+    try:
+        _consume_tasks(queues, policy, prefetch, buffered_tasks, known_tasks, config, reactor, conn_handler,
+                       executor, coalescer)
+    finally:
+        executor.shutdown()
+        if buffered_tasks:
+            try:
+                requeued = requeue_tasks(conn_handler.get_conn(), [(q, msg) for q, msg, _ in buffered_tasks])
+                logger.warning('Pushed %s unstarted tasks back to queue=%s', requeued, queue)
+            except Exception:
+                logger.exception('Failed to push %s unstarted tasks back to queue=%s. Details: ',
+                                 len(buffered_tasks), queue)
+
+
+def _execute_task(task_queue, known_tasks, reactor, task, span, sampling_config, expired_counter, coalescer=None,
+                  coalesced_counter=None):
+    with span:
+        try:
+            # a newer task for the same check and entity was already seen: only the newest one matters
+            if coalescer is not None and coalescer.is_stale(task):
+                span.set_tag(OPENTRACING_TAG_QUEUE_RESULT, 'coalesced')
+                coalesced_count = next(coalesced_counter)
+                if coalesced_count % 500 == 0:
+                    logger.warning('coalesced tasks count: %s', coalesced_count)
+                return
+
+            is_processed = process_message(
+                task_queue, known_tasks, reactor, task, current_span=span, sampling_config=sampling_config)
+            if is_processed:
+                span.set_tag(OPENTRACING_TAG_QUEUE_RESULT, 'success')
+            else:
+                span.set_tag(OPENTRACING_TAG_QUEUE_RESULT, 'expired')
+                expired_count = next(expired_counter)
+                if expired_count % 500 == 0:
+                    logger.warning('expired tasks count: %s', expired_count)
+        except Exception:
+            span.set_tag(OPENTRACING_TAG_QUEUE_RESULT, 'error')
+            span.set_tag('error', True)
+            span.log_kv({'exception': format_exc()})
+
+
+def _consume_tasks(queues, policy, prefetch, buffered_tasks, known_tasks, config, reactor, conn_handler, executor,
+                   coalescer=None):
+    expired_counter = itertools.count(1)  # shared by executor threads, next() on it is atomic
+    coalesced_counter = itertools.count(1)
     count = 0
 
-    sampling_rate_last_updated = datetime.utcnow()
-    sampling_config = None
-    sampling_update_rate = int(config.get('zmon.sampling.update.rate', SAMPLING_RATE_UPDATE_DURATION))
+    purge_batch_size = int(config.get('zmon.expired.purge.batch', EXPIRED_PURGE_BATCH_DEFAULT))
+    last_purge = 0
 
     while True:
         try:
@@ -182,51 +419,43 @@ def flow_simple_queue_processor(queue='', **execution_context):
 
                 r_conn = ch.get_healthy_conn()
 
-                encoded_task = r_conn.blpop(queue, TASK_POP_TIMEOUT)
+                if not buffered_tasks:
+                    buffered_tasks.extend(decode_popped_tasks(
+                        pop_tasks(r_conn, order_queues(queues, policy) if len(queues) > 1 else queues[0][0], prefetch)))
+                    if coalescer is not None:
+                        coalescer.observe(task for _, _, task in buffered_tasks if task is not None)
 
-                if encoded_task is None:
+                if not buffered_tasks:
                     raise ch.IdleLoopException('No task received')
 
-                queue, msg = encoded_task
+                task_queue, msg, task = buffered_tasks.popleft()
 
-                if msg[:1] != '{':
-                    msg = snappy.decompress(msg)
+                if task is None:
+                    task = decode_task(msg)  # raises again for the message that could not be decoded
 
-                msg_obj = json.loads(msg)
+                # an expired task is a sign of backlog: drop the expired ones in bulk instead of one BLPOP at a time
+                if purge_batch_size > 0 and task.is_expired() and time.time() - last_purge > EXPIRED_PURGE_MIN_INTERVAL:
+                    last_purge = time.time()
+                    purged = purge_expired_tasks(r_conn, task_queue, purge_batch_size)
+                    if purged:
+                        details = 'Purged {} expired tasks from queue={} in {:.3f}s'.format(
+                            purged, task_queue, time.time() - last_purge)
+                        logger.warning(details)
+                        reactor.add_event('flow_simple_queue_processor.purge_expired_tasks', 'ACTION', details)
 
-                # OpenTracing: picking up trace from scheduler
-                trace = msg_obj.get('properties', {}).get('trace', {})
+                # while lagging behind, look ahead in the queue for newer tasks of the same check and entity
+                if coalescer is not None and coalescer.is_lagging(task):
+                    coalescer.scan(r_conn, task_queue)
 
-                span = extract_tracing_span(trace)
+                # OpenTracing: picking up trace from scheduler
+                span = extract_tracing_span(task.trace)
                 span.set_operation_name(OPENTRACING_QUEUE_OPERATION)
 
-                # Get sampling rates. We update every minute.
-                if sampling_config is None or (
-                        (datetime.utcnow() - sampling_rate_last_updated).seconds > sampling_update_rate):
-                    try:
-                        sampling_rate_last_updated = datetime.utcnow()
-                        sampling_config = get_sampling_rate_config(config, span)
-                        span.log_kv({'sampling_config': sampling_config})
-                        span.set_tag('sampling_rate_updated', True)
-                    except Exception:
-                        span.set_tag('sampling_rate_updated', False)
-                        span.log_kv({'exception': format_exc()})
+                # Sampling rates are fetched by the parent process and kept up to date by the reactor
+                sampling_config = reactor.get_shared_value(SAMPLING_CONFIG_SHARED_NAME)
 
-                with span:
-                    try:
-                        is_processed = process_message(
-                            queue, known_tasks, reactor, msg_obj, current_span=span, sampling_config=sampling_config)
-                        if is_processed:
-                            span.set_tag(OPENTRACING_TAG_QUEUE_RESULT, 'success')
-                        else:
-                            span.set_tag(OPENTRACING_TAG_QUEUE_RESULT, 'expired')
-                            expired_count += 1
-                            if expired_count % 500 == 0:
-                                logger.warning('expired tasks count: %s', expired_count)
-                    except Exception:
-                        span.set_tag(OPENTRACING_TAG_QUEUE_RESULT, 'error')
-                        span.set_tag('error', True)
-                        span.log_kv({'exception': format_exc()})
+                executor.submit(_execute_task, task_queue, known_tasks, reactor, task, span, sampling_config,
+                                expired_counter, coalescer, coalesced_counter)
 
                 count += 1
 
@@ -244,7 +473,7 @@ def flow_simple_queue_processor(queue='', **execution_context):
             # TODO: some exit condition on failure: maybe when number of consecutive failures > n ?
 
 
-def process_message(queue, known_tasks, reactor, msg_obj, current_span, sampling_config=None):
+def process_message(queue, known_tasks, reactor, task, current_span, sampling_config=None):
     """
     Proccess and execute a task.
 
@@ -257,8 +486,8 @@ def process_message(queue, known_tasks, reactor, msg_obj, current_span, sampling
     :param reactor: Instance of FlowControlReactor
     :type reactor: FlowControlReactor
 
-    :param msg_obj: Dictionary that contains the task to process
-    :type msg_obj: dict
+    :param task: The decoded task to process, args and kwargs are decoded only if the task runs
+    :type task: envelope.TaskEnvelope
 
     :param current_span: Current OpenTracing span.
     :type current_span: opentracing.Span
@@ -269,59 +498,38 @@ def process_message(queue, known_tasks, reactor, msg_obj, current_span, sampling
     :return: Return True if the message was processed successfully
     :rtype: bool
     """
-    msg_body = None
-    body_encoding = msg_obj.get('properties', {}).get('body_encoding')
-    if body_encoding == "nested":
-        msg_body = msg_obj["body"]
-    elif body_encoding == "base64":
-        msg_body = json.loads(base64.b64decode(msg_obj['body']))
-    elif body_encoding == "snappy":
-        msg_body = json.loads(snappy.decompress(base64.b64decode(msg_obj['body'])))
-
-    taskname = msg_body['task']
-    func_args = msg_body['args']
-    func_kwargs = msg_body['kwargs']
-    timelimit = msg_body.get('timelimit')  # [90, 60]
-    t_hard, t_soft = timelimit
+    taskname = task.task
+    t_hard, t_soft = task.timelimit  # [90, 60]
 
     current_span.set_tag('taskname', taskname)
 
+    check_id = task.check_id if task.check_id is not None else 'XX'
+
+    current_span.set_tag('check_id', check_id)
+
+    # discard tasks that are expired, from header metadata only: the body is never decoded for them
+    if task.is_expired():
+        current_span.set_tag(OPENTRACING_TASK_EXPIRATION, str(task.expires))
+        logger.debug('Discarding task due to time expiration. expire_time: %s, check_id: %s, task_id: %s',
+                     task.expires, check_id, task.id)
+        return False
+
     # we pass task metadata as a kwargs right now, later will be put in the function context by decorator
     task_context = {
         'queue': queue,
         'taskname': taskname,
 
-        'delivery_info': msg_obj.get('properties', {}).get('delivery_info', {}),
+        'delivery_info': task.delivery_info,
         'task_properties': {
             'task': taskname,
-            'id': msg_body.get('id', ''),
-            'expires': msg_body.get('expires'),  # '2014-09-04T10:27:32.91915200:00'
-            'timelimit': timelimit,  # [90, 60]
-            'utc': msg_body.get('utc', True),
+            'id': task.id,
+            'expires': task.expires,  # epoch seconds
+            'timelimit': task.timelimit,  # [90, 60]
         },
     }
 
-    # discard tasks that are expired if expire metadata comes with the message
-    cur_time = datetime.utcnow() if task_context['task_properties']['utc'] else datetime.now()
-    expire_time = datetime.strptime(
-        msg_body.get('expires').replace('Z', '').rsplit('+', 1)[0], '%Y-%m-%dT%H:%M:%S.%f') \
-        if msg_body.get('expires') else cur_time + timedelta(seconds=10)
-
-    check_id = (msg_body['args'][0].get('check_id', 'xx') if len(msg_body['args']) > 0 and isinstance(
-        msg_body['args'][0], dict) else 'XX')
-
-    current_span.set_tag('check_id', check_id)
-
-    if cur_time >= expire_time:
-        current_span.set_tag(OPENTRACING_TASK_EXPIRATION, str(expire_time))
-        logger.warn(
-            'Discarding task due to time expiration. cur_time: %s , expire_time: %s, check_id: %s, '
-            'msg_body["expires"]=%s  ----  msg_body=%s',
-            cur_time, expire_time, check_id, msg_body.get('expires'), msg_body)
-        return False
-
-    with reactor.enter_task_context(taskname, t_hard, t_soft):
-        known_tasks[taskname](*func_args, task_context=task_context, sampling_config=sampling_config, **func_kwargs)
+    with reactor.enter_task_context(taskname, t_hard, t_soft, queue=queue):
+        known_tasks[taskname](*task.args, task_context=task_context, sampling_config=sampling_config, **task.kwargs)
     return True
 
 
@@ -349,6 +557,8 @@ class FlowControlReactor(object):
         'tasks_done': 0,
         'percent_idle': 0,
         'task_duration': 0.0,
+        'tasks_by_queue': {},
+        'check_costs': {},
     }
 
     _event_template = {
@@ -362,6 +572,8 @@ class FlowControlReactor(object):
     _max_keep_events = 5000
     events_timedelta = 60  # send events every X seconds
 
+    shared_timedelta = 5  # poll shared values from the parent every X seconds
+
     def __init__(self):
         # self.task_agg_info = {}  # we could aggregate some info about how tasks are running in this worker
         assert not self._initialized and self._can_init, 'Call get_instance() to instantiate'
@@ -370,11 +582,13 @@ class FlowControlReactor(object):
         self._rpc_client = get_rpc_client('http://{}:{}{}'.format(settings.RPC_SERVER_CONF['HOST'],
                                                                   settings.RPC_SERVER_CONF['PORT'],
                                                                   settings.RPC_SERVER_CONF['RPC_PATH']))
-        self._current_task_by_thread = {}  # {thread_id: (taskname, t_hard, t_soft, tstart)}
+        self._current_tasks = {}  # {task_id: (taskname, t_hard, t_soft, tstart, queue)}
+        self._task_ids = itertools.count()
         self.action_on = False
         self._thread = threading.Thread(target=self.action_loop)
         self._thread.daemon = True
-        self._actions = (self.action_hard_kill, self.action_send_ping, self.action_send_events)
+        self._actions = (self.action_hard_kill, self.action_send_ping, self.action_send_events,
+                         self.action_refresh_shared_values)
 
         self._ping_data = deepcopy(self._ping_template)
         self._ping_lock = threading.RLock()
@@ -386,6 +600,11 @@ class FlowControlReactor(object):
         self._event_lock = threading.RLock()
         self._t_last_events = time.time() + self.events_timedelta * random()  # randomize event start
 
+        self._shared_values = {}  # {name: {'version': version, 'value': value}}
+        self._shared_fallbacks = {}  # {name: (fetch, refresh_sec)}
+        self._t_shared_fallback = {}  # {name: t_last_fetch}
+        self._t_last_shared = 0
+
     @classmethod
     def get_instance(cls):
         if cls._instance is None:
@@ -394,19 +613,19 @@ class FlowControlReactor(object):
         return cls._instance
 
     @contextmanager
-    def enter_task_context(self, taskname, t_hard, t_soft):
-        self.task_received(taskname, t_hard, t_soft)
+    def enter_task_context(self, taskname, t_hard, t_soft, queue=None):
+        task_id = self.task_received(taskname, t_hard, t_soft, queue=queue)
         try:
             yield self
         except Exception:
-            self.task_ended(exc=format_exc())  # self.task_ended(exc=e)
+            self.task_ended(task_id, exc=format_exc())  # self.task_ended(exc=e)
             raise
         else:
-            self.task_ended()
+            self.task_ended(task_id)
 
     def action_hard_kill(self):
         """ hard kill logic """
-        for th_name, (taskname, t_hard, t_soft, ts) in self._current_task_by_thread.copy().items():
+        for task_id, (taskname, t_hard, t_soft, ts, _) in self._current_tasks.copy().items():
             if time.time() > ts + t_hard:
                 msg = 'Hard kill request received for worker pid={}, task={}, t_hard={}, cmdline={}'.format(
                     self._pid, taskname, t_hard, get_process_cmdline(self._pid)
@@ -414,7 +633,7 @@ class FlowControlReactor(object):
                 logger.warn(msg)
                 self.add_event('FlowControlReactor.action_hard_kill', 'ACTION', msg)
                 self._rpc_client.mark_for_termination(self._pid)  # rpc call to parent asking for a kill
-                self._current_task_by_thread.pop(th_name, {})
+                self._current_tasks.pop(task_id, {})
 
     def action_send_ping(self):
 
@@ -431,6 +650,7 @@ class FlowControlReactor(object):
             data['timestamp'] = t_now
             data['timedelta'] = t_now - self._t_last_ping
             data['percent_idle'] = (idle * 100.0) / total if total > 0 else 0
+            data['check_costs'] = pop_check_costs()
 
             # send ping data
             if self._num_ping_sent >= 0:
@@ -441,7 +661,7 @@ class FlowControlReactor(object):
         else:
             # update idle info
             with self._ping_lock:
-                self._ping_idle_points[0] += 1 if not self._current_task_by_thread else 0  # idle
+                self._ping_idle_points[0] += 1 if not self._current_tasks else 0  # idle
                 self._ping_idle_points[1] += 1  # total
 
     def action_send_events(self):
@@ -466,6 +686,42 @@ class FlowControlReactor(object):
                 self._rpc_client.add_events(self._pid, events)  # rpc call to send events to parent
             self._t_last_events = t_now
 
+    def subscribe_shared_value(self, name, fallback, fallback_refresh_sec=SAMPLING_RATE_UPDATE_DURATION):
+        """
+        Keep a local copy of a value the parent process fetches for all workers. The fallback is called from this
+        worker (still in the reactor thread) while the parent can not serve the value, e.g. running without RPC.
+        The value is fetched on the next pass of the reactor.
+        """
+        self._shared_fallbacks[name] = (fallback, fallback_refresh_sec)
+        self._t_last_shared = 0
+
+    def get_shared_value(self, name, default=None):
+        # cheap enough for the task loop: just a dict lookup, the value is replaced as a whole by the reactor thread
+        return self._shared_values.get(name, {}).get('value', default)
+
+    def action_refresh_shared_values(self):
+        t_now = time.time()
+
+        # the timer only starts with the first subscription
+        if not self._shared_fallbacks or t_now - self._t_last_shared < self.shared_timedelta:
+            return
+
+        self._t_last_shared = t_now
+
+        for name, (fallback, refresh_sec) in self._shared_fallbacks.items():
+            local = self._shared_values.get(name, {'version': 0})
+            try:
+                # rpc call to parent, the value is only sent back if our version is outdated
+                shared = self._rpc_client.get_shared_value(name, local['version'])
+            except Exception:
+                shared = {'version': 0}
+
+            if 'value' in shared:
+                self._shared_values[name] = shared
+            elif shared['version'] == 0 and t_now - self._t_shared_fallback.get(name, 0) >= refresh_sec:
+                self._t_shared_fallback[name] = t_now
+                self._shared_values[name] = {'version': 0, 'value': fallback()}
+
     def add_event(self, origin, type, body, repeats=1):
         with self._event_lock:
             self._event_list.append(dict(origin=origin, type=type, body=body, repeats=repeats, timestamp=time.time()))
@@ -491,19 +747,25 @@ class FlowControlReactor(object):
     def stop(self):
         self.action_on = False
 
-    def task_received(self, taskname, t_hard, t_soft):
-        # this sets a timer for this task, there is only one task per thread, and right now only main thread produce
-        self._current_task_by_thread[threading.currentThread().getName()] = (taskname, t_hard, t_soft, time.time())
+    def task_received(self, taskname, t_hard, t_soft, queue=None):
+        # this sets a timer for this task, several tasks may run at once when the worker uses a threaded executor
+        task_id = next(self._task_ids)
+        self._current_tasks[task_id] = (taskname, t_hard, t_soft, time.time(), queue)
+        return task_id
 
-    def task_ended(self, exc=None):
+    def task_ended(self, task_id, exc=None):
         # delete the task from the list
-        task_detail = self._current_task_by_thread.pop(threading.currentThread().getName(), ())
+        task_detail = self._current_tasks.pop(task_id, ())
         if not exc:
             # update ping data
             with self._ping_lock:
                 self._ping_data['tasks_done'] += 1
-                if len(list(task_detail)) >= 4:
+                if len(list(task_detail)) >= 5:
                     self._ping_data['task_duration'] += time.time() - list(task_detail)[3]
+                    queue = task_detail[4]
+                    if queue:
+                        tasks_by_queue = self._ping_data['tasks_by_queue']
+                        tasks_by_queue[queue] = tasks_by_queue.get(queue, 0) + 1
         else:
             # register error event
             self.add_event('FlowControlReactor.task_ended', 'ERROR', str(exc))
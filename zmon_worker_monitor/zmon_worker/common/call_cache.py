@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Short lived cache of plugin calls shared by all the tasks of a worker.
+
+Checks opt in per call: ``cached(ttl=30).entities().search_all({'type': 'instance'})`` runs the search once every 30
+seconds for all entities of the check, instead of once per entity. Calls are keyed by the check, the user who created
+it, plugin function, what its factory bound into it (e.g. the base URL of http() or the shards of sql()), its
+arguments, method and the method arguments. Plugin functions whose bound arguments are not known are cached per
+entity.
+
+Values are kept pickled: every caller gets its own copy and the memory used by the cache is known. Values that can
+not be pickled and exceptions are not cached.
+"""
+
+import cPickle as pickle
+import functools
+import json
+import threading
+import time
+from collections import OrderedDict
+
+CALL_CACHE_SIZE = 1024
+CALL_CACHE_BYTES = 64 * 1024 * 1024
+CALL_CACHE_MAX_TTL = 300
+# seconds between lookups while waiting for the same call running in another task
+CALL_PENDING_WAIT = 1
+
+# bound arguments not changing what a plugin function returns
+CALL_KEY_IGNORED = frozenset(['deadline'])
+
+
+def call_key(*parts):
+    '''
+    >>> call_key('entities', (), {}, 'search_all', ({'type': 'a', 'id': 1},), {})
+    '["entities",[],{},"search_all",[{"id":1,"type":"a"}],{}]'
+    '''
+    return json.dumps(parts, sort_keys=True, separators=(',', ':'), default=repr)
+
+
+def bound_arguments(func):
+    '''
+    (function, arguments, keyword arguments) a plugin function factory bound into func with propartial() or
+    functools.partial, None if they are not known.
+
+    >>> bound_arguments(functools.partial(int, base=2))
+    (<type 'int'>, (), {'base': 2})
+    >>> from zmon_worker_monitor.zmon_worker.common.eval import ProtectedPartial
+    >>> bound_arguments(ProtectedPartial(int, base=2))
+    (<type 'int'>, (), {'base': 2})
+    >>> bound_arguments(int) is None
+    True
+    '''
+    if isinstance(func, functools.partial):
+        return func.func, func.args, func.keywords or {}
+    # ProtectedPartial of common.eval and of the plugin adapters
+    bound = getattr(func, '__bound__', None)
+    return bound() if bound is not None else None
+
+
+class CallCache(object):
+    '''
+    Thread safe LRU cache of call results with a time to live, bounded by the number of entries and their pickled
+    size. Concurrent misses of the same key run the call only once, calls with a ttl of 0 are not cached nor shared.
+
+    >>> cache = CallCache(maxsize=2)
+    >>> calls = []
+    >>> def call(x):
+    ...     calls.append(x)
+    ...     return [x]
+    >>> [cache.get(k, 60, call, k) for k in ('a', 'b', 'a', 'c', 'b')]
+    [['a'], ['b'], ['a'], ['c'], ['b']]
+    >>> calls
+    ['a', 'b', 'c', 'b']
+    >>> sorted(cache.stats().items())
+    [('bytes', 20), ('evictions', 2), ('hit_rate', 0.2), ('hits', 1), ('misses', 4), ('size', 2)]
+    >>> cache.get('d', 0, call, 'd'), cache.get('d', 0, call, 'd'), calls[-2:]
+    (['d'], ['d'], ['d', 'd'])
+    '''
+
+    def __init__(self, maxsize=CALL_CACHE_SIZE, maxbytes=CALL_CACHE_BYTES, max_ttl=CALL_CACHE_MAX_TTL):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.max_ttl = max_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._values = OrderedDict()  # {key: (expires, pickled value)}, most recently used last
+        self._pending = {}  # {key: threading.Event} of the calls running right now
+        self._lock = threading.Lock()
+
+    def get(self, key, ttl, func, *args, **kwargs):
+        ttl = min(ttl, self.max_ttl)
+        if ttl <= 0:
+            return func(*args, **kwargs)
+        while True:
+            with self._lock:
+                entry = self._lookup(key)
+                if entry is not None:
+                    self.hits += 1
+                    return pickle.loads(entry[1])
+                pending = self._pending.get(key)
+                if pending is None:
+                    self.misses += 1
+                    self._pending[key] = threading.Event()
+                    break
+            # other task is running the same call, wait for its result. It may fail, then we try ourselves.
+            pending.wait(CALL_PENDING_WAIT)
+
+        try:
+            value = func(*args, **kwargs)
+            self._store(key, ttl, value)
+            return value
+        finally:
+            with self._lock:
+                self._pending.pop(key).set()
+
+    def _lookup(self, key):
+        entry = self._values.pop(key, None)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            self.bytes -= len(entry[1])
+            return None
+        self._values[key] = entry
+        return entry
+
+    def _store(self, key, ttl, value):
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        try:
+            pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return
+        if len(pickled) > self.maxbytes:
+            return
+        with self._lock:
+            self._values[key] = (time.time() + ttl, pickled)
+            self.bytes += len(pickled)
+            self._evict()
+
+    def configure(self, maxsize=CALL_CACHE_SIZE, maxbytes=CALL_CACHE_BYTES, max_ttl=CALL_CACHE_MAX_TTL):
+        with self._lock:
+            self.maxsize = maxsize
+            self.maxbytes = maxbytes
+            self.max_ttl = max_ttl
+            self._evict()
+
+    def _evict(self):
+        while self._values and (len(self._values) > self.maxsize or self.bytes > self.maxbytes):
+            _, (_, pickled) = self._values.popitem(last=False)
+            self.bytes -= len(pickled)
+            self.evictions += 1
+
+    def stats(self):
+        calls = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._values),
+                'bytes': self.bytes, 'hit_rate': round(float(self.hits) / calls, 3) if calls else 0.0}
+
+
+call_cache = CallCache()
+
+
+class CachedCalls(object):
+    '''
+    The cached() function of the check context: plugin functions are looked up as attributes, method calls on the
+    objects they return are cached. scope holds what results depend on besides the call, e.g. the check id.
+
+    >>> class Entities(object):
+    ...     def __init__(self, url):
+    ...         self.url = url
+    ...     def search_all(self, q):
+    ...         return [{'url': self.url, 'type': q['type']}]
+    >>> cache = CallCache()
+    >>> cached = CachedCalls({'entities': functools.partial(Entities, url='a')}, ttl=10, cache=cache)
+    >>> cached.entities().search_all({'type': 'instance'})
+    [{'url': 'a', 'type': 'instance'}]
+    >>> cached.entities().search_all({'type': 'instance'}) and cached._cache.hits
+    1
+    >>> built = []
+    >>> lazy = CachedCalls({'entities': lambda: built.append(1) or Entities('a')}, ttl=10, cache=cache)
+    >>> lazy.entities().search_all({'type': 'instance'}) and lazy.entities().search_all({'type': 'instance'})
+    [{'url': 'a', 'type': 'instance'}]
+    >>> built
+    [1]
+    >>> other = CachedCalls({'entities': functools.partial(Entities, url='b')}, ttl=10, cache=cache)
+    >>> other.entities().search_all({'type': 'instance'})
+    [{'url': 'b', 'type': 'instance'}]
+    >>> cached.json
+    Traceback (most recent call last):
+        ...
+    AttributeError: No plugin function json to cache
+    '''
+
+    def __init__(self, functions, ttl=30, cache=None, scope=(), entity_id=None):
+        self._functions = functions
+        self._ttl = ttl
+        self._cache = call_cache if cache is None else cache
+        self._scope = tuple(scope)
+        self._entity_id = entity_id
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._functions:
+            raise AttributeError('No plugin function {} to cache'.format(name))
+        func = self._functions[name]
+        bound = bound_arguments(func)
+        if bound is None:
+            bound = ('entity', self._entity_id)
+        else:
+            bound = (bound[0], bound[1], {k: v for k, v in bound[2].items() if k not in CALL_KEY_IGNORED})
+        return _CachedFunction(self._cache, self._ttl, self._scope + (name, bound), func)
+
+
+class _CachedFunction(object):
+
+    def __init__(self, cache, ttl, key, func):
+        self._cache = cache
+        self._ttl = ttl
+        self._key = key
+        self._func = func
+
+    def __call__(self, *args, **kwargs):
+        return _CachedObject(self._cache, self._ttl, self._key + (args, kwargs),
+                             functools.partial(self._func, *args, **kwargs))
+
+
+class _CachedObject(object):
+    '''
+    Object of a plugin function, built only when one of its method calls is not cached: clients (e.g. boto or
+    kubernetes) are not created on every hit. Attributes other than methods are not available.
+    '''
+
+    def __init__(self, cache, ttl, key, factory):
+        self._cache = cache
+        self._ttl = ttl
+        self._key = key
+        self._factory = factory
+        self._built = None
+
+    def _obj(self):
+        if self._built is None:
+            self._built = self._factory()
+        return self._built
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            return getattr(self._obj(), name)
+
+        def cached_method(*args, **kwargs):
+            key = call_key(*(self._key + (name, args, kwargs)))
+            return self._cache.get(key, self._ttl, lambda: getattr(self._obj(), name)(*args, **kwargs))
+
+        return cached_method
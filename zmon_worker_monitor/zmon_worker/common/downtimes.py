@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Downtimes of all alerts and entities, kept by every worker process.
+
+Downtimes are stored by the controller in redis: the set zmon:downtimes of alert ids, the sets zmon:downtimes:<alert>
+of entity ids and the hashes zmon:downtimes:<alert>:<entity> of downtime id to its JSON. Almost no entities have
+downtimes, so instead of reading them for every alert evaluation the index loads all of them and reloads when:
+
+- the version key zmon:downtimes:version changes, checked at most every check_interval seconds,
+- a keyspace notification for one of the zmon:downtimes keys arrives (needs notify-keyspace-events on the redis
+  server, e.g. "Kghs"),
+- the index is older than max_age seconds, for writers not touching the version key.
+
+Whether a downtime is active only depends on the time, its transitions are detected on every lookup.
+"""
+
+import json
+import logging
+import threading
+import time
+
+from zmon_worker_monitor.zmon_worker.common.utils import registered_script
+
+DOWNTIMES_KEY = 'zmon:downtimes'
+DOWNTIMES_VERSION_KEY = 'zmon:downtimes:version'
+ACTIVE_DOWNTIMES_KEY = 'zmon:active_downtimes'
+
+DOWNTIMES_CHECK_INTERVAL = 1
+DOWNTIMES_MAX_AGE = 10
+
+# Removes an expired downtime: KEYS are its hash, the entities of the alert, all alerts with downtimes, the active
+# downtimes and the version key, ARGV the downtime id, entity id, alert id and the active downtimes member. Empty
+# hashes and sets are removed by redis.
+LUA_DOWNTIME_EXPIRED = '''
+redis.call('SREM', KEYS[4], ARGV[4])
+redis.call('HDEL', KEYS[1], ARGV[1])
+if redis.call('HLEN', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[2], ARGV[2])
+    if redis.call('SCARD', KEYS[2]) == 0 then
+        redis.call('SREM', KEYS[3], ARGV[3])
+    end
+end
+return redis.call('INCR', KEYS[5])
+'''
+
+logger = logging.getLogger(__name__)
+
+
+class DowntimeIndex(object):
+    '''
+    >>> from mock import MagicMock
+    >>> con = MagicMock()
+    >>> con.pipeline.return_value.execute.side_effect = [[None, set(['1'])], [set(['e1'])],
+    ...                                                  [{'d1': '{"start_time": 0, "end_time": 2000000000}'}]]
+    >>> index = DowntimeIndex()
+    >>> index.active(con, 1, 'e1') == [{'start_time': 0, 'end_time': 2000000000, 'id': 'd1'}]
+    True
+    >>> index.active(con, 1, 'e2'), index.active(con, 2, 'e1')
+    ([], [])
+    >>> con.pipeline.return_value.execute.call_count, con.sadd.call_count
+    (3, 1)
+    '''
+
+    def __init__(self, check_interval=DOWNTIMES_CHECK_INTERVAL, max_age=DOWNTIMES_MAX_AGE, notifications=False):
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self.notifications = notifications
+        self.reloads = 0
+        self._downtimes = {}  # {(alert id, entity id): {downtime id: downtime}}
+        self._version = None
+        self._loaded = 0  # time of the last reload
+        self._checked = 0  # time of the last version check
+        self._stale = True
+        self._marked_active = set()  # (alert id, entity id, downtime id) this process wrote to zmon:active_downtimes
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def configure(self, check_interval=DOWNTIMES_CHECK_INTERVAL, max_age=DOWNTIMES_MAX_AGE, notifications=False):
+        with self._lock:
+            self.check_interval = check_interval
+            self.max_age = max_age
+            self.notifications = notifications
+            self._stale = True
+
+    def active(self, con, alert_id, entity_id):
+        '''
+        Active downtimes of the entity, with their id. Expired downtimes are removed from redis.
+        '''
+        self._refresh(con)
+        pair = (str(alert_id), str(entity_id))
+        downtimes = self._downtimes.get(pair)
+        if not downtimes:
+            return []
+
+        result = []
+        now = time.time()
+        for uuid, d in downtimes.items():
+            try:
+                # PF-3604 First check if downtime is active, otherwise check if it's expired, else: it's a
+                # future downtime.
+                member = '{}:{}:{}'.format(alert_id, entity_id, uuid)
+                if now > d['start_time'] and now < d['end_time']:
+                    result.append(dict(d, id=uuid))
+                    if pair + (uuid,) not in self._marked_active:
+                        con.sadd(ACTIVE_DOWNTIMES_KEY, member)
+                        self._marked_active.add(pair + (uuid,))
+                elif now >= d['end_time']:
+                    # If downtime is over, we can remove its definition from redis.
+                    expire = registered_script(con, LUA_DOWNTIME_EXPIRED)
+                    expire(keys=['{}:{}:{}'.format(DOWNTIMES_KEY, alert_id, entity_id),
+                                 '{}:{}'.format(DOWNTIMES_KEY, alert_id), DOWNTIMES_KEY, ACTIVE_DOWNTIMES_KEY,
+                                 DOWNTIMES_VERSION_KEY],
+                           args=[uuid, entity_id, alert_id, member], client=con)
+                    downtimes.pop(uuid, None)
+                    self._marked_active.discard(pair + (uuid,))
+            except Exception:
+                logger.exception('Exception while evaluating downtime!')
+        return result
+
+    def _refresh(self, con):
+        if self.notifications and self._listener is None:
+            self._start_listener(con)
+
+        now = time.time()
+        if not self._stale and now - self._loaded < self.max_age and now - self._checked < self.check_interval:
+            return
+        with self._lock:
+            now = time.time()
+            if not self._stale and now - self._loaded < self.max_age:
+                if now - self._checked < self.check_interval:
+                    return  # other thread checked meanwhile
+                self._checked = now
+                if con.get(DOWNTIMES_VERSION_KEY) == self._version:
+                    return
+            self._load(con)
+
+    def _load(self, con):
+        # changes while loading are caught by the next version check or notification
+        started = time.time()
+        self._stale = False
+
+        p = con.pipeline(transaction=False)
+        p.get(DOWNTIMES_VERSION_KEY)
+        p.smembers(DOWNTIMES_KEY)
+        version, alert_ids = p.execute()
+        alert_ids = list(alert_ids)
+
+        for alert_id in alert_ids:
+            p.smembers('{}:{}'.format(DOWNTIMES_KEY, alert_id))
+        pairs = [(alert_id, entity_id) for alert_id, entity_ids in zip(alert_ids, p.execute() if alert_ids else [])
+                 for entity_id in entity_ids]
+
+        for alert_id, entity_id in pairs:
+            p.hgetall('{}:{}:{}'.format(DOWNTIMES_KEY, alert_id, entity_id))
+        downtimes = {}
+        for pair, redis_downtimes in zip(pairs, p.execute() if pairs else []):
+            try:
+                downtimes[pair] = dict((k, json.loads(v)) for k, v in redis_downtimes.iteritems())
+            except ValueError:
+                logger.exception('Invalid downtime of alert %s and entity %s', *pair)
+
+        self._downtimes = downtimes
+        self._version = version
+        self._marked_active = set(m for m in self._marked_active if m[2] in downtimes.get(m[:2], ()))
+        self._loaded = self._checked = started
+        self.reloads += 1
+
+    def _start_listener(self, con):
+        with self._lock:
+            if self._listener is not None:
+                return
+            self._listener = threading.Thread(target=self._listen, args=(con,), name='downtime-notifications')
+            self._listener.daemon = True
+            self._listener.start()
+
+    def _listen(self, con):
+        pattern = '__keyspace@{}__:{}*'.format(con.connection_pool.connection_kwargs.get('db', 0), DOWNTIMES_KEY)
+        while True:
+            try:
+                pubsub = con.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(pattern)
+                # changes while we were not subscribed are missed
+                self._stale = True
+                for _ in pubsub.listen():
+                    self._stale = True
+            except Exception:
+                logger.exception('Downtime notifications failed, resubscribing')
+                time.sleep(self.check_interval)
+
+    def stats(self):
+        return {'size': sum(len(d) for d in self._downtimes.values()), 'reloads': self.reloads}
+
+
+downtime_index = DowntimeIndex()
@@ -1,6 +1,11 @@
 import __future__
 import ast
+import threading
+from collections import OrderedDict
 from inspect import isclass
+from types import CodeType
+
+COMPILE_CACHE_SIZE = 1024
 
 
 class InvalidEvalExpression(Exception):
@@ -27,6 +32,18 @@ class ProtectedPartial(object):
         new_kwargs.update((k, v) for (k, v) in kwargs.iteritems() if k not in self.__protected)
         return self.__func(*self.__partial_args + args, **new_kwargs)
 
+    def __bound__(self):
+        '''
+        The function and the arguments bound into it, e.g. to key cached calls. Check commands can not call it, names
+        with double underscores are rejected by safe_eval, so they do not see protected arguments like passwords.
+
+        >>> safe_eval('sql.__bound__()', sql=ProtectedPartial(dict, password='secret'))
+        Traceback (most recent call last):
+            ...
+        InvalidEvalExpression: <string> should not try to access hidden attributes (for example '__class__')
+        '''
+        return self.__func, self.__partial_args, self.__partial_kwargs
+
 
 def check_ast_node_is_safe(node, source):
     '''
@@ -77,6 +94,115 @@ def check_ast_node_is_safe(node, source):
     return node
 
 
+def code_names(code):
+    '''
+    All names a code object and the functions, classes or lambdas defined inside it may look up. Attribute names are
+    included too, so this is a superset of the global names the code needs.
+
+    >>> sorted(code_names(compile('lambda: http(url).json()', '<string>', 'eval')))
+    ['http', 'json', 'url']
+    '''
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names |= code_names(const)
+    return names
+
+
+def compile_safe(expr, eval_source='<string>'):
+    '''
+    Parse, validate and compile expr. Returns (is_expression, code, names), expressions are compiled in eval mode and
+    function or class definitions in exec mode, names are the ones returned by code_names().
+
+    >>> compile_safe('value > 0')[0]
+    True
+    >>> is_expression, code, names = compile_safe('def m(): return value')
+    >>> is_expression, sorted(names)
+    (False, ['m', 'value'])
+    '''
+    node = compile(expr, eval_source, 'exec', ast.PyCF_ONLY_AST | __future__.CO_FUTURE_PRINT_FUNCTION)
+    node = check_ast_node_is_safe(node, eval_source)
+    body = node.body
+    if not body or len(body) != 1:
+        raise InvalidEvalExpression(
+            '{} should contain only one python expression, a function call or a callable class definition'.format(
+                eval_source))
+
+    x = body[0]
+    if isinstance(x, ast.FunctionDef) or isinstance(x, ast.ClassDef):
+        code = compile(node, eval_source, 'exec')
+        return False, code, frozenset(code_names(code))
+    elif isinstance(x, ast.Expr):
+        code = compile(expr, eval_source, 'eval', __future__.CO_FUTURE_PRINT_FUNCTION)
+        return True, code, frozenset(code_names(code))
+    else:
+        raise InvalidEvalExpression(
+            '{} can contain a python expression, a function call or a callable class definition'.format(eval_source))
+
+
+class CompileCache(object):
+    '''
+    Thread safe LRU cache of validated code objects keyed by (expr, eval_source). Invalid expressions are not cached.
+
+    >>> cache = CompileCache(maxsize=2)
+    >>> for expr in ('1', '2', '1', '3'):
+    ...     _ = cache.get(expr, '<string>')
+    >>> sorted(cache.stats().items())
+    [('evictions', 1), ('hits', 1), ('misses', 3), ('size', 2)]
+    '''
+
+    def __init__(self, maxsize=COMPILE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._codes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, expr, eval_source):
+        key = (expr, eval_source)
+        with self._lock:
+            compiled = self._codes.pop(key, None)
+            if compiled is not None:
+                self._codes[key] = compiled  # most recently used go last
+                self.hits += 1
+                return compiled
+            self.misses += 1
+
+        compiled = compile_safe(expr, eval_source)
+
+        with self._lock:
+            self._codes[key] = compiled
+            self._evict()
+        return compiled
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def _evict(self):
+        while len(self._codes) > self.maxsize:
+            self._codes.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._codes)}
+
+
+compile_cache = CompileCache()
+
+
+def referenced_names(expr, eval_source='<string>'):
+    '''
+    Names expr may look up in its context, raises like safe_eval() if expr is not valid.
+
+    >>> 'entity' in referenced_names("entity['host']")
+    True
+    '''
+    return compile_cache.get(expr, eval_source)[2]
+
+
 def safe_eval(expr, eval_source='<string>', **kwargs):
     '''
     Safely execute expr.
@@ -94,7 +220,7 @@ def safe_eval(expr, eval_source='<string>', **kwargs):
     we should not have any problem with vulnerabilites defined here:
     Link: http://nedbatchelder.com/blog/201206/eval_really_is_dangerous.html
 
-    TODO: implement compile object cache
+    Validated code objects are kept in compile_cache, so an expression is parsed and compiled only once.
 
     >>> safe_eval('value > 0', value=1)
     True
@@ -177,42 +303,28 @@ def safe_eval(expr, eval_source='<string>', **kwargs):
     # __name__ is needed to be able to compile a class
     g.update(kwargs)
 
-    node = compile(expr, eval_source, 'exec', ast.PyCF_ONLY_AST | __future__.CO_FUTURE_PRINT_FUNCTION)
-    node = check_ast_node_is_safe(node, eval_source)
-    body = node.body
-    if body and len(body) == 1:
-        x = body[0]
-        if isinstance(x, ast.FunctionDef) or isinstance(x, ast.ClassDef):
-            cc = compile(node, eval_source, 'exec')  # can be nicely cached
-            v = {}
-            exec (cc, g, v)
-            if len(v) == 1:
-                c = v.itervalues().next()
-                if isclass(c):
-                    # we need a class instance and not the class itself
-                    c = c()
-
-                if callable(c):
-                    return c()  # if a function will return another callable, we will not call it
-                else:
-                    raise InvalidEvalExpression(
-                        '{} should contain a callable class definition (missing __call__ method?)'.format(eval_source))
-            else:
-                raise InvalidEvalExpression(
-                    '{} should contain only one function or one callable class definition'.format(eval_source))
-        elif isinstance(x, ast.Expr):
-            cc = compile(expr, eval_source, 'eval', __future__.CO_FUTURE_PRINT_FUNCTION)  # can be nicely cached
-            r = eval(cc, g)
-            if callable(r):
-                # Try() returns callable that should be executed
-                return r()
-            else:
-                return r
+    is_expression, cc, _ = compile_cache.get(expr, eval_source)
+    if is_expression:
+        r = eval(cc, g)
+        if callable(r):
+            # Try() returns callable that should be executed
+            return r()
+        else:
+            return r
+
+    v = {}
+    exec (cc, g, v)
+    if len(v) == 1:
+        c = v.itervalues().next()
+        if isclass(c):
+            # we need a class instance and not the class itself
+            c = c()
+
+        if callable(c):
+            return c()  # if a function will return another callable, we will not call it
         else:
             raise InvalidEvalExpression(
-                '{} can contain a python expression, a function call or a callable class definition'.format(
-                    eval_source))
+                '{} should contain a callable class definition (missing __call__ method?)'.format(eval_source))
     else:
         raise InvalidEvalExpression(
-            '{} should contain only one python expression, a function call or a callable class definition'.format(
-                eval_source))
+            '{} should contain only one function or one callable class definition'.format(eval_source))
@@ -1,3 +1,5 @@
+from requests.adapters import HTTPAdapter
+
 from zmon_worker_monitor import __version__
 
 
@@ -18,3 +20,22 @@ def is_absolute_http_url(url):
     '''
 
     return url.startswith('http://') or url.startswith('https://')
+
+
+class DeadlineAdapter(HTTPAdapter):
+    '''
+    Transport adapter capping the timeout of every request sent through a session with the remaining budget of a
+    check deadline. Useful for clients building their own session, e.g. pykube.
+    '''
+
+    def __init__(self, deadline, **kwargs):
+        self.deadline = deadline
+        super(DeadlineAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        timeout = kwargs.get('timeout')
+        if isinstance(timeout, tuple):  # (connect, read)
+            kwargs['timeout'] = tuple(self.deadline.timeout(t) for t in timeout)
+        else:
+            kwargs['timeout'] = self.deadline.timeout(timeout)
+        return super(DeadlineAdapter, self).send(request, **kwargs)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Numeric time series of check results for alert conditions, backed by NumPy arrays
+'''
+
+import numpy
+
+from zmon_worker_monitor.zmon_worker.common.time_ import parse_timedelta
+
+
+def window_start(ts, time_spec):
+    '''
+    Index of the first timestamp of the sorted array ts within time_spec of the last one.
+
+    >>> window_start(numpy.array([121, 123, 123.6]), '2s')
+    1
+    >>> window_start(numpy.array([0, 1]), '-5s')
+    0
+    '''
+    if len(ts) < 2:
+        return 0
+    idx = int(numpy.searchsorted(ts, ts[-1] - parse_timedelta(time_spec).total_seconds(), side='left'))
+    # time range exceeds range of results
+    return 0 if idx == len(ts) else idx
+
+
+def _item(v):
+    # numpy scalars back to python numbers, values which are not numbers (e.g. dicts) are kept as they are
+    return v.item() if isinstance(v, numpy.generic) else v
+
+
+class Series(object):
+    '''
+    Values ordered by timestamp, oldest first. Aggregates of an empty series are None, except sum() and delta()
+    which are 0 like sum() and mathfun.delta() of an empty list.
+
+    >>> s = Series.from_results([{'ts': 180, 'value': 7}, {'ts': 120, 'value': 4}, {'ts': 60, 'value': 1}])
+    >>> s.values.tolist(), s.last(), s.rate(), s.delta()
+    ([1, 4, 7], 7, 0.05, 6)
+    >>> s.window('1m').values.tolist(), s.percentile(0.5), round(s.stddev(), 3), round(s.zscore(), 3)
+    ([4, 7], 4.0, 2.449, 1.225)
+    >>> s.ewma(0.5)
+    4.75
+    >>> Series([], []).avg() is None, Series([], []).sum(), Series([], []).delta()
+    (True, 0, 0)
+    '''
+
+    def __init__(self, ts, values):
+        self.ts = numpy.asarray(ts, dtype=float)
+        self.values = numpy.asarray(values)
+
+    @classmethod
+    def from_results(cls, results, key=None):
+        '''
+        Build a series from check results as get_results() returns them, key maps each value to a number.
+        '''
+        ts = numpy.fromiter((r['ts'] for r in results), dtype=float, count=len(results))
+        order = numpy.argsort(ts, kind='mergesort')  # stable: same order as sorting the results by ts
+        values = [results[i]['value'] for i in order]
+        return cls(ts[order], values if key is None else [key(v) for v in values])
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values.tolist())
+
+    def __repr__(self):
+        return 'Series({})'.format(zip(self.ts.tolist(), self.values.tolist()))
+
+    def window(self, time_spec):
+        '''Values within time_spec of the latest one, e.g. "5m"'''
+        idx = window_start(self.ts, time_spec)
+        return Series(self.ts[idx:], self.values[idx:])
+
+    def first(self):
+        return _item(self.values[0]) if len(self) else None
+
+    def last(self):
+        return _item(self.values[-1]) if len(self) else None
+
+    def min(self):
+        return _item(self.values.min()) if len(self) else None
+
+    def max(self):
+        return _item(self.values.max()) if len(self) else None
+
+    def sum(self):
+        return _item(self.values.sum()) if len(self) else 0
+
+    def avg(self):
+        return float(self.values.mean()) if len(self) else None
+
+    def median(self):
+        return self.percentile(0.5)
+
+    def percentile(self, percent):
+        '''percent goes from 0.0 to 1.0, values are interpolated linearly like in mathfun.percentile'''
+        return float(numpy.percentile(self.values, percent * 100)) if len(self) else None
+
+    def stddev(self):
+        return float(self.values.std()) if len(self) else None
+
+    def delta(self):
+        return _item(self.values[-1] - self.values[0]) if len(self) else 0
+
+    def rate(self):
+        '''Change per second between the first and the last value'''
+        if len(self) < 2 or self.ts[-1] == self.ts[0]:
+            return None
+        return float(self.values[-1] - self.values[0]) / (self.ts[-1] - self.ts[0])
+
+    def zscore(self):
+        '''Distance of the last value to the mean, in standard deviations'''
+        std = self.stddev()
+        if not std:
+            return None
+        return float(self.values[-1] - self.values.mean()) / std
+
+    def ewma(self, alpha=0.3):
+        '''Exponentially weighted moving average at the last value, the first value starts the average'''
+        if not len(self):
+            return None
+        weights = alpha * (1 - alpha) ** numpy.arange(len(self) - 1, -1, -1, dtype=float)
+        weights[0] /= alpha
+        return float(numpy.dot(weights, self.values))
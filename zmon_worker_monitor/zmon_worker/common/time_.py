@@ -3,6 +3,9 @@
 
 from datetime import timedelta, datetime
 import re
+import time
+
+from zmon_worker_monitor.zmon_worker.errors import TimeLimitExceeded
 
 TIME_UNITS = {
     's': 'seconds',
@@ -108,3 +111,40 @@ def parse_datetime(s):
         except Exception:
             pass
     return None
+
+
+class Deadline(object):
+    '''
+    Time budget of a running check, derived from the soft time limit of its task. Plugins take the timeout of their
+    next I/O call from it, so a slow check fails with a CheckError before the worker gets killed at the hard limit.
+
+    >>> d = Deadline(10, start=100.0)
+    >>> d.remaining(now=104.0)
+    6.0
+    >>> d.timeout(30, now=104.0), d.timeout(2, now=104.0)
+    (6.0, 2)
+    >>> d.timeout(now=111.0)
+    Traceback (most recent call last):
+    ...
+    TimeLimitExceeded: Soft time limit of 10s exceeded
+    '''
+
+    def __init__(self, seconds, start=None):
+        self.seconds = seconds
+        self.expires = (time.time() if start is None else start) + seconds
+
+    def remaining(self, now=None):
+        return max(self.expires - (time.time() if now is None else now), 0)
+
+    def expired(self, now=None):
+        return self.remaining(now=now) <= 0
+
+    def timeout(self, default=None, now=None):
+        '''
+        Timeout for the next blocking call: the remaining budget, or default if shorter.
+        Raises TimeLimitExceeded if there is no budget left.
+        '''
+        remaining = self.remaining(now=now)
+        if remaining <= 0:
+            raise TimeLimitExceeded(self.seconds)
+        return remaining if default is None else min(default, remaining)
@@ -5,6 +5,9 @@ import threading
 import time
 
 import psutil
+from redis.exceptions import NoScriptError
+
+_registered_scripts = {}  # {Lua source: redis Script}
 
 
 def flatten(structure, key='', path='', flattened=None):
@@ -111,3 +114,48 @@ def get_process_cmdline(pid):
         return ' '.join(filter(bool, psutil.Process(pid).cmdline()))
     except: # noqa
         return 'N/A'
+
+
+def registered_script(con, source):
+    '''
+    The redis Script of the Lua source, registered once per process. It is run with EVALSHA instead of sending the
+    source with every EVAL, and loaded again when redis does not know it (NOSCRIPT).
+    '''
+    script = _registered_scripts.get(source)
+    if script is None:
+        script = _registered_scripts.setdefault(source, con.register_script(source))
+    return script
+
+
+def eval_script_pipelined(con, script, calls):
+    '''
+    Run the registered script once for every (keys, args) of calls in one round trip, returns their results. Only the
+    calls failing with NOSCRIPT are repeated after loading the script, the others already ran.
+
+    >>> from mock import MagicMock
+    >>> con = MagicMock()
+    >>> con.pipeline.return_value.execute.side_effect = [[NoScriptError('NOSCRIPT'), 3], [2]]
+    >>> script = MagicMock(sha='old', script='return #KEYS')
+    >>> con.script_load.return_value = 'new'
+    >>> eval_script_pipelined(con, script, [(['a', 'b'], []), (['a', 'b', 'c'], [])])
+    [2, 3]
+    >>> [c[0] for c in con.pipeline.return_value.evalsha.call_args_list]
+    [('old', 2, 'a', 'b'), ('old', 3, 'a', 'b', 'c'), ('new', 2, 'a', 'b')]
+    '''
+    def execute(indexes):
+        p = con.pipeline(transaction=False)
+        for i in indexes:
+            keys, args = calls[i]
+            p.evalsha(script.sha, len(keys), *(list(keys) + list(args)))
+        return p.execute(raise_on_error=False)
+
+    results = execute(range(len(calls)))
+    missing = [i for i, result in enumerate(results) if isinstance(result, NoScriptError)]
+    if missing:
+        script.sha = con.script_load(script.script)
+        for i, result in zip(missing, execute(missing)):
+            results[i] = result
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
@@ -3,11 +3,15 @@
 
 import datetime
 import json
+import msgpack
 import numpy
+import zlib
 
 from collections import Set
 from decimal import Decimal
 
+from zmon_worker_monitor.zmon_worker.common.utils import flatten
+
 
 class JsonDataEncoder(json.JSONEncoder):
     def default(self, o):
@@ -39,3 +43,165 @@ class JsonDataEncoder(json.JSONEncoder):
     def iterencode(self, o, _one_shot=False):
         for chunk in super(JsonDataEncoder, self).iterencode(o, _one_shot=_one_shot):
             yield {'NaN': 'null', 'Infinity': '"Infinity"', '-Infinity': '"-Infinity"'}.get(chunk, chunk)
+
+
+def dumps_compact(obj):
+    return json.dumps(obj, separators=(',', ':'), cls=JsonDataEncoder)
+
+
+def dumps_with_raw(obj, **raw_members):
+    '''
+    Compact JSON of the dict obj, plus members given as already encoded JSON.
+
+    >>> dumps_with_raw({'a': 1}, b='[1,2]')
+    '{"a":1,"b":[1,2]}'
+    >>> dumps_with_raw({}, b='null')
+    '{"b":null}'
+    '''
+    encoded = dumps_compact(obj)
+    if not raw_members:
+        return encoded
+    members = ','.join('{}:{}'.format(json.dumps(k), v) for k, v in sorted(raw_members.items()))
+    return encoded[:-1] + (',' if obj else '') + members + '}'
+
+
+class CheckResult(dict):
+    '''
+    A check result computing its JSON encoding and flattened views once, on first use, so that the result limits and
+    all the sinks (redis, KairosDB, metric cache, data service) share them.
+    Top level changes reset them, call invalidate() after changing nested values in place.
+
+    >>> r = CheckResult(value={'a': {'b': 1, 'c': 'x'}})
+    >>> r.json == dumps_compact(r)
+    True
+    >>> sorted(r.numeric_values.items())
+    [('a.b', 1.0)]
+    >>> r['ts'] = 10
+    >>> '"ts":10' in r.json
+    True
+    >>> r.setdefault('exc', 1) and '"exc":1' in r.json
+    True
+    >>> r.clear()
+    >>> r.json
+    '{}'
+    >>> CheckResult(value='7.5').numeric_values
+    {None: 7.5}
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(CheckResult, self).__init__(*args, **kwargs)
+        self.invalidate()
+
+    def invalidate(self):
+        self._json = None
+        self._flat_value = None
+        self._numeric_values = None
+
+    def __setitem__(self, key, value):
+        super(CheckResult, self).__setitem__(key, value)
+        self.invalidate()
+
+    def __delitem__(self, key):
+        super(CheckResult, self).__delitem__(key)
+        self.invalidate()
+
+    def update(self, *args, **kwargs):
+        super(CheckResult, self).update(*args, **kwargs)
+        self.invalidate()
+
+    def pop(self, *args):
+        self.invalidate()
+        return super(CheckResult, self).pop(*args)
+
+    def popitem(self):
+        self.invalidate()
+        return super(CheckResult, self).popitem()
+
+    def setdefault(self, *args):
+        self.invalidate()
+        return super(CheckResult, self).setdefault(*args)
+
+    def clear(self):
+        super(CheckResult, self).clear()
+        self.invalidate()
+
+    @property
+    def json(self):
+        if self._json is None:
+            self._json = dumps_compact(self)
+        return self._json
+
+    @property
+    def flat_value(self):
+        '''flattened value, None if the value is not a dict'''
+        if self._flat_value is None and isinstance(self.get('value'), dict):
+            self._flat_value = flatten(self['value'])
+        return self._flat_value
+
+    @property
+    def numeric_values(self):
+        '''{flattened key: float} of the numeric leaves of the value, {None: float} if the value itself is numeric'''
+        if self._numeric_values is None:
+            flat_value = self.flat_value
+            items = flat_value.iteritems() if flat_value is not None else [(None, self.get('value'))]
+            self._numeric_values = {}
+            for k, v in items:
+                try:
+                    self._numeric_values[k] = float(v)
+                except (ValueError, TypeError):
+                    continue
+        return self._numeric_values
+
+    @staticmethod
+    def encode(result):
+        return result.json if isinstance(result, CheckResult) else dumps_compact(result)
+
+
+# Encodings of the check result history lists zmon:checks:<check>:<entity>. Compact entries start with a version
+# prefix, JSON entries with "{": readers understand all of them, whatever encoding the writer was configured with.
+HISTORY_ENCODINGS = ('json', 'zlib', 'msgpack')
+HISTORY_ZLIB_PREFIX = '\x00z1'
+HISTORY_MSGPACK_PREFIX = '\x00m1'
+
+
+def encode_history(encoded, encoding='json'):
+    '''
+    History entry of the JSON encoded check result. Entries stay JSON when the compact encoding would not be smaller
+    or can not represent the result exactly.
+
+    >>> encoded = dumps_compact({'ts': 1409826332.92, 'td': 0.012345, 'worker': 'plocal.zmon-worker-1',
+    ...                          'value': {'status': 'UP', 'heap': {'used': 123456789, 'max': 536870912}}})
+    >>> [len(encode_history(encoded, e)) for e in HISTORY_ENCODINGS]
+    [132, 122, 98]
+    >>> encode_history('{"value":1}', 'zlib')
+    '{"value":1}'
+    >>> all(decode_history(encode_history(encoded, e)) == json.loads(encoded) for e in HISTORY_ENCODINGS)
+    True
+    '''
+    try:
+        if encoding == 'zlib':
+            compact = HISTORY_ZLIB_PREFIX + zlib.compress(encoded)
+        elif encoding == 'msgpack':
+            # packing the decoded JSON keeps what readers get the same as with JSON, e.g. for non string keys
+            compact = HISTORY_MSGPACK_PREFIX + msgpack.packb(json.loads(encoded), use_bin_type=True)
+        else:
+            return encoded
+    except Exception:
+        return encoded
+    return compact if len(compact) < len(encoded) else encoded
+
+
+def decode_history(raw):
+    '''
+    Check result of a history entry in any of the HISTORY_ENCODINGS.
+
+    >>> decode_history('{"value":1}')
+    {u'value': 1}
+    >>> decode_history(HISTORY_ZLIB_PREFIX + zlib.compress('{"value":1}'))
+    {u'value': 1}
+    '''
+    if raw.startswith(HISTORY_ZLIB_PREFIX):
+        return json.loads(zlib.decompress(raw[len(HISTORY_ZLIB_PREFIX):]))
+    if raw.startswith(HISTORY_MSGPACK_PREFIX):
+        return msgpack.unpackb(raw[len(HISTORY_MSGPACK_PREFIX):], raw=False)
+    return json.loads(raw)
@@ -68,3 +68,9 @@ class ResultSizeError(CheckError):
         message = 'Result size error: {}'.format(message)
 
         super(ResultSizeError, self).__init__(message)
+
+
+class TimeLimitExceeded(CheckError):
+    def __init__(self, seconds):
+        self.seconds = seconds
+        super(TimeLimitExceeded, self).__init__('Soft time limit of {}s exceeded'.format(seconds))
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Sends notifications in the background, so that slow mail servers or provider APIs do not hold up the checks.
+
+Every provider (mail, sms, slack, ...) has its own bounded queue and threads, a slow provider does not delay the
+others. Failed notifications are retried, except for NotificationError which means they are not valid. When the
+queue of a provider is full notifications are sent right away by the caller, as they were without the dispatcher.
+"""
+
+import logging
+import Queue
+import threading
+import time
+from collections import Counter
+
+from zmon_worker_monitor.zmon_worker.errors import NotificationError
+
+NOTIFICATION_QUEUE_SIZE = 1000
+NOTIFICATION_CONCURRENCY = 4
+NOTIFICATION_RETRIES = 2
+NOTIFICATION_RETRY_DELAY = 5
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationDispatcher(object):
+    '''
+    >>> dispatcher = NotificationDispatcher(concurrency={'mail': 1})
+    >>> sent = threading.Event()
+    >>> dispatcher.submit('mail', sent.set)
+    True
+    >>> sent.wait(5) and dispatcher.join(5)
+    True
+    >>> dispatcher.stats()['mail.sent']
+    1
+    '''
+
+    def __init__(self, queue_size=NOTIFICATION_QUEUE_SIZE, concurrency=None,
+                 default_concurrency=NOTIFICATION_CONCURRENCY, retries=NOTIFICATION_RETRIES,
+                 retry_delay=NOTIFICATION_RETRY_DELAY):
+        self.queue_size = queue_size
+        self.concurrency = concurrency or {}
+        self.default_concurrency = default_concurrency
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._queues = {}  # {provider: Queue}, threads are started with the queue
+        self._counter = Counter()
+        self._lock = threading.Lock()
+
+    def configure(self, queue_size=NOTIFICATION_QUEUE_SIZE, concurrency=None,
+                  default_concurrency=NOTIFICATION_CONCURRENCY, retries=NOTIFICATION_RETRIES,
+                  retry_delay=NOTIFICATION_RETRY_DELAY):
+        '''Queues and threads already started keep their size'''
+        self.queue_size = queue_size
+        self.concurrency = concurrency or {}
+        self.default_concurrency = default_concurrency
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def submit(self, provider, func, args=(), description='', retries=None):
+        '''
+        Queue func(*args) for the provider. Returns False if the queue was full and func ran right away.
+        retries overrides the retries of the dispatcher, e.g. 0 for calls that are not safe to repeat.
+        '''
+        try:
+            self._queue(provider).put_nowait((time.time(), func, args, description,
+                                              self.retries if retries is None else retries))
+            self._count(provider, 'queued')
+            return True
+        except Queue.Full:
+            self._count(provider, 'overflow')
+            self._run(provider, func, args, description, retries=0)
+            return False
+
+    def join(self, timeout=None):
+        '''Wait until all queued notifications are sent, returns False on timeout'''
+        deadline = time.time() + timeout if timeout is not None else None
+        for q in self._queues.values():
+            while q.unfinished_tasks:
+                if deadline is not None and time.time() > deadline:
+                    return False
+                time.sleep(0.01)
+        return True
+
+    def _queue(self, provider):
+        q = self._queues.get(provider)
+        if q is not None:
+            return q
+        with self._lock:
+            if provider not in self._queues:
+                q = Queue.Queue(self.queue_size)
+                for i in range(max(1, self.concurrency.get(provider, self.default_concurrency))):
+                    thread = threading.Thread(target=self._loop, args=(provider, q),
+                                              name='notifications-{}-{}'.format(provider, i))
+                    thread.daemon = True
+                    thread.start()
+                self._queues[provider] = q
+            return self._queues[provider]
+
+    def _loop(self, provider, q):
+        while True:
+            queued, func, args, description, retries = q.get()
+            try:
+                self._count_max(provider, 'delay_ms.max', int(1000 * (time.time() - queued)))
+                self._run(provider, func, args, description, retries=retries)
+            finally:
+                q.task_done()
+
+    def _run(self, provider, func, args, description, retries):
+        for attempt in range(retries + 1):
+            try:
+                func(*args)
+                self._count(provider, 'sent')
+                return
+            except NotificationError:
+                logger.exception('Invalid %s notification %s', provider, description)
+                break
+            except Exception:
+                logger.exception('Sending %s notification %s failed, attempt %s of %s', provider, description,
+                                 attempt + 1, retries + 1)
+                if attempt < retries:
+                    self._count(provider, 'retried')
+                    time.sleep(self.retry_delay * (attempt + 1))
+        self._count(provider, 'failed')
+
+    def _count(self, provider, name):
+        with self._lock:
+            self._counter['{}.{}'.format(provider, name)] += 1
+
+    def _count_max(self, provider, name, value):
+        with self._lock:
+            key = '{}.{}'.format(provider, name)
+            self._counter[key] = max(value, self._counter[key])
+
+    def stats(self):
+        '''Counters since the last call, the queue length per provider'''
+        with self._lock:
+            stats = dict(self._counter)
+            self._counter.clear()
+        stats.update(('{}.queue'.format(p), q.qsize()) for p, q in self._queues.items())
+        return stats
+
+
+notification_dispatcher = NotificationDispatcher()
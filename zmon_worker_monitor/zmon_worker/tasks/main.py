@@ -11,6 +11,7 @@ import requests
 import setproctitle
 import socket
 import sys
+import threading
 import traceback
 import time
 import urllib
@@ -21,10 +22,11 @@ from base64 import b64decode
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 
-from bisect import bisect_left
 from collections import Callable, Counter
 from collections import defaultdict
+from contextlib import contextmanager
 from datetime import timedelta, datetime
+import operator
 from operator import itemgetter
 
 import functional
@@ -38,16 +40,27 @@ from timeperiod import in_period, InvalidFormat
 from opentracing_utils import trace, extract_span_from_kwargs
 
 from zmon_worker_monitor import eventloghttp
+from zmon_worker_monitor.accounting import account_check, add_cost, install_http_accounting
 from zmon_worker_monitor import plugin_manager
 from zmon_worker_monitor.redis_context_manager import RedisConnHandler
 from zmon_worker_monitor.zmon_worker.common import mathfun
-from zmon_worker_monitor.zmon_worker.common.eval import safe_eval, InvalidEvalExpression, ProtectedPartial
+from zmon_worker_monitor.zmon_worker.common.call_cache import (
+    CALL_CACHE_BYTES, CALL_CACHE_MAX_TTL, CALL_CACHE_SIZE, CachedCalls, CallCache, call_cache, call_key)
+from zmon_worker_monitor.zmon_worker.common.downtimes import DOWNTIMES_CHECK_INTERVAL, DOWNTIMES_MAX_AGE, downtime_index
+from zmon_worker_monitor.zmon_worker.common.eval import (
+    COMPILE_CACHE_SIZE, compile_cache, referenced_names, safe_eval, InvalidEvalExpression, ProtectedPartial)
 from zmon_worker_monitor.zmon_worker.common.http import get_user_agent
-from zmon_worker_monitor.zmon_worker.common.time_ import parse_timedelta
-from zmon_worker_monitor.zmon_worker.common.utils import flatten, PeriodicBufferedAction
-from zmon_worker_monitor.zmon_worker.encoder import JsonDataEncoder
+from zmon_worker_monitor.zmon_worker.common.series import Series, window_start
+from zmon_worker_monitor.zmon_worker.common.time_ import Deadline
+from zmon_worker_monitor.zmon_worker.common.utils import (PeriodicBufferedAction, eval_script_pipelined,
+                                                          registered_script)
+from zmon_worker_monitor.zmon_worker.encoder import (CheckResult, JsonDataEncoder, HISTORY_ENCODINGS, decode_history,
+                                                     dumps_compact, dumps_with_raw, encode_history)
 from zmon_worker_monitor.zmon_worker.errors import (
-    CheckError, AlertError, InsufficientPermissionsError, SecurityError, ResultSizeError)
+    CheckError, AlertError, InsufficientPermissionsError, SecurityError, ResultSizeError, TimeLimitExceeded)
+from zmon_worker_monitor.zmon_worker.notifications.dispatcher import (
+    NOTIFICATION_CONCURRENCY, NOTIFICATION_QUEUE_SIZE, NOTIFICATION_RETRIES, NOTIFICATION_RETRY_DELAY,
+    notification_dispatcher)
 from zmon_worker_monitor.zmon_worker.notifications.http import NotifyHttp
 from zmon_worker_monitor.zmon_worker.notifications.hipchat import NotifyHipchat
 from zmon_worker_monitor.zmon_worker.notifications.google_hangouts_chat import NotifyGoogleHangoutsChat
@@ -78,18 +91,65 @@ TRIAL_RUN_RESULT_EXPIRY_TIME = 300
 # the following pattern is used to check if "value" has to be prepended to the condition
 SIMPLE_CONDITION_PATTERN = re.compile(r'^[<>!=\[]|i[ns] ')
 
+# conditions only comparing the value with a literal are evaluated without building a context, e.g. ">= 100".
+# Integers with leading zeros are octal in Python 2, they are left to safe_eval, as are strings with escapes or
+# characters other than printable ASCII.
+SIMPLE_COMPARISON_PATTERN = re.compile(
+    r'^\s*(>=|<=|==|!=|>|<)\s*(-?(?:0|[1-9]\d*)(?:\.\d*)?(?:[eE][-+]?\d+)?|'
+    r'\'[\x20-\x26\x28-\x5b\x5d-\x7e]*\'|"[\x20\x21\x23-\x5b\x5d-\x7e]*"|True|False|None)\s*$')
+SIMPLE_COMPARISON_OPERATORS = {'>=': operator.ge, '<=': operator.le, '==': operator.eq, '!=': operator.ne,
+                               '>': operator.gt, '<': operator.lt}
+SIMPLE_COMPARISON_CONSTANTS = {'True': True, 'False': False, 'None': None}
+
 # round to microseconds
 ROUND_SECONDS_DIGITS = 6
 JMX_CONFIG_FILE = 'jmxremote.password'
 KAIROS_ID_FORBIDDEN_RE = re.compile(r'[^a-zA-Z0-9\-_\.]')
 
 HOST_GROUP_PREFIX = re.compile(r'^([a-z]+)')
+NOTIFICATION_CALL = re.compile(r'\s*(?:send|notify)_(\w+)\s*\(')
+NOTIFICATION_CALLS = re.compile(r'\b(?:send|notify)_\w+\s*\(')
+NOTIFICATION_PROVIDER_ALIASES = {'email': 'mail'}
+# seconds a notification queued for the dispatcher holds its repeat slot until it is sent, retries included
+NOTIFICATION_PENDING_TIMEOUT = 300
 INSTANCE_PORT_SUFFIX = re.compile(r':([0-9]+)$')
 
+# entities of an alert read in one round trip by entity_results()
+ENTITY_RESULTS_CHUNK = 500
+ENTITY_RESULTS_CACHE_TTL = 10
+ENTITY_RESULTS_CACHE_SIZE = 256
+
+# entities of check_and_notify_batch whose results are stored in one pipeline before their alerts are evaluated
+CHECK_BATCH_CHUNK = 50
+
+entity_results_cache = CallCache(maxsize=ENTITY_RESULTS_CACHE_SIZE, max_ttl=ENTITY_RESULTS_CACHE_TTL)
+
 # Result size limits
 MAX_RESULT_SIZE = 64  # KB
 MAX_RESULT_KEYS = 1000
 
+# Alert state transition of an entity: KEYS are the entities in alert, the active alerts, the captures, the stored
+# alert and the notification repeat times, ARGV entity id, alert id, 1 if in alert and the captures JSON. Captures
+# are only written if they changed, steady entities cause no writes.
+LUA_ALERT_TRANSITION = '''
+local changed, alert_changed
+if ARGV[3] == '1' then
+    changed = redis.call('SADD', KEYS[1], ARGV[1])
+    alert_changed = redis.call('SADD', KEYS[2], ARGV[2])
+else
+    changed = redis.call('SREM', KEYS[1], ARGV[1])
+    alert_changed = 0
+    if redis.call('SCARD', KEYS[1]) == 0 then
+        alert_changed = redis.call('SREM', KEYS[2], ARGV[2])
+    end
+end
+if redis.call('HGET', KEYS[3], ARGV[1]) ~= ARGV[4] then
+    redis.call('HSET', KEYS[3], ARGV[1], ARGV[4])
+end
+return {changed, alert_changed, redis.call('SCARD', KEYS[1]), redis.call('GET', KEYS[4]),
+        redis.call('HGETALL', KEYS[5])}
+'''
+
 EVENTS = {
     'ALERT_STARTED': eventlog.Event(0x34001, ['checkId', 'alertId', 'value']),
     'ALERT_ENDED': eventlog.Event(0x34002, ['checkId', 'alertId', 'value']),
@@ -143,6 +203,17 @@ def setp(check_id, entity, msg):
         'zmon-worker check {} on {} {} {}'.format(check_id, entity, msg, datetime.now().isoformat()))
 
 
+def is_critical_check(sampling_config, check_id):
+    """
+    >>> is_critical_check({'critical_checks': ['11', 12]}, 11), is_critical_check({'critical_checks': [12]}, 12)
+    (True, True)
+    >>> is_critical_check({}, 11)
+    False
+    """
+    critical_checks = (sampling_config or {}).get('critical_checks', [])
+    return str(check_id) in critical_checks or check_id in critical_checks
+
+
 def get_kairosdb_value(name, points, tags):
     return {'name': name, 'datapoints': points, 'tags': tags}
 
@@ -251,11 +322,40 @@ def entity_values(con, check_id, alert_id, count=1):
 
 
 def entity_results(con, check_id, alert_id, count=1):
+    '''
+    Latest count results of all entities of the alert. All the tasks of the alert share them for
+    zmon.entity_results.cache_ttl seconds, 0 disables the cache.
+    '''
+    if entity_results_cache.max_ttl <= 0:
+        return _read_entity_results(con, check_id, alert_id, count)
+    key = call_key('entity_results', check_id, alert_id, count)
+    return entity_results_cache.get(key, entity_results_cache.max_ttl, _read_entity_results, con, check_id, alert_id,
+                                    count)
+
+
+def _read_entity_results(con, check_id, alert_id, count):
+    '''
+    Read the results in pipelines of ENTITY_RESULTS_CHUNK entities, each chunk is decoded before the next one is read.
+
+    >>> from mock import MagicMock
+    >>> con = MagicMock()
+    >>> con.hkeys.return_value = ['e{}'.format(i) for i in range(ENTITY_RESULTS_CHUNK + 1)]
+    >>> con.pipeline.return_value.execute.side_effect = lambda: [['{"value": 1}']] * len(con.pipeline.mock_calls)
+    >>> len(_read_entity_results(con, 1, 2, 1)), con.pipeline.return_value.execute.call_count
+    (501, 2)
+    '''
     all_entities = con.hkeys('zmon:alerts:{}:entities'.format(alert_id))
     all_results = []
-    for entity_id in all_entities:
-        results = get_results(con, check_id, entity_id, count)
-        all_results.extend(results)
+    for i in range(0, len(all_entities), ENTITY_RESULTS_CHUNK):
+        chunk = all_entities[i:i + ENTITY_RESULTS_CHUNK]
+        p = con.pipeline(transaction=False)
+        for entity_id in chunk:
+            p.lrange('zmon:checks:{}:{}'.format(check_id, entity_id), 0, count - 1)
+        for entity_id, results in zip(chunk, p.execute()):
+            for r in results:
+                r = decode_history(r)
+                r['entity_id'] = entity_id
+                all_results.append(r)
     return all_results
 
 
@@ -332,9 +432,10 @@ def _parse_alert_parameter_value(data):
     return value
 
 
-def _inject_alert_parameters(alert_parameters, ctx):
+def _inject_alert_parameters(alert_parameters, ctx, reserved=()):
     '''
-    Inject alert parameters into the execution context dict (ctx)
+    Inject alert parameters into the execution context dict (ctx), they must not clash with the names in ctx or
+    reserved.
 
     >>> ctx = {}; _inject_alert_parameters({'para': {'value': 1}}, ctx); sorted(ctx.items())
     [('para', 1), ('params', {'para': 1})]
@@ -345,7 +446,7 @@ def _inject_alert_parameters(alert_parameters, ctx):
 
     if alert_parameters:
         for apname, apdata in alert_parameters.items():
-            if apname in ctx:
+            if apname in ctx or apname in reserved:
                 raise Exception('Parameter name: %s clashes in context', apname)
             value = _parse_alert_parameter_value(apdata)
             params[apname] = value
@@ -356,12 +457,12 @@ def _inject_alert_parameters(alert_parameters, ctx):
             ctx[params_name] = params
 
 
-def alert_series(f, n, con, check_id, entity_id):
+def alert_series(f, n, con, check_id, entity_id, history=None):
     """
     Evaluate given function on the last n check results and return true if the "alert" function f returns true for
     all values
     """
-    vs = get_results(con, check_id, entity_id, n)
+    vs = get_results(con, check_id, entity_id, n, history=history)
 
     threshold = min(n, len(vs))
 
@@ -389,9 +490,10 @@ def alert_series(f, n, con, check_id, entity_id):
     return threshold == active_count
 
 
-def monotonic(count=2, increasing=True, strictly=False, data=None, con=None, check_id=None, entity_id=None):
+def monotonic(count=2, increasing=True, strictly=False, data=None, con=None, check_id=None, entity_id=None,
+              history=None):
     if not data:
-        data = get_results_user(count, con, check_id, entity_id)
+        data = get_results_user(count, con, check_id, entity_id, history=history)
     cur, data = data[0], data[1:]
     comp = None
     # we get data in "reversed" order, i.e. latest one comes first, oldest last
@@ -429,51 +531,68 @@ def _less(c, d):
     return c < d
 
 
-def build_condition_context(con, check_id, alert_id, entity, captures, alert_parameters):
+def _plugin_function(name, factory_ctx):
+    return plugin_manager.get_plugin_obj_by_name(name, 'Function').create(factory_ctx)
+
+
+def _timeseries_function(f):
+    def create(con, check_id, alert_id, entity, captures, history):
+        return functools.partial(_apply_aggregate_function_for_time, con=con, func=f, check_id=check_id,
+                                 entity_id=entity['id'], captures=captures, history=history)
+    return create
+
+
+# functions of the alert condition context, built from (con, check_id, alert_id, entity, captures, history) on demand
+CONDITION_CONTEXT = {
+    'capture': lambda con, check_id, alert_id, entity, captures, history: functools.partial(capture, captures=captures),
+    'entity_results': lambda con, check_id, alert_id, entity, captures, history: functools.partial(
+        entity_results, con=con, check_id=check_id, alert_id=alert_id),
+    'entity_values': lambda con, check_id, alert_id, entity, captures, history: functools.partial(
+        entity_values, con=con, check_id=check_id, alert_id=alert_id),
+    'entity': lambda con, check_id, alert_id, entity, captures, history: dict(entity),
+    'value_series': lambda con, check_id, alert_id, entity, captures, history: functools.partial(
+        get_results_user, con=con, check_id=check_id, entity_id=entity['id'], history=history),
+    'alert_series': lambda con, check_id, alert_id, entity, captures, history: functools.partial(
+        alert_series, con=con, check_id=check_id, entity_id=entity['id'], history=history),
+    'series': lambda con, check_id, alert_id, entity, captures, history: history.series,
+    'monotonic': lambda con, check_id, alert_id, entity, captures, history: functools.partial(
+        monotonic, con=con, check_id=check_id, entity_id=entity['id'], history=history),
+    # check plugins available in alert condition!
+    'time': lambda con, check_id, alert_id, entity, captures, history: _plugin_function('time', {}),
+    'history': lambda con, check_id, alert_id, entity, captures, history: _plugin_function(
+        'history', {'check_id': check_id, 'entity_id_for_kairos': normalize_kairos_id(entity['id'])}),
+    'kairosdb': lambda con, check_id, alert_id, entity, captures, history: _plugin_function('kairosdb', {}),
+}
+
+CONDITION_CONTEXT.update(('timeseries_' + f.__name__.lstrip('_'), _timeseries_function(f)) for f in (
+    mathfun.avg, mathfun.delta, mathfun.median, mathfun.percentile, mathfun.first, mathfun._min, mathfun._max, sum))
+
+
+def build_condition_context(con, check_id, alert_id, entity, captures, alert_parameters, names=None, history=None):
     '''
+    Build the context of an alert condition, names holds the names the condition looks up: the functions it does not
+    reference are not created. None means all of them. history is the CheckHistory of the check result the alerts of
+    the check share.
+
     >>> plugin_manager.collect_plugins(); 'timeseries_median' in build_condition_context(None, 1, 1, {'id': '1'}, {}, {})
     True
     >>> set(('history', 'kairosdb', 'time', 'timeseries_percentile')) - set(build_condition_context(None, 1, 1, {'id': '1'}, {}, {})) == set()
     True
+    >>> ctx = build_condition_context(None, 1, 1, {'id': '1'}, {}, {}, names={'value', 'history'})
+    >>> 'history' in ctx, 'kairosdb' in ctx, 'timeseries_median' in ctx
+    (True, False, False)
     '''  # noqa
 
-    history_factory = plugin_manager.get_plugin_obj_by_name('history', 'Function')
-    kairosdb_factory = plugin_manager.get_plugin_obj_by_name('kairosdb', 'Function')
-    time_factory = plugin_manager.get_plugin_obj_by_name('time', 'Function')
+    if history is None:
+        history = CheckHistory(con, check_id, entity['id'])
 
     ctx = build_default_context()
-    ctx['capture'] = functools.partial(capture, captures=captures)
-    ctx['entity_results'] = functools.partial(entity_results, con=con, check_id=check_id, alert_id=alert_id)
-    ctx['entity_values'] = functools.partial(entity_values, con=con, check_id=check_id, alert_id=alert_id)
-    ctx['entity'] = dict(entity)
-    ctx['value_series'] = functools.partial(get_results_user, con=con, check_id=check_id, entity_id=entity['id'])
-    ctx['alert_series'] = functools.partial(alert_series, con=con, check_id=check_id, entity_id=entity['id'])
-    ctx['monotonic'] = functools.partial(monotonic, con=con, check_id=check_id, entity_id=entity['id'])
+    for name, create in CONDITION_CONTEXT.items():
+        if names is None or name in names:
+            ctx[name] = create(con, check_id, alert_id, entity, captures, history)
+
+    _inject_alert_parameters(alert_parameters, ctx, reserved=CONDITION_CONTEXT)
 
-    # check plugins available in alert condition!
-    ctx['time'] = time_factory.create({})
-    ctx['history'] = history_factory.create(
-        {'check_id': check_id, 'entity_id_for_kairos': normalize_kairos_id(entity['id'])})
-    ctx['kairosdb'] = kairosdb_factory.create({})
-
-    _inject_alert_parameters(alert_parameters, ctx)
-
-    for f in (
-            mathfun.avg,
-            mathfun.delta,
-            mathfun.median,
-            mathfun.percentile,
-            mathfun.first,
-            mathfun._min,
-            mathfun._max,
-            sum,
-    ):
-        name = f.__name__
-        if name.startswith('_'):
-            name = name[1:]
-        ctx['timeseries_' + name] = functools.partial(_apply_aggregate_function_for_time, con=con, func=f,
-                                                      check_id=check_id,
-                                                      entity_id=entity['id'], captures=captures)
     return ctx
 
 
@@ -492,21 +611,14 @@ def _time_slice(time_spec, results):
     if len(results) < 2:
         # not enough values to calculate anything
         return results
-    get_ts = itemgetter('ts')
-    results.sort(key=get_ts)
-    keys = map(get_ts, results)
-    td = parse_timedelta(time_spec)
-    last = results[-1]
-    needle = last['ts'] - td.total_seconds()
-    idx = bisect_left(keys, needle)
-    if idx == len(results):
-        # timerange exceeds range of results
-        return results
-    return results[idx:]
+    ts = numpy.fromiter((r['ts'] for r in results), dtype=float, count=len(results))
+    order = numpy.argsort(ts, kind='mergesort')
+    return [results[i] for i in order[window_start(ts[order], time_spec):]]
 
 
-def _get_results_for_time(con, check_id, entity_id, time_spec, size=DEFAULT_CHECK_RESULTS_HISTORY_LENGTH):
-    results = get_results(con, check_id, entity_id, size)
+def _get_results_for_time(con, check_id, entity_id, time_spec, size=DEFAULT_CHECK_RESULTS_HISTORY_LENGTH,
+                          history=None):
+    results = get_results(con, check_id, entity_id, size, history=history)
     return _time_slice(time_spec, results)
 
 
@@ -518,9 +630,10 @@ def _apply_aggregate_function_for_time(
         entity_id,
         captures,
         key=functional.id,
+        history=None,
         **args
 ):
-    results = _get_results_for_time(con, check_id, entity_id, time_spec)
+    results = _get_results_for_time(con, check_id, entity_id, time_spec, history=history)
     ret = mathfun.apply_aggregate_function(results, func, key=functional.compose(key, get_value), **args)
     # put function result in our capture dict for debugging
     # e.g. captures["delta(5m)"] = 13.5
@@ -553,6 +666,41 @@ def _build_notify_context(alert):
     }
 
 
+def _notifications_key(context):
+    return 'zmon:notifications:{}:{}'.format(context['alert_def']['id'], context['entity']['id'])
+
+
+def _notification_retries(notification):
+    '''
+    Retries of the notification in the dispatcher: none for expressions with several calls, which would send the
+    ones that succeeded again
+
+    >>> _notification_retries("send_email(per_entity=True, repeat=600)")
+    >>> _notification_retries("[send_sms('1234'), send_mail()]")
+    0
+    '''
+    if len(NOTIFICATION_CALLS.findall(notification)) > 1:
+        return 0
+    return None
+
+
+def _notification_provider(notification):
+    '''
+    Provider of the notification, its queue in the notification dispatcher
+
+    >>> _notification_provider("send_email(per_entity=True, repeat=600)")
+    'mail'
+    >>> _notification_provider("notify_slack(channel='#alerts')")
+    'slack'
+    >>> _notification_provider("[send_sms('1234'), send_mail()]")
+    'other'
+    '''
+    match = NOTIFICATION_CALL.match(notification)
+    if not match:
+        return 'other'
+    return NOTIFICATION_PROVIDER_ALIASES.get(match.group(1), match.group(1))
+
+
 def _prepare_condition(condition):
     '''function to prepend "value" to condition if necessary
 
@@ -589,6 +737,43 @@ def _log_event(event_name, alert, result, entity=None):
     eventloghttp.log(EVENTS[event_name].id, **params)
 
 
+def parse_simple_condition(condition):
+    '''
+    Split a comparison of the value with a literal, like ">100", into the operator and the literal. Returns None for
+    any other condition.
+
+    >>> parse_simple_condition('>= -1.5')
+    (<built-in function ge>, -1.5)
+    >>> parse_simple_condition('!= "OK"')
+    (<built-in function ne>, 'OK')
+    >>> parse_simple_condition('> 0 and value < 10') is None
+    True
+
+    The literal is the one safe_eval would see:
+
+    >>> op, literal = parse_simple_condition('>10')
+    >>> op(9, literal) == evaluate_condition(9, '>10')
+    True
+    >>> parse_simple_condition('>010') is None, evaluate_condition(9, '>010')
+    (True, True)
+    >>> parse_simple_condition(u'== "\\xe9"') is None
+    True
+    '''
+    match = SIMPLE_COMPARISON_PATTERN.match(condition)
+    if not match:
+        return None
+    op, literal = match.groups()
+    if literal in SIMPLE_COMPARISON_CONSTANTS:
+        literal = SIMPLE_COMPARISON_CONSTANTS[literal]
+    elif literal[0] in '\'"':
+        literal = literal[1:-1]
+    elif literal.lstrip('-').isdigit():
+        literal = int(literal)
+    else:
+        literal = float(literal)
+    return SIMPLE_COMPARISON_OPERATORS[op], literal
+
+
 def evaluate_condition(val, condition, **ctx):
     '''
 
@@ -626,12 +811,15 @@ class Try(Callable):
             return self.except_call(e)
 
 
-def get_results_user(count=1, con=None, check_id=None, entity_id=None):
-    return map(lambda x: x['value'], get_results(con, check_id, entity_id, count))
+def get_results_user(count=1, con=None, check_id=None, entity_id=None, history=None):
+    return map(lambda x: x['value'], get_results(con, check_id, entity_id, count, history=history))
+
 
+def get_results(con, check_id, entity_id, count=1, history=None):
+    if history is not None:
+        return history.get(count)
 
-def get_results(con, check_id, entity_id, count=1):
-    r = map(json.loads, con.lrange('zmon:checks:{}:{}'.format(check_id, entity_id), 0, count - 1))
+    r = map(decode_history, con.lrange('zmon:checks:{}:{}'.format(check_id, entity_id), 0, count - 1))
 
     for x in r:
         x.update({'entity_id': entity_id})
@@ -639,6 +827,55 @@ def get_results(con, check_id, entity_id, count=1):
     return r
 
 
+class CheckHistory(object):
+    '''
+    Latest results of a check on an entity, as get_results() returns them, shared by all the alerts evaluated for one
+    check result. The history is read once, deep enough for the usual conditions, and results are only decoded when
+    asked for. head is the entry of the result just stored, which spares the round trip for the latest result.
+    Results are shared: conditions must not change them.
+
+    >>> from mock import MagicMock
+    >>> con = MagicMock()
+    >>> con.lrange.return_value = ['{"value": 2}', '{"value": 1}']
+    >>> history = CheckHistory(con, 1, 'e1', head='{"value": 3}')
+    >>> history.get(1) == [{'entity_id': 'e1', 'value': 3}]
+    True
+    >>> con.lrange.called
+    False
+    >>> [r['value'] for r in history.get(10)], [r['value'] for r in history.get(2)]
+    ([3, 2, 1], [3, 2])
+    >>> con.lrange.call_args_list
+    [call('zmon:checks:1:e1', 1, 19)]
+    '''
+
+    def __init__(self, con, check_id, entity_id, head=None, depth=DEFAULT_CHECK_RESULTS_HISTORY_LENGTH):
+        self.con = con
+        self.key = 'zmon:checks:{}:{}'.format(check_id, entity_id)
+        self.entity_id = entity_id
+        self.depth = depth
+        self._raw = [] if head is None else [head]
+        self._decoded = []
+        self._complete = False  # all results in redis are read
+
+    def get(self, count=1):
+        if count > len(self._raw) and not self._complete:
+            start = len(self._raw)
+            size = max(count, self.depth)
+            self._raw.extend(self.con.lrange(self.key, start, size - 1))
+            self._complete = len(self._raw) < size
+        while len(self._decoded) < min(count, len(self._raw)):
+            r = decode_history(self._raw[len(self._decoded)])
+            r['entity_id'] = self.entity_id
+            self._decoded.append(r)
+        return self._decoded[:count]
+
+    def series(self, count=DEFAULT_CHECK_RESULTS_HISTORY_LENGTH, key=None):
+        '''
+        The latest count results as a Series, key maps each value to a number, e.g. series(key=lambda v: v['load'])
+        '''
+        return Series.from_results(self.get(count), key=key)
+
+
 def avg(sequence):
     '''
     >>> avg([])
@@ -761,8 +998,9 @@ class MainTask(object):
     _port = 6379
     _secure_queue = 'zmon:queue:secure'
     _db = 0
-    _con = None
     _counter = Counter()
+    _gauges = {}
+    _counter_lock = threading.Lock()
     _last_metrics_sent = 0
     _last_captures_sent = 0
     _logger = None
@@ -774,6 +1012,9 @@ class MainTask(object):
     _worker_name = None
     _queues = None
     _safe_repositories = []
+    _shedding_lag = 0
+    _async_notifications = False
+    _notification_pending_timeout = NOTIFICATION_PENDING_TIMEOUT
 
     _is_secure_worker = True
 
@@ -797,6 +1038,8 @@ class MainTask(object):
         except KeyError:
             logger.exception('Error creating connection: ')
             raise
+        # response bytes of all plugins count into the http_bytes of the running check
+        install_http_accounting()
         # cls._loglevel = (logging.getLevelName(config['loglevel']) if 'loglevel' in config else logging.INFO)
         cls._kairosdb_enabled = config.get('kairosdb.enabled')
         cls._kairosdb_host = config.get('kairosdb.host')
@@ -804,6 +1047,36 @@ class MainTask(object):
         cls._zmon_url = config.get('zmon.url')
         cls._queues = config.get('zmon.queues', 'zmon:queue:default/16')
         cls._safe_repositories = sorted(config.get('safe_repositories', []))
+        cls._shedding_lag = int(config.get('zmon.shedding.lag', 0))
+
+        # code objects of check commands, alert conditions and notifications
+        compile_cache.resize(int(config.get('zmon.eval.cache.size', COMPILE_CACHE_SIZE)))
+        # results of plugin calls wrapped with cached() in check commands
+        call_cache.configure(maxsize=int(config.get('zmon.call_cache.size', CALL_CACHE_SIZE)),
+                             maxbytes=int(config.get('zmon.call_cache.bytes', CALL_CACHE_BYTES)),
+                             max_ttl=int(config.get('zmon.call_cache.max_ttl', CALL_CACHE_MAX_TTL)))
+        # results of all entities of an alert, shared by its tasks. Should stay below the shortest check interval.
+        entity_results_cache.configure(maxsize=int(config.get('zmon.entity_results.cache_size',
+                                                              ENTITY_RESULTS_CACHE_SIZE)),
+                                       max_ttl=int(config.get('zmon.entity_results.cache_ttl',
+                                                              ENTITY_RESULTS_CACHE_TTL)))
+        # downtimes of all alerts, reloaded when they change. See common/downtimes.py
+        # notifications sent in the background, see notifications/dispatcher.py
+        cls._async_notifications = bool(config.get('zmon.notifications.async', False))
+        cls._notification_pending_timeout = float(config.get('zmon.notifications.pending_timeout',
+                                                             NOTIFICATION_PENDING_TIMEOUT))
+        concurrency_prefix = 'zmon.notifications.concurrency.'
+        notification_dispatcher.configure(
+            queue_size=int(config.get('zmon.notifications.queue_size', NOTIFICATION_QUEUE_SIZE)),
+            concurrency={k[len(concurrency_prefix):]: int(v) for k, v in config.items()
+                         if k.startswith(concurrency_prefix)},
+            default_concurrency=int(config.get('zmon.notifications.concurrency', NOTIFICATION_CONCURRENCY)),
+            retries=int(config.get('zmon.notifications.retries', NOTIFICATION_RETRIES)),
+            retry_delay=float(config.get('zmon.notifications.retry_delay', NOTIFICATION_RETRY_DELAY)))
+        downtime_index.configure(check_interval=float(config.get('zmon.downtimes.check_interval',
+                                                                 DOWNTIMES_CHECK_INTERVAL)),
+                                 max_age=float(config.get('zmon.downtimes.max_age', DOWNTIMES_MAX_AGE)),
+                                 notifications=bool(config.get('zmon.downtimes.notifications', False)))
 
         cls._logger = cls.get_configured_logger()
 
@@ -850,6 +1123,11 @@ class MainTask(object):
         cls.max_result_history_size = min(
             int(config.get('result.history.size', DEFAULT_CHECK_RESULTS_HISTORY_LENGTH)),
             DEFAULT_CHECK_RESULTS_HISTORY_LENGTH)
+        # Encoding of new history entries, readers understand all of them. Other readers of the history (e.g. the
+        # controller) must understand the compact encodings before they are enabled.
+        cls.result_history_encoding = config.get('result.history.encoding', 'json')
+        if cls.result_history_encoding not in HISTORY_ENCODINGS:
+            raise ValueError('result.history.encoding must be one of {}'.format(', '.join(HISTORY_ENCODINGS)))
         # Result limits
         cls.max_result_size = int(config.get('result.size', MAX_RESULT_SIZE))
         cls.max_result_keys = int(config.get('result.keys.count', MAX_RESULT_KEYS))
@@ -861,9 +1139,37 @@ class MainTask(object):
         cls._entity_tags = set(config.get('zmon.entity.tags', '').replace(' ', '').split(','))
 
     def __init__(self):
-        self.task_context = None
+        # a worker process may run several tasks at once in different threads, keep per task state thread local
+        self._task_local = threading.local()
         self._cmds_first_accessed = False
 
+    @property
+    def task_context(self):
+        return getattr(self._task_local, 'task_context', None)
+
+    @task_context.setter
+    def task_context(self, value):
+        self._task_local.task_context = value
+
+    @property
+    def _stored_results(self):
+        if not hasattr(self._task_local, 'stored_results'):
+            self._task_local.stored_results = {}
+        return self._task_local.stored_results
+
+    @property
+    def deadline(self):
+        return getattr(self._task_local, 'deadline', None)
+
+    def start_deadline(self, req, task_context):
+        """
+        Start the time budget of the check from the soft time limit of the task, or the check interval for tasks
+        without time limits. Plugins get it in their factory_ctx.
+        """
+        timelimit = ((task_context or {}).get('task_properties') or {}).get('timelimit')
+        self._task_local.deadline = Deadline(timelimit[1] if timelimit else req['interval'])
+        return self._task_local.deadline
+
     @classmethod
     def is_secure_worker(cls):
         return cls._is_secure_worker
@@ -876,9 +1182,10 @@ class MainTask(object):
 
     @property
     def con(self):
-        self._con = RedisConnHandler.get_instance().get_conn()
-        BaseNotification.set_redis_con(self._con)
-        return self._con
+        # RedisConnHandler instances are thread local, so each task thread gets its own connection
+        con = RedisConnHandler.get_instance().get_conn()
+        BaseNotification.set_redis_con(con)
+        return con
 
     @property
     def logger(self):
@@ -896,17 +1203,40 @@ class MainTask(object):
     def get_redis_port(self):
         return RedisConnHandler.get_instance().get_parsed_redis().port
 
+    def update_counter(self, counts):
+        with self._counter_lock:
+            self._counter.update(counts)
+
+    def update_gauge_max(self, name, value):
+        """Keep the max value seen in the current metrics interval"""
+        with self._counter_lock:
+            self._gauges[name] = max(value, self._gauges.get(name, value))
+
     def send_metrics(self):
         now = time.time()
         if now > self._last_metrics_sent + METRICS_INTERVAL:
+            with self._counter_lock:
+                if now <= self._last_metrics_sent + METRICS_INTERVAL:
+                    return  # other task thread was faster
+                counter = self._counter.copy()
+                self._counter.clear()
+                gauges = self._gauges.copy()
+                self._gauges.clear()
+                gauges.update(('eval.cache.{}'.format(k), v) for k, v in compile_cache.stats().items())
+                gauges.update(('call.cache.{}'.format(k), v) for k, v in call_cache.stats().items())
+                gauges.update(('entity_results.cache.{}'.format(k), v) for k, v in entity_results_cache.stats().items())
+                gauges.update(('downtimes.{}'.format(k), v) for k, v in downtime_index.stats().items())
+                gauges.update(('notifications.{}'.format(k), v) for k, v in notification_dispatcher.stats().items())
+                self._last_metrics_sent = now
+
             p = self.con.pipeline()
             p.sadd('zmon:metrics', self.worker_name)
-            for key, val in self._counter.items():
+            for key, val in counter.items():
                 p.incrby('zmon:metrics:{}:{}'.format(self.worker_name, key), val)
+            for key, val in gauges.items():
+                p.set('zmon:metrics:{}:{}'.format(self.worker_name, key), val)
             p.set('zmon:metrics:{}:ts'.format(self.worker_name), now)
             p.execute()
-            self._counter.clear()
-            self._last_metrics_sent = now
             # self.logger.info(
             #     'Send metrics, end storing metrics in redis count: %s, duration: %.3fs',
             #     len(self._counter), time.time() - now)
@@ -951,7 +1281,6 @@ class MainTask(object):
                         'team': team,
                         'account': account,
                         'region': region,
-                        'results': results,
                     }
 
                     current_span.set_tag('check_id', check_id)
@@ -959,7 +1288,8 @@ class MainTask(object):
                     # we can skip this data, this problem will never fix itself
                     serialized_data = None
                     try:
-                        serialized_data = json.dumps(worker_result, cls=JsonDataEncoder)
+                        serialized_results = ','.join(cls._serialize_dataservice_result(cr) for cr in results)
+                        serialized_data = dumps_with_raw(worker_result, results='[' + serialized_results + ']')
                     except Exception as ex:
                         logger.exception('Failed to serialize data for check {} {}: {}'.format(check_id, ex, results))
                         current_span.set_tag('skip_check_result', True)
@@ -975,6 +1305,19 @@ class MainTask(object):
             logger.error('Error in data service send: url={} ex={}'.format(cls._dataservice_url, ex))
             raise
 
+    @staticmethod
+    def _serialize_dataservice_result(cr):
+        '''
+        Serialize a result for the data service, reusing the encoding of the check result computed for redis.
+
+        >>> MainTask._serialize_dataservice_result({'check_id': 1, 'check_result': CheckResult(value=2)})
+        '{"check_id":1,"check_result":{"value":2}}'
+        '''
+        if 'check_result' not in cr:
+            return dumps_compact(cr)
+        return dumps_with_raw({k: v for k, v in cr.items() if k != 'check_result'},
+                              check_result=CheckResult.encode(cr['check_result']))
+
     def is_sampled(self, sampling_config, check_id, interval, is_alert, alert_changed, current_span):
         """
         Return sampling bool flag. Sampling flag is computed via random non-uniform sampling.
@@ -997,9 +1340,8 @@ class MainTask(object):
         # check if we have a specific sampling for this worker (account)
         worker_sampling = sampling_config.get('worker_sampling', {}).get(self._account, None)
         default_sampling = sampling_config.get('default_sampling', 100)
-        critical_checks = sampling_config.get('critical_checks', [])
 
-        if str(check_id) in critical_checks or check_id in critical_checks:
+        if is_critical_check(sampling_config, check_id):
             current_span.set_tag('sampling_ignored', True)
             current_span.set_tag('critical_check', True)
             return True
@@ -1011,6 +1353,34 @@ class MainTask(object):
 
         return bool(numpy.random.choice([False, True], 1, p=(1 - sampling, sampling)))
 
+    def is_shed(self, sampling_config, check_id, interval, schedule_time, current_span):
+        """
+        Return True if this check run should be skipped on purpose because the worker lags behind.
+
+        Lag is measured from schedule_time to execution start. Once it passes zmon.shedding.lag seconds, non-critical
+        checks with an interval below SAMPLING_INTERVAL_THRESHOLD run with probability zmon.shedding.lag / lag, so the
+        more we lag the more we shed. Critical and long interval checks always run.
+        """
+        if not schedule_time:
+            return False
+
+        lag = max(time.time() - schedule_time, 0)
+        self.update_gauge_max('tasks.lag.max', round(lag, 3))
+
+        if not self._shedding_lag or lag <= self._shedding_lag:
+            return False
+
+        if int(interval) >= SAMPLING_INTERVAL_THRESHOLD or is_critical_check(sampling_config, check_id):
+            return False
+
+        shed = random.random() >= float(self._shedding_lag) / lag
+
+        self.update_counter({'shedding.skipped' if shed else 'shedding.kept': 1})
+        current_span.set_tag('task_lag', lag)
+        current_span.set_tag('load_shedding', shed)
+
+        return shed
+
     @trace(pass_span=True)
     def check_and_notify(self, req, alerts, task_context=None, **kwargs):
         # Current OpenTracing span.
@@ -1019,8 +1389,9 @@ class MainTask(object):
         sampling_config = kwargs.get('sampling_config', {})
 
         self.task_context = task_context
+        self._stored_results.clear()
         start_time = time.time()
-        # soft_time_limit = req['interval']
+        self.start_deadline(req, task_context)
         check_id = req['check_id']
         entity_id = req['entity']['id']
 
@@ -1028,32 +1399,36 @@ class MainTask(object):
         current_span.set_tag('entity_id', entity_id)
         current_span.log_kv({'alerts': [a['id'] for a in alerts]})
 
+        if self.is_shed(sampling_config, check_id, req['interval'], req.get('schedule_time'), current_span):
+            self.send_metrics()
+            return
+
+        val, failed = self._check_for_notify(req, start_time, current_span)
+        if failed:
+            self.notify(val, req, alerts, force_alert=True)
+        else:
+            self.notify(val, req, alerts, sampling_config=sampling_config)
+
+    def _check_for_notify(self, req, start_time, current_span):
+        """
+        Run the check of req, returns the value to notify and whether the check failed.
+        """
+        check_id = req['check_id']
+        entity_id = req['entity']['id']
         try:
-            val = self.check(req)
-        # TODO: need to support soft and hard time limits soon
-        # except SoftTimeLimitExceeded, e:
-        #     self.logger.info('Check request with id %s on entity %s exceeded soft time limit', check_id,
-        #                                  entity_id)
-        #     # PF-3685 It might happen that this exception was raised after sending a command to redis, but before
-        #     # receiving a response. In this case, the connection object is "dirty" and when the same connection gets
-        #     # taken out of the pool and reused, it'll throw an exception in redis client.
-        #     self.con.connection_pool.disconnect()
-        #     notify(check_and_notify, {'ts': start_time, 'td': soft_time_limit, 'value': str(e)}, req, alerts,
-        #            force_alert=True)
+            return self.check(req), False
+        # Checks running out of their soft time limit raise TimeLimitExceeded, a CheckError
         except CheckError, e:
-            self.notify({'ts': start_time, 'td': time.time() - start_time, 'value': str(e), 'worker': self.worker_name,
-                         'exc': 1}, req, alerts,
-                        force_alert=True)
+            if self._batch_time_limit_exceeded(e):
+                raise  # skipped by check_and_notify_batch
+            return {'ts': start_time, 'td': time.time() - start_time, 'value': str(e), 'worker': self.worker_name,
+                    'exc': 1}, True
         except SecurityError, e:
             self.logger.exception('Security exception in request with id %s on entity %s', check_id, entity_id)
             current_span.set_tag('security_exception', True)
             current_span.log_kv({'exception': str(e)})
-            self.notify(
-                {
-                    'ts': start_time, 'td': time.time() - start_time, 'value': str(e), 'worker': self.worker_name,
-                    'exc': 1
-                },
-                req, alerts, force_alert=True)
+            return {'ts': start_time, 'td': time.time() - start_time, 'value': str(e), 'worker': self.worker_name,
+                    'exc': 1}, True
         except Exception, e:
             # self.logger.exception('Check request with id %s on entity %s threw an exception', check_id, entity_id)
             # PF-3685 Disconnect on unknown exceptions: we don't know what actually happened, it might be that redis
@@ -1061,11 +1436,94 @@ class MainTask(object):
             # a different response than expected, the user doesn't have access to the checked entity or there's an
             # error in check's parameters.
             self.con.connection_pool.disconnect()
-            self.notify({'ts': start_time, 'td': time.time() - start_time, 'value': str(e), 'worker': self.worker_name,
-                         'exc': 1}, req, alerts,
-                        force_alert=True)
-        else:
-            self.notify(val, req, alerts, sampling_config=sampling_config)
+            return {'ts': start_time, 'td': time.time() - start_time, 'value': str(e), 'worker': self.worker_name,
+                    'exc': 1}, True
+
+    @trace(pass_span=True)
+    def check_and_notify_batch(self, req, entities, alerts, task_context=None, **kwargs):
+        """
+        Run one check definition for many entities, for the results check_and_notify would give for each of them.
+
+        req is the check request without entity, entities a list of {'entity': {...}, 'alert_ids': [...]}: the ids of
+        the alerts of the list alerts that apply to the entity, all of them if alert_ids is missing.
+
+        Entities are checked in chunks of CHECK_BATCH_CHUNK: the results of a chunk are stored in a single redis
+        pipeline, then its alerts are evaluated, they can rely on the current result being in the check history as
+        with check_and_notify. A task killed at its hard time limit loses the results of one chunk at most.
+
+        Every entity gets the check interval as its own deadline, bounded by what is left of the time limit of the
+        task. Once the task runs out of time the remaining entities are skipped, they are not alerted as failed.
+        """
+        current_span = extract_span_from_kwargs(**kwargs)
+
+        sampling_config = kwargs.get('sampling_config', {})
+
+        self.task_context = task_context
+        self._stored_results.clear()
+        task_deadline = self.start_deadline(req, task_context)
+        check_id = req['check_id']
+
+        current_span.set_tag('check_id', check_id)
+        current_span.set_tag('entity_count', len(entities))
+        current_span.log_kv({'alerts': [a['id'] for a in alerts]})
+
+        if self.is_shed(sampling_config, check_id, req['interval'], req.get('schedule_time'), current_span):
+            self.send_metrics()
+            return
+
+        done = 0
+        self._task_local.batch_deadline = task_deadline
+        try:
+            while done < len(entities) and not task_deadline.expired():
+                checked = []
+                with self.batched_result_writes():
+                    for item in entities[done:done + CHECK_BATCH_CHUNK]:
+                        remaining = task_deadline.remaining()
+                        if remaining <= 0:
+                            break
+                        self._task_local.deadline = Deadline(min(req['interval'], remaining))
+                        entity_req = dict(req, entity=item['entity'])
+                        start_time = time.time()
+                        try:
+                            val, failed = self._check_for_notify(entity_req, start_time, current_span)
+                        except TimeLimitExceeded:
+                            break  # cut short by the time limit of the task, skipped
+                        checked.append((entity_req, item.get('alert_ids'), val, failed))
+                done += len(checked)
+
+                for entity_req, alert_ids, val, failed in checked:
+                    entity_alerts = alerts if alert_ids is None else [a for a in alerts if a['id'] in alert_ids]
+                    if failed:
+                        self.notify(val, entity_req, entity_alerts, force_alert=True)
+                    else:
+                        self.notify(val, entity_req, entity_alerts, sampling_config=sampling_config)
+        finally:
+            self._task_local.batch_deadline = None
+            self._task_local.deadline = task_deadline
+
+        skipped = len(entities) - done
+        if skipped:
+            self.logger.warning('Time limit of %ss exceeded, skipped %s of %s entities of check %s',
+                                task_deadline.seconds, skipped, len(entities), check_id)
+            self.update_counter({'batch.skipped_entities': skipped})
+            current_span.set_tag('skipped_entities', skipped)
+            self.send_metrics()
+
+    def _batch_time_limit_exceeded(self, e):
+        batch_deadline = getattr(self._task_local, 'batch_deadline', None)
+        return isinstance(e, TimeLimitExceeded) and batch_deadline is not None and batch_deadline.expired()
+
+    @contextmanager
+    def batched_result_writes(self):
+        """
+        Queue the check results stored by this task in a redis pipeline sent when leaving the block.
+        """
+        self._task_local.result_pipe = self.con.pipeline(transaction=False)
+        try:
+            yield
+        finally:
+            pipe, self._task_local.result_pipe = self._task_local.result_pipe, None
+            pipe.execute()
 
     @trace(pass_span=True)
     def trial_run(self, req, alerts, task_context=None, **kwargs):
@@ -1074,19 +1532,13 @@ class MainTask(object):
 
         self.task_context = task_context
         start_time = time.time()
-        # soft_time_limit = req['interval']
+        self.start_deadline(req, task_context)
         entity_id = req['entity']['id']
 
         current_span.set_tag('entity_id', entity_id)
 
         try:
             val = self.check_for_trial_run(req)
-        # TODO: need to support soft and hard time limits soon
-        # except SoftTimeLimitExceeded, e:
-        #     trial_run.logger.info('Trial run on entity %s exceeded soft time limit', entity_id)
-        #     trial_run.con.connection_pool.disconnect()
-        #     notify_for_trial_run(trial_run, {'ts': start_time, 'td': soft_time_limit, 'value': str(e)}, req, alerts,
-        #                          force_alert=True)
         except InsufficientPermissionsError, e:
             self.logger.info('Access denied for user %s to run check on %s', req['created_by'], entity_id)
             self.notify_for_trial_run({'ts': start_time, 'td': time.time() - start_time, 'value': str(e)}, req,
@@ -1221,28 +1673,36 @@ class MainTask(object):
             pipeline.delete('zmon:{}:{}:{}'.format(entry_type, entry_id, entity))
 
     def _store_check_result(self, req, result):
-        self.con.sadd('zmon:checks', req['check_id'])
-        self.con.sadd('zmon:checks:{}'.format(req['check_id']), req['entity']['id'])
+        con = getattr(self._task_local, 'result_pipe', None) or self.con
+        con.sadd('zmon:checks', req['check_id'])
+        con.sadd('zmon:checks:{}'.format(req['check_id']), req['entity']['id'])
         key = 'zmon:checks:{}:{}'.format(req['check_id'], req['entity']['id'])
         value = 'NONE'
         try:
-            value = json.dumps(result, cls=JsonDataEncoder)
+            value = encode_history(CheckResult.encode(result), self.result_history_encoding)
         except Exception, e:
             self.logger.exception('failed to serialize check result for check %s', req['check_id'])
             value = 'Serialization error: {}'.format(e)
-        self.con.lpush(key, value)
-        self.con.ltrim(key, 0, self.max_result_history_size - 1)
+        add_cost('result_bytes', len(value))
+        con.lpush(key, value)
+        con.ltrim(key, 0, self.max_result_history_size - 1)
+        # head of the history the alerts of this result read, see notify
+        self._stored_results[key] = value
 
     def _check_result_limit(self, result):
-        if isinstance(result, dict):
-            key_count = len(flatten(result).keys())
-            if key_count > self.max_result_keys:
-                raise ResultSizeError(
-                    'Result keys count ({}) exceeded the maximum value: {}'.format(key_count, self.max_result_keys))
+        if not isinstance(result, CheckResult):
+            result = CheckResult(result)
+
+        # flattened keys of the result, the worker name added by us does not count
+        value_keys = len(result.flat_value) if result.flat_value is not None else 1
+        key_count = value_keys + len([k for k in result if k not in ('value', 'worker')])
+        if key_count > self.max_result_keys:
+            raise ResultSizeError(
+                'Result keys count ({}) exceeded the maximum value: {}'.format(key_count, self.max_result_keys))
 
         result_str = ''
         try:
-            result_str = json.dumps(result, separators=(',', ':'), cls=JsonDataEncoder)
+            result_str = result.json
         except Exception, e:
             self.logger.exception('failed to serialize check result')
             result_str = 'Serialization error: {}'.format(e)
@@ -1255,6 +1715,11 @@ class MainTask(object):
 
     @trace()
     def check(self, req):
+        # wall and cpu time, result size, redis round trips and http bytes: shipped to the parent with the pings
+        with account_check(req['check_id']):
+            return self._check(req)
+
+    def _check(self, req):
 
         self.logger.debug(req)
         # schedule_time = req['schedule_time']
@@ -1266,14 +1731,16 @@ class MainTask(object):
             setp(req['check_id'], req['entity']['id'], 'done')
         except Exception, e:
             # PF-3778 Always store check results and re-raise exception which will be handled in 'check_and_notify'.
-            self._store_check_result(
-                req, {
-                    'td': round(time.time() - start, ROUND_SECONDS_DIGITS),
-                    'ts': round(start, ROUND_SECONDS_DIGITS),
-                    'value': str(e),
-                    'worker': self.worker_name,
-                    'exc': 1
-                })
+            # Checks of a batch cut short by the time limit of the task are skipped, they have no result.
+            if not self._batch_time_limit_exceeded(e):
+                self._store_check_result(
+                    req, {
+                        'td': round(time.time() - start, ROUND_SECONDS_DIGITS),
+                        'ts': round(start, ROUND_SECONDS_DIGITS),
+                        'value': str(e),
+                        'worker': self.worker_name,
+                        'exc': 1
+                    })
             raise
         finally:
             # Store duration in milliseconds as redis only supports integers for counters.
@@ -1282,7 +1749,7 @@ class MainTask(object):
             # 'check.{}.duration'.format(req['check_id']): int(round(1000.0 * (time.time() - start))),
             # 'check.{}.latency'.format(req['check_id']): int(round(1000.0 * (start - schedule_time))),
 
-            self._counter.update({
+            self.update_counter({
                 'check.count': 1
             })
 
@@ -1305,10 +1772,9 @@ class MainTask(object):
                 'application_version': req['entity'].get('application_version', '1')
             }
             try:
-                requests.post(self._metric_cache_url,
-                              data=json.dumps([{'entity_id': req['entity']['id'],
-                                                'entity': temp_entity,
-                                                'check_result': res}], cls=JsonDataEncoder))
+                body = dumps_with_raw({'entity_id': req['entity']['id'], 'entity': temp_entity},
+                                      check_result=CheckResult.encode(res))
+                requests.post(self._metric_cache_url, data='[{}]'.format(body))
             except Exception:
                 logger.exception('failed to write to metric cache...')
                 pass
@@ -1328,7 +1794,12 @@ class MainTask(object):
         self._enforce_security(req)
         cmd = req['command']
 
-        ctx = self._build_check_context(req)
+        try:
+            names = referenced_names(cmd, eval_source='<check-command>')
+        except Exception:
+            names = None  # not a valid command, safe_eval() raises the proper error below
+
+        ctx = self._build_check_context(req, names=names)
         try:
             result = safe_eval(cmd, eval_source='<check-command>', **ctx)
             return result() if isinstance(result, Callable) else result
@@ -1338,15 +1809,18 @@ class MainTask(object):
         except (SecurityError, InsufficientPermissionsError), e:
             raise(e)
         except Exception, e:
+            if self.deadline is not None and self.deadline.expired():
+                # most likely a plugin call cut short by the deadline: fail cleanly, not with a traceback
+                raise TimeLimitExceeded(self.deadline.seconds), None, sys.exc_info()[2]
             raise Exception(traceback.format_exc())
 
     def _get_check_result(self, req):
-        r = self._get_check_result_internal(req)
+        # the JSON encoding and flattened views computed for the limits are reused by all the sinks
+        r = CheckResult(self._get_check_result_internal(req))
+        r['worker'] = self.worker_name
 
         self._check_result_limit(r)
 
-        r['worker'] = self.worker_name
-
         return r
 
     def _enforce_security(self, req):
@@ -1381,11 +1855,25 @@ class MainTask(object):
 
                 self.logger.warn('secure req[entity] after pp- transformations: %s', req['entity'])
 
-    def _build_check_context(self, req):
-        '''Build context for check command with all necessary functions'''
+    def _build_check_context(self, req, names=None):
+        '''
+        Build context for check command with all necessary functions. Functions from plugins are only created if the
+        command references them: names holds the names the command looks up, None means all of them.
+        '''
 
         entity = req['entity']
 
+        # check execution context
+        ctx = build_default_context()
+        ctx['entity'] = entity
+
+        if names is None:
+            names = self._function_factories.keys()
+        factories = [(func_name, self._function_factories[func_name]) for func_name in names
+                     if func_name in self._function_factories and func_name not in ctx]
+        if not factories:
+            return ctx
+
         # function creation context: passed to function factories create() method
         factory_ctx = {
             'entity': entity,
@@ -1402,6 +1890,7 @@ class MainTask(object):
             'jmx_port': _get_jmx_port(entity),
             'shards': _get_shards(entity),
             'soft_time_limit': req['interval'],
+            'deadline': self.deadline,
             'redis_host': self.get_redis_host(),
             'redis_port': self.get_redis_port(),
             'zmon_url': MainTask._zmon_url,
@@ -1409,14 +1898,14 @@ class MainTask(object):
             'req_created_by': req.get('created_by'),
         }
 
-        # check execution context
-        ctx = build_default_context()
-        ctx['entity'] = entity
-
         # populate check context with functions from plugins' function factories
-        for func_name, func_factory in self._function_factories.items():
-            if func_name not in ctx:
-                ctx[func_name] = func_factory.create(factory_ctx)
+        for func_name, func_factory in factories:
+            ctx[func_name] = func_factory.create(factory_ctx)
+
+        # cached(ttl=30).<plugin function>(...).<method>(...) shares the method results between tasks
+        plugin_functions = {func_name: ctx[func_name] for func_name, _ in factories}
+        ctx['cached'] = functools.partial(CachedCalls, plugin_functions, entity_id=entity['id'],
+                                          scope=(req['check_id'], req.get('created_by'), self._is_secure_worker))
         return ctx
 
     def _store_check_result_to_kairosdb(self, req, result):
@@ -1447,34 +1936,20 @@ class MainTask(object):
 
         values = []
 
-        ts = int(result['ts'] * 1000)
-        if isinstance(result['value'], dict):
-
-            if '_use_scheduled_time' in result['value']:
-                ts = int(req['schedule_time'] * 1000)
-                del result['value']['_use_scheduled_time']
-
-            flat_result = flatten(result['value'])
-
-            for k, v in flat_result.iteritems():
+        if not isinstance(result, CheckResult):
+            result = CheckResult(result)
 
-                try:
-                    v = float(v)
-                except (ValueError, TypeError):
-                    continue
+        ts = int(result['ts'] * 1000)
+        if isinstance(result['value'], dict) and '_use_scheduled_time' in result['value']:
+            ts = int(req['schedule_time'] * 1000)
+            del result['value']['_use_scheduled_time']
+            result.invalidate()
 
-                points = [[ts, v]]
-                tags = get_tags(req['entity'], k)
-                values.append(get_kairosdb_value(series_name, points, tags))
-        else:
-            try:
-                v = float(result['value'])
-            except (ValueError, TypeError):
-                pass
-            else:
-                points = [[ts, v]]
-                tags = get_tags(req['entity'], None)
-                values.append(get_kairosdb_value(series_name, points, tags))
+        # flattened numeric leaves of a dict value, or {None: value} for a numeric value
+        for k, v in result.numeric_values.iteritems():
+            points = [[ts, v]]
+            tags = get_tags(req['entity'], k)
+            values.append(get_kairosdb_value(series_name, points, tags))
 
         if len(values) > 0:
             self.logger.debug(values)
@@ -1490,7 +1965,7 @@ class MainTask(object):
             except Exception:
                 self.logger.exception('KairosDB write failed')
 
-    def evaluate_alert(self, alert_def, req, result):
+    def evaluate_alert(self, alert_def, req, result, history=None):
         '''Check if the result triggers an alert
 
         The function will save the global alert state to the following redis keys:
@@ -1509,13 +1984,22 @@ class MainTask(object):
         alert_parameters = alert_def.get('parameters')
 
         try:
-            result = evaluate_condition(
-                result['value'], alert_def['condition'], **build_condition_context(self.con,
-                                                                                   check_id,
-                                                                                   alert_id,
-                                                                                   req['entity'],
-                                                                                   captures,
-                                                                                   alert_parameters))
+            # parameters are not referenced by simple conditions, but they are still validated in the context
+            simple = None if alert_parameters else parse_simple_condition(alert_def['condition'])
+            if simple:
+                # fast path: no context to build and nothing to evaluate
+                compare, literal = simple
+                result = compare(result['value'], literal)
+            else:
+                condition = _prepare_condition(alert_def['condition'])
+                try:
+                    names = referenced_names(condition, eval_source='<alert-condition>')
+                except Exception:
+                    names = None  # not a valid condition, safe_eval() raises the proper error below
+                result = evaluate_condition(
+                    result['value'], condition, **build_condition_context(self.con, check_id, alert_id, req['entity'],
+                                                                          captures, alert_parameters, names=names,
+                                                                          history=history))
         except Exception, e:
             captures['exception'] = traceback.format_exc()
             result = True
@@ -1540,18 +2024,53 @@ class MainTask(object):
 
         return is_alert, captures
 
-    def send_notification(self, notification, context):
-        ctx = _build_notify_context(context)
+    def send_notification(self, notification, context, con=None):
+        if self._async_notifications:
+            # Reserve the repeat slot right away, so the next run of the check does not queue the notification again
+            # while it is pending. The dispatcher threads store the actual repeat time once it is sent, a notification
+            # that could not be sent is repeated when the reservation expires.
+            self.con.hset(_notifications_key(context), notification, time.time() + self._notification_pending_timeout)
+            notification_dispatcher.submit(
+                _notification_provider(notification), self._send_notification,
+                (notification, dict(context), None, True),
+                'alertId={} entity={}'.format(context['alert_def']['id'], context['entity']['id']),
+                retries=_notification_retries(notification))
+            return
         try:
-            repeat = safe_eval(notification, eval_source='<check-command>', **ctx)
+            self._send_notification(notification, context, con)
         except Exception:
             # TODO Define what should happen if sending emails or sms fails.
             self.logger.exception('Sending notification failed! alertId={} entity={}'.format(context['alert_def']['id'],
                                                                                              context['entity']['id']))
-        else:
-            if repeat:
-                self.con.hset('zmon:notifications:{}:{}'.format(context['alert_def']['id'], context['entity']['id']),
-                              notification, time.time() + repeat)
+
+    def _send_notification(self, notification, context, con=None, reserved=False):
+        repeat = safe_eval(notification, eval_source='<check-command>', **_build_notify_context(context))
+        if repeat:
+            (con or self.con).hset(_notifications_key(context), notification, time.time() + repeat)
+        elif reserved:
+            (con or self.con).hdel(_notifications_key(context), notification)
+
+    def _transition_alerts(self, entity_id, alerts):
+        """
+        Move the entity in or out of the given alerts and store its captures, in one round trip for all the alerts.
+        alerts is a list of (alert_id, is_alert, captures JSON), returns for each of them (changed, alert_changed,
+        entities in alert, stored alert JSON, notification repeat times), the stored alert and times as they were
+        before the transition.
+        """
+        con = self.con
+        calls = []
+        for alert_id, is_alert, capt_json in alerts:
+            keys = ['zmon:alerts:{}'.format(alert_id), 'zmon:alerts', 'zmon:alerts:{}:entities'.format(alert_id),
+                    'zmon:alerts:{}:{}'.format(alert_id, entity_id),
+                    'zmon:notifications:{}:{}'.format(alert_id, entity_id)]
+            calls.append((keys, [entity_id, alert_id, int(bool(is_alert)), capt_json]))
+
+        transitions = []
+        for changed, alert_changed, entities_in_alert, stored_raw, times in eval_script_pipelined(
+                con, registered_script(con, LUA_ALERT_TRANSITION), calls):
+            transitions.append((bool(changed), bool(alert_changed), entities_in_alert, stored_raw,
+                                dict(zip(times[::2], times[1::2]))))
+        return transitions
 
     @trace(pass_span=True)
     def notify(self, val, req, alerts, force_alert=False, **kwargs):
@@ -1601,38 +2120,20 @@ class MainTask(object):
             setp(req['check_id'], entity_id, 'notify loop')
             all_alerts_state = []
             all_alerts_changed_state = []
+
+            # check history shared by all alerts, starting with the result we just stored
+            history = CheckHistory(self.con, req['check_id'], entity_id, head=self._stored_results.pop(
+                'zmon:checks:{}:{}'.format(req['check_id'], entity_id), None))
+
+            # evaluate all alerts first, their state transitions then take a single round trip
+            evaluated = []
             for alert in alerts:
                 alert_id = alert['id']
-                alert_entities_key = 'zmon:alerts:{}'.format(alert_id)
-                alerts_key = 'zmon:alerts:{}:{}'.format(alert_id, entity_id)
-                notifications_key = 'zmon:notifications:{}:{}'.format(alert_id, entity_id)
-                is_alert, captures = ((True, {}) if force_alert else self.evaluate_alert(alert, req, val))
+                is_alert, captures = ((True, {}) if force_alert else self.evaluate_alert(alert, req, val, history))
 
                 # Timestamp of alert evaluation - useful in alerting metrics
                 alert_evaluation_ts = time.time()
 
-                alert_changed = False
-                func = getattr(self.con, ('sadd' if is_alert else 'srem'))
-                changed = bool(func(alert_entities_key, entity_id))
-
-                # Used later in sampling evaluation
-                all_alerts_state.append(is_alert)
-                all_alerts_changed_state.append(changed)
-
-                if is_alert:
-                    # bubble up: also update global set of alerts
-                    alert_changed = func('zmon:alerts', alert_id)
-
-                    if alert_changed:
-                        _log_event('ALERT_STARTED', alert, val)
-                else:
-                    entities_in_alert = self.con.smembers(alert_entities_key)
-                    if not entities_in_alert:
-                        # no entity has alert => remove from global set
-                        alert_changed = func('zmon:alerts', alert_id)
-                        if alert_changed:
-                            _log_event('ALERT_ENDED', alert, val)
-
                 # If an alert has malformed time period, we should evaluate it anyway and continue with
                 # the remaining alert definitions.
                 try:
@@ -1642,12 +2143,6 @@ class MainTask(object):
                     captures['exception'] = '; \n'.join(filter(None, [captures.get('exception'), str(e)]))
                     is_in_period = True
 
-                if changed and is_in_period and is_alert:
-                    # notify on entity-level
-                    _log_event(('ALERT_ENTITY_STARTED'), alert, val, entity_id)
-                elif changed and not is_alert:
-                    _log_event(('ALERT_ENTITY_ENDED'), alert, val, entity_id)
-
                 # Always store captures for given alert-entity pair, this is also used a list of all entities matching
                 # given alert id. Captures are stored here because this way we can easily link them with check results
                 # (see PF-3146).
@@ -1661,7 +2156,32 @@ class MainTask(object):
                     capt_json = json.dumps(captures, cls=JsonDataEncoder)
                     # FIXME - set is_alert = True?
 
-                self.con.hset('zmon:alerts:{}:entities'.format(alert_id), entity_id, capt_json)
+                evaluated.append((alert, is_alert, captures, capt_json, is_in_period, alert_evaluation_ts))
+
+            transitions = self._transition_alerts(entity_id, [(ev[0]['id'], ev[1], ev[3]) for ev in evaluated])
+
+            # writes depending on the previous state, sent together after the loop
+            writes = self.con.pipeline()
+            for (alert, is_alert, captures, capt_json, is_in_period, alert_evaluation_ts), transition in zip(
+                    evaluated, transitions):
+                alert_id = alert['id']
+                alerts_key = 'zmon:alerts:{}:{}'.format(alert_id, entity_id)
+                notifications_key = 'zmon:notifications:{}:{}'.format(alert_id, entity_id)
+                changed, alert_changed, entities_in_alert, stored_raw, previous_times = transition
+
+                # Used later in sampling evaluation
+                all_alerts_state.append(is_alert)
+                all_alerts_changed_state.append(changed)
+
+                if alert_changed:
+                    _log_event('ALERT_STARTED' if is_alert else 'ALERT_ENDED', alert, val)
+
+                if changed and is_in_period and is_alert:
+                    # notify on entity-level
+                    _log_event(('ALERT_ENTITY_STARTED'), alert, val, entity_id)
+                elif changed and not is_alert:
+                    _log_event(('ALERT_ENTITY_ENDED'), alert, val, entity_id)
+
                 # prepare report - alert part
                 check_result['alerts'][alert_id] = {
                     'alert_id': alert_id,
@@ -1676,10 +2196,9 @@ class MainTask(object):
                     # '_alert_stored': None,
                 }
 
-                # get last alert data stored in redis if any
+                # last alert data stored in redis if any
                 alert_stored = None
                 try:
-                    stored_raw = self.con.get(alerts_key)
                     alert_stored = json.loads(stored_raw) if stored_raw else None
                 except (ValueError, TypeError):
                     self.logger.warn('My messy Error parsing JSON alert result for key: %s', alerts_key)
@@ -1688,9 +2207,9 @@ class MainTask(object):
 
                 if is_in_period:
 
-                    self._counter.update({'alerts.{}.count'.format(alert_id): 1,
-                                          'alerts.{}.evaluation_duration'.format(alert_id):
-                                              int(round(1000.0 * (time.time() - start)))})
+                    self.update_counter({'alerts.{}.count'.format(alert_id): 1,
+                                         'alerts.{}.evaluation_duration'.format(alert_id):
+                                             int(round(1000.0 * (time.time() - start)))})
 
                     # Always evaluate downtimes, so that we don't miss downtime_ended event in case the downtime
                     # ends when the alert is no longer active.
@@ -1716,10 +2235,14 @@ class MainTask(object):
                                 if not check_result['alerts'][alert_id].get('exception', False):
                                     check_result['alerts'][alert_id]['exception'] = True
 
-                        self.con.set(alerts_key, alert_json)
+                        writes.set(alerts_key, alert_json)
                     else:
-                        self.con.delete(alerts_key)
-                        self.con.delete(notifications_key)
+                        # nothing to delete for entities that were not in alert before
+                        if stored_raw is not None:
+                            writes.delete(alerts_key)
+                        if previous_times:
+                            writes.delete(notifications_key)
+                        previous_times = {}
 
                     start = time.time()
                     notification_context = {
@@ -1739,30 +2262,25 @@ class MainTask(object):
                     if not downtimes:
                         if changed:
                             for notification in alert.get('notifications', []):
-                                self.send_notification(notification, notification_context)
+                                self.send_notification(notification, notification_context, con=writes)
                         else:
-                            previous_times = self.con.hgetall(notifications_key)
                             for notification in alert.get('notifications', []):
                                 if notification in previous_times and time.time() > float(previous_times[notification]):
-                                    self.send_notification(notification, notification_context)
+                                    self.send_notification(notification, notification_context, con=writes)
 
                     duration_ms = int(round(1000.0 * (time.time() - start)))
-                    self._counter.update({'alerts.{}.notification_duration'.format(alert_id): duration_ms})
+                    self.update_counter({'alerts.{}.notification_duration'.format(alert_id): duration_ms})
                     setp(req['check_id'], entity_id, 'notify loop - send metrics')
                     self.send_metrics()
                     setp(req['check_id'], entity_id, 'notify loop end')
                 else:
                     self.logger.debug('Alert %s is not in time period: %s', alert_id, alert['period'])
                     if is_alert:
-                        entities_in_alert = self.con.smembers('zmon:alerts:{}'.format(alert_id))
-
-                        p = self.con.pipeline()
-                        p.srem('zmon:alerts:{}'.format(alert_id), entity_id)
-                        p.delete('zmon:alerts:{}:{}'.format(alert_id, entity_id))
-                        p.delete(notifications_key)
-                        if len(entities_in_alert) == 1:
-                            p.srem('zmon:alerts', alert_id)
-                        p.execute()
+                        writes.srem('zmon:alerts:{}'.format(alert_id), entity_id)
+                        writes.delete('zmon:alerts:{}:{}'.format(alert_id, entity_id))
+                        writes.delete(notifications_key)
+                        if entities_in_alert == 1:
+                            writes.srem('zmon:alerts', alert_id)
 
                         self.logger.info(
                             'Removed alert with id %s on entity %s from active alerts due to time period: %s',
@@ -1779,6 +2297,8 @@ class MainTask(object):
                 check_result['alerts'][alert_id]['start_time_ts'] = alert_stored['start_time'] if alert_stored else None
                 check_result['alerts'][alert_id]['downtimes'] = downtimes
 
+            writes.execute()
+
             setp(req['check_id'], entity_id, 'return notified')
 
             # enqueue report to be sent via http request
@@ -1811,8 +2331,10 @@ class MainTask(object):
                 # overwrite timestamp with scheduled time for datapoint alignment
                 if (isinstance(check_result['check_result']['value'], dict) and
                         '_use_scheduled_time' in check_result['check_result']['value']):
-                    check_result['check_result']['ts'] = int(req['schedule_time'])
                     del check_result['check_result']['value']['_use_scheduled_time']
+                    check_result['check_result']['ts'] = int(req['schedule_time'])
+                    if isinstance(check_result['check_result'], CheckResult):
+                        check_result['check_result'].invalidate()  # the nested change keeps the cached encoding
 
                 self._dataservice_poster.enqueue(check_result)
 
@@ -1904,60 +2426,4 @@ class MainTask(object):
             return None
 
     def _evaluate_downtimes(self, alert_id, entity_id):
-        result = []
-
-        p = self.con.pipeline()
-        p.smembers('zmon:downtimes:{}'.format(alert_id))
-        p.hgetall('zmon:downtimes:{}:{}'.format(alert_id, entity_id))
-        redis_entities, redis_downtimes = p.execute()
-
-        try:
-            downtimes = dict((k, json.loads(v)) for (k, v) in redis_downtimes.iteritems())
-        except ValueError, e:
-            self.logger.exception(e)
-        else:
-            now = time.time()
-            for uuid, d in downtimes.iteritems():
-                # PF-3604 First check if downtime is active, otherwise check if it's expired, else: it's a
-                # future downtime.
-                try:
-                    if now > d['start_time'] and now < d['end_time']:
-                        d['id'] = uuid
-                        result.append(d)
-                        func = 'sadd'
-                    elif now >= d['end_time']:
-                        func = 'srem'
-                    else:
-                        continue
-
-                    # Check whether the downtime changed state: active -> inactive or inactive -> active.
-                    changed = getattr(self.con, func)(
-                        'zmon:active_downtimes', '{}:{}:{}'.format(alert_id, entity_id, uuid))
-                    if changed:
-                        pass
-                        # eventlog.log(EVENTS[('DOWNTIME_ENDED' if func == 'srem' else 'DOWNTIME_STARTED')].id, **{
-                        #     'alertId': alert_id,
-                        #     'entity': entity_id,
-                        #     'startTime': d['start_time'],
-                        #     'endTime': d['end_time'],
-                        #     'userName': d['created_by'],
-                        #     'comment': d['comment'],
-                        # })
-
-                    # If downtime is over, we can remove its definition from redis.
-                    if func == 'srem':
-                        if len(downtimes) == 1:
-                            p.delete('zmon:downtimes:{}:{}'.format(alert_id, entity_id))
-                            if len(redis_entities) == 1:
-                                p.delete('zmon:downtimes:{}'.format(alert_id))
-                                p.srem('zmon:downtimes', alert_id)
-                            else:
-                                p.srem('zmon:downtimes:{}'.format(alert_id), entity_id)
-                        else:
-                            p.hdel('zmon:downtimes:{}:{}'.format(alert_id, entity_id), uuid)
-                        p.execute()
-                except Exception:
-                    self.logger.exception('Exception while evaluating downtime!')
-                    continue
-
-        return result
+        return downtime_index.active(self.con, alert_id, entity_id)